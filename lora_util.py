@@ -24,19 +24,33 @@
 
 from spi_lora.LoRa import LoRa
 from spi_lora.constants import REG, MODE
-from spi_lora.boards.Generic_RFM95W import BOARD
+from spi_lora.status import decode_status, format_status, parse_register_dump, registers_from_dump
+from spi_lora.profiles import RadioProfile
 import argparse
-import re
 import sys
 
+parser = argparse.ArgumentParser(description='LoRa utility functions')
+parser.add_argument('--dump', '-d', dest='dump', default=False, action="store_true", help="dump all registers")
+parser.add_argument('--load', '-l', dest='load', default=None, type=argparse.FileType('r'), help="load and apply register dump file")
+parser.add_argument('--profile', '-p', dest='profile', default=None, type=argparse.FileType('r'),
+                    help="apply the modem profile in a register dump file, and verify it")
+parser.add_argument('--decode', dest='decode', default=[], nargs='+', type=argparse.FileType('r'),
+                    help="decode register dump files offline, without touching the modem")
+parser.add_argument('--low-band', dest='low_band', default=False, action="store_true",
+                    help="decode RSSI values for a low band modem (with --decode)")
+args = parser.parse_args()
+
+if args.decode:
+    for dump_file in args.decode:
+        print("%s:" % dump_file.name)
+        print(format_status(decode_status(registers_from_dump(dump_file), args.low_band)))
+    sys.exit(0)
+
+from spi_lora.boards.Generic_RFM95W import BOARD
+
 BOARD.setup()
 try:
 
-    parser = argparse.ArgumentParser(description='LoRa utility functions')
-    parser.add_argument('--dump', '-d', dest='dump', default=False, action="store_true", help="dump all registers")
-    parser.add_argument('--load', '-l', dest='load', default=None, type=argparse.FileType('r'), help="load and apply register dump file")
-    args = parser.parse_args()
-
     lora = LoRa(BOARD, verbose=False, do_calibration=False)
 
     if args.dump:
@@ -61,26 +75,19 @@ try:
         # We want to store all the things we applied so we can check them.
         applied_values = {}
         
-        for line in args.load:
-            # Parse out the register number and the hex value
-            parsed = re.match('([0-9A-F][0-9A-F]) +[0-9A-Z_]+ ([0-9A-F][0-9A-F]) [0-1]+', line)
-            if parsed:
-                # This is a line that means something
-                reg_number = int(parsed.group(1), 16)
-                reg_value = int(parsed.group(2), 16)
-            
-                if reg_number == REG.LORA.OP_MODE:
-                    if reg_value not in MODE.lookup:
-                        sys.stderr.write("Refusing to set unrecognized operating mode %02X\n" % reg_value)
-                        sys.exit(1)
-                    op_mode_set = True
-                elif not op_mode_set:
-                    sys.stderr.write("Refusing to set register %02X before OP_MODE\n" % reg_number)
+        for reg_number, reg_value in parse_register_dump(args.load):
+            if reg_number == REG.LORA.OP_MODE:
+                if reg_value not in MODE.lookup:
+                    sys.stderr.write("Refusing to set unrecognized operating mode %02X\n" % reg_value)
                     sys.exit(1)
-                
-                sys.stderr.write("Setting %02X to %02X\n" % (reg_number, reg_value))
-                lora.set_register(reg_number, reg_value)
-                applied_values[reg_number] = reg_value
+                op_mode_set = True
+            elif not op_mode_set:
+                sys.stderr.write("Refusing to set register %02X before OP_MODE\n" % reg_number)
+                sys.exit(1)
+            
+            sys.stderr.write("Setting %02X to %02X\n" % (reg_number, reg_value))
+            lora.set_register(reg_number, reg_value)
+            applied_values[reg_number] = reg_value
         
         sys.stderr.write("Verifying register values\n")
         
@@ -92,6 +99,12 @@ try:
 
         sys.stderr.write("Applied register dump file successfully\n")
 
+    elif args.profile:
+        profile = RadioProfile.load(args.profile)
+        sys.stderr.write("Applying profile with registers %s\n" % ' '.join('%02X' % a for a in sorted(profile.registers)))
+        lora.apply_profile(profile, verify=True)
+        sys.stderr.write("Applied profile successfully\n")
+
     else:
         print(lora)
 
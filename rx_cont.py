@@ -22,9 +22,10 @@
 # <http://www.gnu.org/licenses/>.
 
 
-from time import sleep
+from time import time
 from spi_lora.LoRa import *
 from spi_lora.LoRaArgumentParser import LoRaArgumentParser
+from spi_lora.poller import IrqPoller
 from spi_lora.boards.Generic_RFM95W import BOARD
 
 BOARD.setup()
@@ -38,19 +39,6 @@ class LoRaRcvCont(LoRa):
         self.set_mode(MODE.SLEEP)
         self.set_dio_mapping([0] * 6)
 
-    def on_rx_done(self):
-        BOARD.led_on()
-        print("\nRxDone")
-        self.clear_irq_flags(RxDone=1)
-        payload = self.read_payload(nocheck=True)
-        print("Payload is {} bytes".format(len(payload)))
-        print("Payload: {}".format(payload))
-        print("Payload decodes to: \"{}\"".format(bytes(payload).decode()))
-        self.set_mode(MODE.SLEEP)
-        self.reset_ptr_rx()
-        BOARD.led_off()
-        self.set_mode(MODE.RXCONT)
-
     def on_tx_done(self):
         print("\nTxDone")
         print(self.get_irq_flags())
@@ -75,17 +63,35 @@ class LoRaRcvCont(LoRa):
         print("\non_FhssChangeChannel")
         print(self.get_irq_flags())
 
+    def print_packet(self, packet):
+        BOARD.led_on()
+        print("\nRxDone")
+        print("Payload is {} bytes, RSSI {} dBm, SNR {} dB, CRC {}".format(
+            len(packet.payload), packet.rssi, packet.snr, "ok" if packet.crc_ok else "bad"))
+        print("Payload: {}".format(list(packet.payload)))
+        print("Payload decodes to: \"{}\"".format(packet.payload.decode(errors='replace')))
+        BOARD.led_off()
+
     def start(self):
-        self.reset_ptr_rx()
-        self.set_mode(MODE.RXCONT)
+        # The IRQ handler only queues packets and leaves the modem in RXCONT, so all the printing happens out here
+        ring = self.start_rx_pipeline(capacity=32)
+        poller = None if self.irq_events_available else IrqPoller(self)
+        last_status = 0
         while True:
-            sleep(.5)
-            rssi_value = self.get_rssi_value()
-            status = self.get_modem_status()
-            sys.stdout.flush()
-            sys.stdout.write("\r%d %d %d" % (rssi_value, status['rx_ongoing'], status['modem_clear']))
-            if not self.irq_events_available:
-                self.handle_irq_flags()
+            # Without DIO lines, packets only arrive while polling, so waiting on the ring is the poller's sleep
+            packet = ring.get(timeout=poller.poll() if poller else .5)
+            if packet is not None:
+                self.print_packet(packet)
+                continue
+            if time() - last_status >= .5:
+                last_status = time()
+                rssi_value = self.get_rssi_value()
+                status = self.get_modem_status()
+                sys.stdout.flush()
+                sys.stdout.write("\r%d %d %d dropped=%d" % (rssi_value, status['rx_ongoing'], status['modem_clear'],
+                                                            ring.dropped))
+                if poller:
+                    sys.stdout.write(" poll=%.1fms" % (poller.interval * 1000))
 
 
 lora = LoRaRcvCont(BOARD, verbose=False)
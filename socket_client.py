@@ -1,29 +1,55 @@
 #!/usr/bin/env python3
 
 # used for testing socket_transceiver.py
-# connects to socket and allows user to send ascii payload
+# connects to socket and allows user to send ascii payload, printing whatever the gateway receives
 
 import socket
- 
+import struct
+import sys
+import threading
+
+
+def recv_exactly(sock, length):
+        data = b''
+        while len(data) < length:
+                chunk = sock.recv(length - len(data))
+                if not chunk:
+                        return None
+                data += chunk
+        return data
+
+
+def print_received(sock):
+        while True:
+                header = recv_exactly(sock, 2)
+                if header is None:
+                        break
+                data = recv_exactly(sock, struct.unpack('>H', header)[0])
+                if data is None:
+                        break
+                print('From LoRa: ' + data.decode('ascii', 'replace'))
+
+
 def sock_client():
         host = '127.0.0.1'
         port = 20000
-         
+        if len(sys.argv) > 1:
+                port = int(sys.argv[1])
+
         sock = socket.socket()
         sock.connect((host,port))
-         
+
+        threading.Thread(target=print_received, args=(sock,), daemon=True).start()
+
         message = input('>> ')
-         
-        while message != 'quit':
-                sock.send(bytearray(message,'utf-8'))
 
-                data = bytearray(sock.recv(1024)).decode('ascii')
-                 
-                print ('From LoRa: ' + data)                 
+        while message != 'quit':
+                payload = bytearray(message,'utf-8')
+                sock.sendall(struct.pack('>H', len(payload)) + payload)
 
                 message = input('>> ')
-                 
+
         sock.close()
- 
+
 if __name__ == '__main__':
     sock_client()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-""" An asynchronous socket <-> LoRa interface """
+""" A socket <-> LoRa gateway. Any number of clients can connect over TCP or a Unix socket. """
 
 # MIT License
 #
@@ -25,103 +25,64 @@
 # SOFTWARE.
 
 
-import sys, asyncore
-from time import time
+import argparse
+import asyncio
+import importlib
+import sys
 from spi_lora.LoRa import *
-from spi_lora.boards.RPi_inAir9B import BOARD
+from spi_lora.LoRaArgumentParser import LoRaArgumentParser
+from spi_lora.AsyncLoRa import AsyncLoRa
+from spi_lora.gateway import LoRaGateway
+from spi_lora.scheduler import TxScheduler
 
-BOARD.setup()
-
-class Server(asyncore.dispatcher):
-    def __init__(self, host, port):
-        asyncore.dispatcher.__init__(self)
-        self.create_socket()
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(1) 
-        
-    def handle_accepted(self, sock, addr):
-        print("Connection from %s:%s" % sock.getpeername())
-        self.conn = Handler(sock)
+parser = LoRaArgumentParser("Socket <-> LoRa gateway. Packets are framed with a 2-byte big-endian length prefix.")
+parser.add_argument('--board', dest='board', default='RPi_inAir9B', action="store", type=str,
+                    help="Board module in spi_lora.boards. Default is RPi_inAir9B.")
+parser.add_argument('--host', dest='host', default='localhost', action="store", type=str,
+                    help="Address to listen on. Default is localhost.")
+parser.add_argument('--port', dest='port', default=20000, action="store", type=int,
+                    help="TCP port to listen on. Default is 20000.")
+parser.add_argument('--unix', dest='unix', default=None, action="store", type=str,
+                    help="Also listen on this Unix socket path.")
+parser.add_argument('--tx-queue', dest='tx_queue', default=16, action="store", type=int,
+                    help="Packets to queue for transmission before holding off clients. Default is 16.")
+parser.add_argument('--duty-cycle', dest='duty_cycle', action="store_true",
+                    help="Hold packets until the EU868 sub-band duty cycle limits allow them to go.")
+parser.add_argument('--verbose', '-v', dest='verbose', action="store_true",
+                    help="Log connections and packets.")
 
-class Handler(asyncore.dispatcher):
-    def __init__(self, sock):
-        asyncore.dispatcher.__init__(self, sock)
-        self.databuffer = b""
-        self.tx_wait = 0
-    
-    # when data is available on socket send to LoRa
-    def handle_read(self):
-        if not self.tx_wait:
-            data = self.recv(127)
-            print('Send:' + str(data))
-            lora.write_payload(list(data))
-            lora.set_dio_mapping([1,0,0,0,0,0]) # set DIO0 for txdone
-            lora.set_mode(MODE.TX)
-            self.tx_wait = 1 
-    
-    # when data for the socket, send
-    def handle_write(self):
-        if self.databuffer:
-            self.send(self.databuffer)
-            self.databuffer = b""
-            
-    def handle_close(self):
-        print("Client disconnected")
-        self.close()
-        
-class LoRaSocket(LoRa):
-    
-    def __init__(self, board=None, verbose=False):
-        super(LoRaSocket, self).__init__(board=board, verbose=verbose)
-        self.set_mode(MODE.SLEEP)
-        self.set_pa_config(pa_select=1)
-        self.set_max_payload_length(128) # set max payload to max fifo buffer length
-        self.payload = []
-        self.set_dio_mapping([0] * 6) #initialise DIO0 for rxdone  
-        
-    # when LoRa receives data send to socket conn
-    def on_rx_done(self):        
-        payload = self.read_payload(nocheck=True)
-        
-        if len(payload) == 127:
-            self.payload[len(self.payload):] = payload
-        else:
-            self.payload[len(self.payload):] = payload
-            print('Recv:' + str(bytes(self.payload)))
+# We need the board before we can make the LoRa object that parse_args() configures
+BOARD = importlib.import_module('spi_lora.boards.' + argparse.ArgumentParser.parse_args(parser).board).BOARD
+BOARD.setup()
 
-            server.conn.databuffer = bytes(self.payload) #send to socket conn
-            self.payload = []
+lora = LoRa(BOARD, verbose=False)
+lora.set_mode(MODE.SLEEP)
+args = parser.parse_args(lora)
+with lora.batch():
+    lora.set_pa_config(pa_select=1)
+    lora.set_max_payload_length(128) # set max payload to max fifo buffer length
 
-        self.clear_irq_flags(RxDone=1) # clear rxdone IRQ flag
-        self.reset_ptr_rx()
-        self.set_mode(MODE.RXCONT)
-    
-    # after data sent by LoRa reset to receive mode
-    def on_tx_done(self):
-        self.clear_irq_flags(TxDone=1) # clear txdone IRQ flag
-        self.set_dio_mapping([0] * 6)    
+print(lora)
 
-        self.set_mode(MODE.RXCONT)
-        server.conn.tx_wait = 0
-   
 
-if __name__ == '__main__':
-    
-    server = Server('localhost', 20000)
-    
-    lora = LoRaSocket(BOARD, verbose=False)
+async def main():
+    async with AsyncLoRa(lora) as radio:
+        scheduler = TxScheduler(lora) if args.duty_cycle else None
+        gateway = LoRaGateway(radio, tx_queue_size=args.tx_queue, scheduler=scheduler, verbose=args.verbose)
+        await gateway.start_tcp(args.host, args.port)
+        if args.unix:
+            await gateway.start_unix(args.unix)
+        try:
+            await gateway.serve_forever()
+        finally:
+            await gateway.close()
 
-    print(lora)
-    
-    try:
-        asyncore.loop()
 
-    except KeyboardInterrupt:
-        sys.stderr.write("\nKeyboardInterrupt\n")
-        
-    finally:
-        lora.set_mode(MODE.SLEEP)
-        print("Closing socket connection")
-        server.close()
-        BOARD.teardown()
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    sys.stderr.write("\nKeyboardInterrupt\n")
+finally:
+    lora.set_mode(MODE.SLEEP)
+    print("Closing socket connection")
+    BOARD.teardown()
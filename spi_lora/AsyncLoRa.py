@@ -0,0 +1,230 @@
+""" Defines AsyncLoRa, an asyncio interface to a GenericLoRa modem. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+
+from .constants import *
+from .poller import IrqPoller
+
+
+# DIO mappings for each job; see GenericLoRa._dio0 and _dio1
+DIO_MAPPING_RX = [0, 0, 0, 0, 0, 0]     # DIO0: RxDone
+DIO_MAPPING_TX = [1, 0, 0, 0, 0, 0]     # DIO0: TxDone
+DIO_MAPPING_CAD = [2, 2, 0, 0, 0, 0]    # DIO0: CadDone, DIO1: CadDetected
+
+# Seconds between IRQ flag polls while a packet is coming in or a job is running, without IRQ events
+IRQ_LATENCY_TARGET = 0.002
+
+
+class AsyncLoRa(object):
+    """
+    asyncio interface to a GenericLoRa (or LoRa) object.
+
+    Takes over the on_rx_done, on_tx_done and on_cad_done handlers of the
+    modem object. If the modem has IRQ events, they may arrive on any thread
+    and are handed to the event loop with call_soon_threadsafe(), so all SPI
+    traffic happens on the event loop thread. Otherwise the IRQ flags are
+    polled from a task on the loop.
+
+    Received packets are queued as LoRa.RxPacket records. Many AsyncLoRa
+    objects can share one event loop.
+
+        radio = AsyncLoRa(lora)
+        await radio.start()
+        await radio.send(b'hello')
+        packet = await radio.receive(timeout=10)
+        async for packet in radio:
+            ...
+    """
+
+    def __init__(self, lora, poll_interval=0.01, rx_queue_size=64):
+        """
+        :param lora: The GenericLoRa object to drive
+        :param poll_interval: Longest time between IRQ flag polls in seconds, if the modem has no IRQ events. Polls
+        come faster while a packet is coming in or a job is running; see poller.IrqPoller.
+        :param rx_queue_size: Number of received packets to hold. When full, the oldest packet is dropped.
+        """
+        self.lora = lora
+        self.poll_interval = poll_interval
+        self.rx_queue_size = rx_queue_size
+        self.listening = False
+        self.rx_dropped = 0
+        self.loop = None
+        self._loop_thread = None
+        self._rx_queue = None
+        self._job_lock = None
+        self._job_future = None
+        self._poll_task = None
+        self.poller = None
+
+    async def start(self, listen=True):
+        """ Hook up the modem to the running event loop.
+        :param listen: If True, put the modem in RXCONT mode to receive packets whenever it is not busy
+        """
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.current_thread()
+        self._rx_queue = asyncio.Queue(self.rx_queue_size)
+        self._job_lock = asyncio.Lock()
+        self.lora.on_rx_done = self._irq_handler(self._rx_done)
+        self.lora.on_tx_done = self._irq_handler(self._tx_done)
+        self.lora.on_cad_done = self._irq_handler(self._cad_done)
+        if not self.lora.irq_events_available:
+            self.poller = IrqPoller(self.lora, latency_target=min(self.poll_interval, IRQ_LATENCY_TARGET),
+                                    max_interval=self.poll_interval)
+            self._poll_task = self.loop.create_task(self._poll())
+        self.listening = listen
+        if listen:
+            self._resume_rx()
+
+    async def close(self):
+        """ Stop driving the modem and put it to sleep. """
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+        self.poller = None
+        for handler in ('on_rx_done', 'on_tx_done', 'on_cad_done'):
+            # Drop our instance attributes so the class methods show through again
+            self.lora.__dict__.pop(handler, None)
+        self.listening = False
+        self.lora.set_mode(MODE.SLEEP)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def send(self, payload, timeout=None):
+        """ Transmit a packet and wait for the transmission to finish.
+        :param payload: Payload (bytes or list of ints)
+        :param timeout: Seconds to wait for TxDone, or None to wait forever
+        """
+        async with self._job_lock:
+            done = self._start_job()
+            try:
+                self.lora.set_dio_mapping(DIO_MAPPING_TX)
+                self.lora.write_payload(payload)
+                self.lora.set_mode(MODE.TX)
+                try:
+                    await asyncio.wait_for(done, timeout)
+                except asyncio.TimeoutError:
+                    # Don't leave the modem transmitting, or waiting to
+                    self.lora.set_mode(MODE.STDBY)
+                    raise
+            finally:
+                self._end_job()
+
+    async def cad(self, timeout=None):
+        """ Run Channel Activity Detection.
+        :param timeout: Seconds to wait for CadDone, or None to wait forever
+        :return: True if LoRa activity was detected on the channel
+        :rtype: bool
+        """
+        async with self._job_lock:
+            done = self._start_job()
+            try:
+                self.lora.set_dio_mapping(DIO_MAPPING_CAD)
+                self.lora.set_mode(MODE.STDBY)
+                self.lora.set_mode(MODE.CAD)
+                return await asyncio.wait_for(done, timeout)
+            finally:
+                self._end_job()
+
+    async def receive(self, timeout=None):
+        """ Wait for a received packet.
+        :param timeout: Seconds to wait, or None to wait forever
+        :return: The next received packet
+        :rtype: LoRa.RxPacket
+        :raises asyncio.TimeoutError: if no packet arrives in time
+        """
+        return await asyncio.wait_for(self._rx_queue.get(), timeout)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._rx_queue.get()
+
+    # Internals. Everything below runs on the event loop thread.
+
+    def _irq_handler(self, handler):
+        """ Wrap a handler so that it runs on the event loop thread, whichever thread the IRQ arrives on. The handler
+        gets the IRQ's timestamp, since another IRQ may have come in by the time it runs. """
+        def on_irq():
+            timestamp = self.lora.irq_timestamp
+            if threading.current_thread() is self._loop_thread:
+                handler(timestamp)
+            else:
+                self.loop.call_soon_threadsafe(handler, timestamp)
+        return on_irq
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poller.poll())
+
+    def _start_job(self):
+        self._job_future = self.loop.create_future()
+        return self._job_future
+
+    def _end_job(self):
+        self._job_future = None
+        if self.listening:
+            self._resume_rx()
+
+    def _finish_job(self, result=None):
+        if self._job_future is not None and not self._job_future.done():
+            self._job_future.set_result(result)
+
+    def _resume_rx(self):
+        self.lora.set_mode(MODE.STDBY)
+        self.lora.set_dio_mapping(DIO_MAPPING_RX)
+        self.lora.reset_ptr_rx()
+        self.lora.set_mode(MODE.RXCONT)
+
+    def _rx_done(self, timestamp):
+        packet = self.lora.fetch_packet(timestamp)
+        if packet is None:
+            # Already handled, e.g. by an event and a poll racing each other
+            return
+        if self._rx_queue.full():
+            self._rx_queue.get_nowait()
+            self.rx_dropped += 1
+        self._rx_queue.put_nowait(packet)
+
+    def _tx_done(self, timestamp):
+        self.lora.clear_irq_flags(TxDone=1)
+        # The modem goes back to STDBY by itself after TX
+        self.lora.set_mode(MODE.STDBY)
+        self._finish_job()
+
+    def _cad_done(self, timestamp):
+        flags = self.lora.get_irq_flags()
+        self.lora.clear_irq_flags(CadDone=1, CadDetected=1)
+        # The modem goes back to STDBY by itself after CAD
+        self.lora.set_mode(MODE.STDBY)
+        self._finish_job(bool(flags['cad_detected']))
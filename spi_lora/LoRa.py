@@ -21,8 +21,21 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import collections
+import contextlib
 import sys
+import threading
+import time
+from itertools import islice
 from .constants import *
+from .airtime import AirtimeParams
+from .cache import RegisterCache
+from .lock import InstrumentedLock
+from .ring import PacketRing, DROP_OLDEST
+from .status import (decode_dio_mapping, decode_fei, decode_freq, decode_hop_channel, decode_irq_flags, decode_lna,
+                     decode_modem_config_1, decode_modem_config_2, decode_modem_config_3, decode_modem_status,
+                     decode_ocp, decode_pa_config, decode_pa_dac, decode_rssi, decode_snr, decode_status,
+                     decode_symb_timeout, decode_tcxo, dump_registers, format_status)
 
 
 ################################################## Some utility functions ##############################################
@@ -43,6 +56,39 @@ def set_bit(value, index, new_bit):
     return value
 
 
+# A received packet with its metadata. payload is bytes, rssi is in dBm, snr in dB, and timestamp is the
+# time.monotonic() value of its RxDone IRQ: the kernel's timestamp of the DIO edge if the board provides one, otherwise
+# the time the IRQ was handled.
+RxPacket = collections.namedtuple('RxPacket', ['payload', 'rssi', 'snr', 'crc_ok', 'timestamp'])
+
+
+def encode_freq(f):
+    """ Compute the FR_MSB, FR_MID and FR_LSB register values for a frequency.
+    :param f: Frequency in MHz
+    :return: Register values [msb, mid, lsb]
+    :rtype: list[int]
+    """
+    i = int(f * 16384.)    # choose floor
+    msb = i // 65536
+    i -= msb * 65536
+    mid = i // 256
+    i -= mid * 256
+    lsb = i
+    return [msb, mid, lsb]
+
+
+def encode_ocp_trim(I_mA):
+    """ Compute the OcpTrim bits of the OCP register for a current limit.
+    :param I_mA: Current limit in mA, 45 .. 240
+    :rtype: int
+    """
+    assert(I_mA >= 45 and I_mA <= 240)
+    if I_mA <= 120:
+        return int(round((I_mA-45.)/5.))
+    else:
+        return int(round((I_mA+30.)/10.))
+
+
 def getter(register_address):
     """ The getter decorator reads the register content and calls the decorated function to do
         post-processing.
@@ -52,11 +98,23 @@ def getter(register_address):
     """
     def decorator(func):
         def wrapper(self):
-            return func(self, self.spi.xfer([register_address, 0])[1])
+            return func(self, self.get_register(register_address))
         return wrapper
     return decorator
 
 
+def locked(func):
+    """ The locked decorator holds the object's lock while the decorated method runs, so that its SPI transfers
+        don't interleave with those of another thread.
+    """
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
 def setter(register_address):
     """ The setter decorator calls the decorated function for pre-processing and
         then writes the result to the register
@@ -66,7 +124,7 @@ def setter(register_address):
     """
     def decorator(func):
         def wrapper(self, val):
-            return self.spi.xfer([register_address | 0x80, func(self, val)])[1]
+            return self.set_register(register_address, func(self, val))
         return wrapper
     return decorator
 
@@ -85,6 +143,11 @@ class GenericLoRa(object):
     Can be extended and have its on_ methods overridden to receive interrupts.
     If no add_events is provided to the constructor, the user must call
     handle_irq_flags() occasionally in order for interrupts to be handled.
+
+    It may be used from several threads, e.g. the main loop and the DIO
+    callback thread. Each register access, each multi-step operation such as
+    write_payload() or fetch_packet(), and each IRQ handler runs holding a
+    re-entrant lock. Use atomic() to hold it across several calls.
     """
 
     spi = None
@@ -94,8 +157,21 @@ class GenericLoRa(object):
     verbose = True
     dio_mapping = [None] * 6          # store the dio mapping here
     irq_events_available = False
-
-    def __init__(self, spi_connection, low_band, add_events=None, verbose=True, do_calibration=True, calibration_freq=868):
+    register_cache = None             # RegisterCache, if caching is enabled
+    BATCH_MAX_GAP = 4                 # cached registers batch() may rewrite to join two bursts
+    _batch = None                     # writes collected by batch(), by register address
+    _batch_depth = 0
+    rx_ring = None                    # PacketRing the receive pipeline fills, while it is running
+    _rx_flags_cleared = False         # set by fetch_packet(), so handle_irq_flags() knows not to clear them again
+    irq_timestamp = None              # time.monotonic() of the IRQ being handled, or of the last one
+    duty_cycle = None                 # airtime.DutyCycleLedger to charge every transmission to, if set
+    lbt = None                        # lbt.ListenBeforeTalk for transmit() to use, if set
+    _cad_event = None                 # set by the CadDone IRQ while cad() waits for it
+    fhss = None                       # fhss.FhssEngine to hand FhssChangeChannel IRQs to, while it is started
+    channel_plan = None               # channels.ChannelPlan for tune() and get_channel()
+
+    def __init__(self, spi_connection, low_band, add_events=None, verbose=True, do_calibration=True, calibration_freq=868,
+                 cache_registers=False):
         """Create a new LoRa driver object.
         
         Send the device to sleep, read all registers, and do the calibration (if do_calibration=True)
@@ -112,10 +188,22 @@ class GenericLoRa(object):
         :param calibration_freq: call rx_chain_calibration with this frequency
         parameter in MHz. Default is 868
         :param do_calibration: Call rx_chain_calibration, default is True.
+        :param cache_registers: Keep a shadow copy of the configuration
+        registers, so that reading them and rewriting unchanged values does not
+        need an SPI transfer. Volatile registers (IRQ flags, FIFO pointers,
+        packet status, etc.) are always read from the modem. Only use this if
+        nothing else changes the modem configuration behind this object's back,
+        or call resync() when something might have.
         """
+        self.lock = InstrumentedLock()
         self.spi = spi_connection
         self.low_band = low_band
         self.verbose = verbose
+        # FIFO transfers are built in here, so sending a payload does not allocate a list of ints for it
+        self._fifo_buffer = bytearray(MAX_PAYLOAD_LENGTH + 1)
+        self._fifo_view = memoryview(self._fifo_buffer)
+        if cache_registers:
+            self.register_cache = RegisterCache()
         if add_events:
             # set the callbacks for DIO0..5 IRQs.
             add_events(self._dio0, self._dio1, self._dio2, self._dio3, self._dio4, self._dio5)
@@ -155,41 +243,57 @@ class GenericLoRa(object):
     def on_fhss_change_channel(self):
         pass
 
-    # Internal callbacks for add_events()
+    def on_cad_detected(self):
+        pass
+
+    # Internal callbacks for add_events(). Boards that know when the DIO line went high, e.g. from a kernel line event,
+    # pass that as a time.monotonic() value in timestamp, and the on_ handlers can find it in self.irq_timestamp.
 
-    def _dio0(self, channel):
+    @locked
+    def _dio0(self, channel, timestamp=None):
+        self.irq_timestamp = time.monotonic() if timestamp is None else timestamp
         # DIO0 00: RxDone
         # DIO0 01: TxDone
         # DIO0 10: CadDone
         if self.dio_mapping[0] == 0:
-            self.on_rx_done()
+            self._rx_done()
         elif self.dio_mapping[0] == 1:
             self.on_tx_done()
         elif self.dio_mapping[0] == 2:
-            self.on_cad_done()
+            if self._cad_event is not None:
+                self._cad_event.set()
+            else:
+                self.on_cad_done()
         else:
             raise RuntimeError("unknown dio0mapping!")
 
-    def _dio1(self, channel):
+    @locked
+    def _dio1(self, channel, timestamp=None):
+        self.irq_timestamp = time.monotonic() if timestamp is None else timestamp
         # DIO1 00: RxTimeout
         # DIO1 01: FhssChangeChannel
         # DIO1 10: CadDetected
         if self.dio_mapping[1] == 0:
             self.on_rx_timeout()
         elif self.dio_mapping[1] == 1:
-            self.on_fhss_change_channel()
+            self._fhss_change_channel()
         elif self.dio_mapping[1] == 2:
-            self.on_CadDetected()
+            if self._cad_event is None:
+                self.on_cad_detected()
         else:
             raise RuntimeError("unknown dio1mapping!")
 
-    def _dio2(self, channel):
+    @locked
+    def _dio2(self, channel, timestamp=None):
+        self.irq_timestamp = time.monotonic() if timestamp is None else timestamp
         # DIO2 00: FhssChangeChannel
         # DIO2 01: FhssChangeChannel
         # DIO2 10: FhssChangeChannel
-        self.on_fhss_change_channel()
+        self._fhss_change_channel()
 
-    def _dio3(self, channel):
+    @locked
+    def _dio3(self, channel, timestamp=None):
+        self.irq_timestamp = time.monotonic() if timestamp is None else timestamp
         # DIO3 00: CadDone
         # DIO3 01: ValidHeader
         # DIO3 10: PayloadCrcError
@@ -202,28 +306,32 @@ class GenericLoRa(object):
         else:
             raise RuntimeError("unknown dio3 mapping!")
 
-    def _dio4(self, channel):
+    def _dio4(self, channel, timestamp=None):
         raise RuntimeError("DIO4 is not used")
 
-    def _dio5(self, channel):
+    def _dio5(self, channel, timestamp=None):
         raise RuntimeError("DIO5 is not used")
         
-    def handle_irq_flags(self):
+    @locked
+    def handle_irq_flags(self, irq_flags=None):
         """
         Retrieve the IRQ flags and dispatch the handler methods for all the set
         flags.
         
         If add_events is not passed to __init__, this method must be called
         periodically by the user for the various overridable on_ functions to
-        work. 
+        work. poller.IrqPoller can do that.
+        :param irq_flags: The IRQ_FLAGS register value, if the caller has just read it
         """
-        flags = self.get_irq_flags()
+        flags = decode_irq_flags(self.get_register(REG.LORA.IRQ_FLAGS) if irq_flags is None else irq_flags)
+        self.irq_timestamp = time.monotonic()
+        self._rx_flags_cleared = False
         # Some demo handlers expect to see the flags set in the handler, so we
         # don't clear them yet.
         if flags['rx_timeout']:
             self.on_rx_timeout()
         if flags['rx_done']:
-            self.on_rx_done()
+            self._rx_done()
         if flags['crc_error']:
             self.on_payload_crc_error()
         if flags['valid_header']:
@@ -233,29 +341,83 @@ class GenericLoRa(object):
         if flags['cad_done']:
             self.on_cad_done()
         if flags['fhss_change_ch']:
-            self.on_fhss_change_channel()
+            self._fhss_change_channel()
         if flags['cad_detected']:
-            self.on_CadDetected()
+            self.on_cad_detected()
         # Clear all the interrupt flags that were set so we can get them again.
         # clear_irq_flags takes any non-None as a clear, even 0 or False, so we make sure to provide Nones.
+        # The receive pipeline has already cleared its flags, and clearing them again could lose the next packet.
+        # The same goes for an on_rx_done() that fetched the packet, like AsyncLoRa's, and for the FHSS engine and
+        # FhssChangeChannel.
+        rx_flags = self.rx_ring is None and not self._rx_flags_cleared
         self.clear_irq_flags(RxTimeout=flags['rx_timeout'] or None,
-                             RxDone=flags['rx_done'] or None,
-                             PayloadCrcError=flags['crc_error'] or None, 
-                             ValidHeader=flags['valid_header'] or None,
+                             RxDone=flags['rx_done'] and rx_flags or None,
+                             PayloadCrcError=flags['crc_error'] and rx_flags or None,
+                             ValidHeader=flags['valid_header'] and rx_flags or None,
                              TxDone=flags['tx_done'] or None,
                              CadDone=flags['cad_done'] or None, 
-                             FhssChangeChannel=flags['fhss_change_ch'] or None,
+                             FhssChangeChannel=flags['fhss_change_ch'] and self.fhss is None or None,
                              CadDetected=flags['cad_detected'] or None)
 
+    # The receive pipeline
+
+    def start_rx_pipeline(self, capacity=64, overflow=DROP_OLDEST, ring=None):
+        """ Receive continuously into a ring buffer.
+
+        From now on, the RxDone handler only reads the packet and its metadata
+        from the modem, pushes a RxPacket into the ring and returns, leaving
+        the modem in RXCONT mode the whole time. on_rx_done() is no longer
+        called. Take packets out of the ring with get() or drain() in another
+        thread, or from an asyncio task woken by the ring's notify function.
+        :param capacity: Number of packets the ring holds
+        :param overflow: What to do when the ring is full: ring.DROP_OLDEST or ring.DROP_NEWEST
+        :param ring: Use this PacketRing instead of making a new one
+        :return: The ring
+        :rtype: ring.PacketRing
+        """
+        self.rx_ring = ring if ring is not None else PacketRing(capacity, overflow)
+        self.set_mode(MODE.STDBY)
+        self.set_dio_mapping([0] * 6)    # DIO0: RxDone
+        self.reset_ptr_rx()
+        self.set_mode(MODE.RXCONT)
+        return self.rx_ring
+
+    def stop_rx_pipeline(self):
+        """ Stop receiving into the ring buffer, put the transceiver into STDBY mode and go back to calling
+        on_rx_done(). Packets still in the ring stay there.
+        :return: The ring
+        :rtype: ring.PacketRing
+        """
+        ring, self.rx_ring = self.rx_ring, None
+        self.set_mode(MODE.STDBY)
+        return ring
+
+    def _fhss_change_channel(self):
+        if self.fhss is None:
+            self.on_fhss_change_channel()
+        else:
+            self.fhss.hop()
+
+    def _rx_done(self):
+        if self.rx_ring is None:
+            self.on_rx_done()
+            return
+        packet = self.fetch_packet(self.irq_timestamp)
+        # In RXCONT mode the modem moves FifoRxCurrentAddr along by itself, so there is nothing to re-arm.
+        if packet is not None:
+            self.rx_ring.push(packet)
+
     # All the set/get/read/write functions
 
+    @locked
     def get_mode(self):
         """ Get the mode
         :return:    New mode
         """
-        self.mode = self.spi.xfer([REG.LORA.OP_MODE, 0])[1]
+        self.mode = self.get_register(REG.LORA.OP_MODE)
         return self.mode
 
+    @locked
     def set_mode(self, mode):
         """ Set the mode
         :param mode: Set the mode. Use constants.MODE class
@@ -264,27 +426,91 @@ class GenericLoRa(object):
         # the mode is backed up in self.mode
         if mode == self.mode:
             return mode
+        if mode == MODE.TX and self.duty_cycle is not None:
+            # Raises DutyCycleExceeded, without starting the transmission, if it would go over the limit
+            self.duty_cycle.charge(self.time_on_air())
         if self.verbose:
             sys.stderr.write("Mode <- %s\n" % MODE.lookup[mode])
         self.mode = mode
-        return self.spi.xfer([REG.LORA.OP_MODE | 0x80, mode])[1]
+        return self.set_register(REG.LORA.OP_MODE, mode)
+
+    def cad(self, timeout=1.):
+        """ Run Channel Activity Detection and wait for it to finish.
+
+        With IRQ events, this maps DIO0 to CadDone and DIO1 to CadDetected and
+        waits for the event; otherwise it polls the IRQ flags. Either way the
+        DIO mapping is put back afterwards, the CAD flags are cleared, the
+        transceiver is left in STDBY mode, and on_cad_done() and
+        on_cad_detected() are not called.
+        :param timeout: Seconds to wait for CadDone
+        :return: True if LoRa activity was detected on the channel
+        :rtype: bool
+        :raises RuntimeError: if CadDone does not come in time
+        """
+        cad_flags = 1 << MASK.IRQ_FLAGS.CadDone | 1 << MASK.IRQ_FLAGS.CadDetected
+        mapping = list(self.dio_mapping)
+        self.set_mode(MODE.STDBY)
+        if self.irq_events_available:
+            self._cad_event = threading.Event()
+            self.set_dio_mapping([2, 2] + mapping[2:])
+        try:
+            self.set_mode(MODE.CAD)
+            if self._cad_event is not None:
+                if not self._cad_event.wait(timeout):
+                    raise RuntimeError("CAD did not finish in %g s" % timeout)
+                irq_flags = self.get_register(REG.LORA.IRQ_FLAGS)
+            else:
+                deadline = time.monotonic() + timeout
+                irq_flags = self.get_register(REG.LORA.IRQ_FLAGS)
+                while not irq_flags & 1 << MASK.IRQ_FLAGS.CadDone:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("CAD did not finish in %g s" % timeout)
+                    time.sleep(.0005)
+                    irq_flags = self.get_register(REG.LORA.IRQ_FLAGS)
+        finally:
+            self._cad_event = None
+            # The modem goes back to STDBY by itself after CAD, but the mode cache does not know that
+            self.set_mode(MODE.STDBY)
+            if self.irq_events_available:
+                self.set_dio_mapping(mapping)
+        self.set_register(REG.LORA.IRQ_FLAGS, irq_flags & cad_flags)
+        return bool(irq_flags & 1 << MASK.IRQ_FLAGS.CadDetected)
+
+    def transmit(self, payload):
+        """ Write a payload and start transmitting it. If lbt is set to a ListenBeforeTalk, wait until the channel is
+        clear first. TxDone is signalled as usual.
+        :param payload: Payload (bytes or list of ints)
+        :raises lbt.ChannelBusy: if the channel stayed busy for all of lbt's attempts
+        """
+        if self.lbt is not None:
+            self.lbt.acquire(self)
+        with self.lock:
+            self.write_payload(payload)
+            self.set_mode(MODE.TX)
 
+    @locked
     def write_payload(self, payload):
         """ Get FIFO ready for TX: Set FifoAddrPtr to FifoTxBaseAddr. The transceiver is put into STDBY mode.
-        :param payload: Payload to write (list)
+        :param payload: Payload to write (bytes, bytearray, memoryview or list of ints)
         :return:    Written payload
         """
         payload_size = len(payload)
         self.set_payload_length(payload_size)
         
         self.set_mode(MODE.STDBY)
+        if self.fhss is not None:
+            self.fhss.rewind()
         base_addr = self.get_fifo_tx_base_addr()
         self.set_fifo_addr_ptr(base_addr)
-        return self.spi.xfer([REG.LORA.FIFO | 0x80] + payload)[1:]
+        self._write_fifo(payload)
+        return payload
 
+    @locked
     def reset_ptr_rx(self):
         """ Get FIFO ready for RX: Set FifoAddrPtr to FifoRxBaseAddr. The transceiver is put into STDBY mode. """
         self.set_mode(MODE.STDBY)
+        if self.fhss is not None:
+            self.fhss.rewind()
         base_addr = self.get_fifo_rx_base_addr()
         self.set_fifo_addr_ptr(base_addr)
 
@@ -304,22 +530,135 @@ class GenericLoRa(object):
         :return: Payload
         :rtype: list[int]
         """
+        payload = self.read_payload_bytes(nocheck)
+        return None if payload is None else list(payload)
+
+    @locked
+    def read_payload_bytes(self, nocheck=False):
+        """ Read the payload from FIFO, like read_payload(), but as bytes.
+        :param nocheck: If True then check rx_is_good()
+        :return: Payload
+        :rtype: bytes
+        """
+        if not nocheck and not self.rx_is_good():
+            return None
+        rx_nb_bytes = self._seek_rx_payload()
+        return self._read_fifo(rx_nb_bytes)
+
+    @locked
+    def read_payload_into(self, buf, nocheck=False):
+        """ Read the payload from FIFO into a buffer the caller owns, so no new buffer is needed for each packet.
+        :param buf: Writable buffer (bytearray, memoryview, array.array('B'), ...) of at least 255 bytes, or at least
+        as long as the payload
+        :param nocheck: If True then check rx_is_good()
+        :return: Number of payload bytes stored at the start of buf, or None if rx_is_good() failed
+        :rtype: int
+        """
         if not nocheck and not self.rx_is_good():
             return None
+        rx_nb_bytes = self._seek_rx_payload()
+        # A bytearray takes slice assignment as it is; other buffers need a byte view, which is one more allocation
+        view = buf if type(buf) is bytearray else memoryview(buf).cast('B')
+        if len(view) < rx_nb_bytes:
+            raise RuntimeError("Buffer of %d bytes is too small for a %d byte payload" % (len(view), rx_nb_bytes))
+        self._read_fifo(rx_nb_bytes, view)
+        return rx_nb_bytes
+
+    @locked
+    def fetch_packet(self, timestamp=None):
+        """ Read the last received packet with its metadata and clear its IRQ flags, in four SPI transfers.
+
+        FIFO_RX_CURR_ADDR through RSSI_VALUE (0x10 .. 0x1B) are contiguous, so the IRQ flags, payload length, FIFO
+        address, SNR and RSSI all come in one burst read. Then FifoAddrPtr is set, the payload is read in one FIFO
+        burst, and RxDone, PayloadCrcError and ValidHeader are cleared in one write, which handle_irq_flags() then
+        does not repeat, so a packet that comes in meanwhile is kept. The transceiver mode is not
+        changed, so in RXCONT mode the modem keeps receiving. With an FHSS engine started, it is tuned back to the
+        first channel for the next packet, in one more transfer.
+        :param timestamp: time.monotonic() value of the RxDone IRQ, if known. Defaults to now.
+        :return: The packet, or None if RxDone is not set
+        :rtype: RxPacket
+        """
+        r = self.get_registers(REG.LORA.FIFO_RX_CURR_ADDR, REG.LORA.RSSI_VALUE - REG.LORA.FIFO_RX_CURR_ADDR + 1)
+        irq_flags = r[REG.LORA.IRQ_FLAGS - REG.LORA.FIFO_RX_CURR_ADDR]
+        if not irq_flags & 1 << MASK.IRQ_FLAGS.RxDone:
+            return None
+        self.set_fifo_addr_ptr(r[0])
+        payload = self._read_fifo(r[REG.LORA.RX_NB_BYTES - REG.LORA.FIFO_RX_CURR_ADDR])
+        rx_flags = 1 << MASK.IRQ_FLAGS.RxDone | 1 << MASK.IRQ_FLAGS.PayloadCrcError | 1 << MASK.IRQ_FLAGS.ValidHeader
+        self.set_register(REG.LORA.IRQ_FLAGS, irq_flags & rx_flags)
+        self._rx_flags_cleared = True
+        if self.fhss is not None:
+            self.fhss.rewind()
+        return RxPacket(payload,
+                        decode_rssi(r[REG.LORA.PKT_RSSI_VALUE - REG.LORA.FIFO_RX_CURR_ADDR], self.low_band),
+                        decode_snr(r[REG.LORA.PKT_SNR_VALUE - REG.LORA.FIFO_RX_CURR_ADDR]),
+                        not irq_flags & 1 << MASK.IRQ_FLAGS.PayloadCrcError,
+                        time.monotonic() if timestamp is None else timestamp)
+
+    def _seek_rx_payload(self):
+        """ Point FifoAddrPtr at the last received packet.
+        :return: Payload length
+        :rtype: int
+        """
         rx_nb_bytes = self.get_rx_nb_bytes()
         fifo_rx_current_addr = self.get_fifo_rx_current_addr()
         self.set_fifo_addr_ptr(fifo_rx_current_addr)
-        payload = self.spi.xfer([REG.LORA.FIFO] + [0] * rx_nb_bytes)[1:]
-        return payload
+        return rx_nb_bytes
+
+    def _write_fifo(self, payload):
+        """ Write a payload to the FIFO in one transfer. Uses spidev's writebytes2(), which takes the buffer as it is,
+        if the SPI connection has it.
+        :param payload: bytes, bytearray, memoryview or list of ints
+        """
+        with self.lock:
+            if self._batch:
+                self._flush_batch()
+            count = len(payload)
+            assert count <= MAX_PAYLOAD_LENGTH
+            self._fifo_buffer[0] = REG.LORA.FIFO | 0x80
+            self._fifo_buffer[1:count + 1] = payload
+            request = self._fifo_view[:count + 1]
+            writebytes2 = getattr(self.spi, 'writebytes2', None)
+            if writebytes2 is not None:
+                writebytes2(request)
+            else:
+                self.spi.xfer(list(request))
+
+    def _read_fifo(self, count, into=None):
+        """ Read count bytes from the FIFO in one transfer. Uses spidev's xfer3(), which takes the request buffer as it
+        is, if the SPI connection has it.
+        :param into: Writable buffer of at least count bytes to store the bytes in, instead of returning new bytes
+        :return: The bytes read, or None if into was given
+        :rtype: bytes
+        """
+        with self.lock:
+            if self._batch:
+                self._flush_batch()
+            self._fifo_buffer[0] = REG.LORA.FIFO
+            # What we clock out after the address byte doesn't matter, so the request is whatever is in the buffer
+            request = self._fifo_view[:count + 1]
+            xfer3 = getattr(self.spi, 'xfer3', None)
+            if xfer3 is not None:
+                result = xfer3(request)
+            else:
+                result = self.spi.xfer(list(request))
+            # Skip the byte clocked in with the address in one copy. A memoryview slice copies nothing, but the view
+            # and its managed buffer take more memory than copying a full FIFO.
+            if into is not None and isinstance(result, (bytes, bytearray)):
+                into[:count] = result[1:]
+                return None
+            # xfer3() gives a tuple and xfer() a list, and bytes() walks either in one pass
+            data = bytes(islice(result, 1, None))
+            if into is None:
+                return data
+            into[:count] = data
 
     def get_freq(self):
         """ Get the frequency (MHz)
         :return:    Frequency in MHz
         :rtype:     float
         """
-        msb, mid, lsb = self.spi.xfer([REG.LORA.FR_MSB, 0, 0, 0])[1:]
-        f = lsb + 256*(mid + 256*msb)
-        return f / 16384.
+        return decode_freq(*self.get_registers(REG.LORA.FR_MSB, 3))
 
     def set_freq(self, f):
         """ Set the frequency (MHz)
@@ -329,28 +668,68 @@ class GenericLoRa(object):
         :rtype: list[int]
         """
         assert self.mode == MODE.SLEEP or self.mode == MODE.STDBY or self.mode == MODE.FSK_STDBY
-        i = int(f * 16384.)    # choose floor
-        msb = i // 65536
-        i -= msb * 65536
-        mid = i // 256
-        i -= mid * 256
-        lsb = i
-        return self.spi.xfer([REG.LORA.FR_MSB | 0x80, msb, mid, lsb])
+        frf = encode_freq(f)
+        self.set_registers(REG.LORA.FR_MSB, frf)
+        return frf
+
+    @locked
+    def tune(self, channel, mode=None, plan=None):
+        """ Switch to a channel of a channels.ChannelPlan, whose frequency register values are worked out already.
+        This is one burst write, plus a switch to STDBY first if the transceiver is not in SLEEP or STDBY mode, and a
+        switch to mode afterwards if given.
+        :param channel: Channel number
+        :param mode: Mode to switch to once tuned, e.g. MODE.RXCONT
+        :param plan: The ChannelPlan. Defaults to self.channel_plan.
+        """
+        plan = self.channel_plan if plan is None else plan
+        if self.mode != MODE.SLEEP and self.mode != MODE.STDBY and self.mode != MODE.FSK_STDBY:
+            self.set_mode(MODE.STDBY)
+        self.set_registers(REG.LORA.FR_MSB, plan.registers[channel])
+        if mode is not None:
+            self.set_mode(mode)
+
+    def get_channel(self, plan=None):
+        """ Get the channel of a channels.ChannelPlan the modem is tuned to, without converting the frequency.
+        :param plan: The ChannelPlan. Defaults to self.channel_plan.
+        :return: Channel number, or None if the frequency is not in the plan
+        :rtype: int
+        """
+        plan = self.channel_plan if plan is None else plan
+        return plan.channel(self.get_registers(REG.LORA.FR_MSB, 3))
+
+    def get_airtime_params(self):
+        """ Read the settings that decide how long a packet is on the air, in two bursts, or from the register cache.
+        :rtype: airtime.AirtimeParams
+        """
+        return AirtimeParams.from_registers(self._get_airtime_registers())
+
+    @locked
+    def _get_airtime_registers(self):
+        """ Read the registers in AirtimeParams.REGISTER_RUNS.
+        :return: Register values by address
+        :rtype: dict
+        """
+        registers = {}
+        for address, count in AirtimeParams.REGISTER_RUNS:
+            registers.update(enumerate(self.get_registers(address, count), address))
+        return registers
+
+    def time_on_air(self, payload_length=None):
+        """ Compute how long a packet takes to send with the current settings.
+        :param payload_length: Payload length in bytes. Defaults to the PAYLOAD_LENGTH register, i.e. the length of the
+        packet write_payload() last set up.
+        :return: Time on air in seconds
+        :rtype: float
+        """
+        registers = self._get_airtime_registers()
+        if payload_length is None:
+            payload_length = registers[REG.LORA.PAYLOAD_LENGTH]
+        return AirtimeParams.from_registers(registers).time_on_air(payload_length)
 
     def get_pa_config(self, convert_dBm=False):
-        v = self.spi.xfer([REG.LORA.PA_CONFIG, 0])[1]
-        pa_select    = v >> 7
-        max_power    = v >> 4 & 0b111
-        output_power = v & 0b1111
-        if convert_dBm:
-            max_power = max_power * .6 + 10.8
-            output_power = max_power - (15 - output_power)
-        return dict(
-                pa_select    = pa_select,
-                max_power    = max_power,
-                output_power = output_power
-            )
+        return decode_pa_config(self.get_register(REG.LORA.PA_CONFIG), convert_dBm)
 
+    @locked
     def set_pa_config(self, pa_select=None, max_power=None, output_power=None):
         """ Configure the PA
         :param pa_select: Selects PA output pin, 0->RFO, 1->PA_BOOST
@@ -363,7 +742,7 @@ class GenericLoRa(object):
         current = self.get_pa_config()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['pa_select'] << 7) | (loc['max_power'] << 4) | (loc['output_power'])
-        return self.spi.xfer([REG.LORA.PA_CONFIG | 0x80, val])[1]
+        return self.set_register(REG.LORA.PA_CONFIG, val)
 
     @getter(REG.LORA.PA_RAMP)
     def get_pa_ramp(self, val):
@@ -374,39 +753,19 @@ class GenericLoRa(object):
         return val & 0b1111
 
     def get_ocp(self, convert_mA=False):
-        v = self.spi.xfer([REG.LORA.OCP, 0])[1]
-        ocp_on = v >> 5 & 0x01
-        ocp_trim = v & 0b11111
-        if convert_mA:
-            if ocp_trim <= 15:
-                ocp_trim = 45. + 5. * ocp_trim
-            elif ocp_trim <= 27:
-                ocp_trim = -30. + 10. * ocp_trim
-            else:
-                assert ocp_trim <= 27
-        return dict(
-                ocp_on   = ocp_on,
-                ocp_trim = ocp_trim
-                )
+        return decode_ocp(self.get_register(REG.LORA.OCP), convert_mA)
 
+    @locked
     def set_ocp_trim(self, I_mA):
         assert(I_mA >= 45 and I_mA <= 240)
-        ocp_on = self.spi.xfer([REG.LORA.OCP, 0])[1] >> 5 & 0x01
-        if I_mA <= 120:
-            v = int(round((I_mA-45.)/5.))
-        else:
-            v = int(round((I_mA+30.)/10.))
-        v = set_bit(v, 5, ocp_on)
-        return self.spi.xfer([REG.LORA.OCP | 0x80, v])[1]
+        ocp_on = self.get_register(REG.LORA.OCP) >> 5 & 0x01
+        v = set_bit(encode_ocp_trim(I_mA), 5, ocp_on)
+        return self.set_register(REG.LORA.OCP, v)
 
     def get_lna(self):
-        v = self.spi.xfer([REG.LORA.LNA, 0])[1]
-        return dict(
-                lna_gain     = v >> 5,
-                lna_boost_lf = v >> 3 & 0b11,
-                lna_boost_hf = v & 0b11
-            )
+        return decode_lna(self.get_register(REG.LORA.LNA))
 
+    @locked
     def set_lna(self, lna_gain=None, lna_boost_lf=None, lna_boost_hf=None):
         assert lna_boost_hf is None or lna_boost_hf == 0b00 or lna_boost_hf == 0b11
         self.set_mode(MODE.STDBY)
@@ -417,7 +776,7 @@ class GenericLoRa(object):
         current = self.get_lna()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['lna_gain'] << 5) | (loc['lna_boost_lf'] << 3) | (loc['lna_boost_hf'])
-        retval = self.spi.xfer([REG.LORA.LNA | 0x80, val])[1]
+        retval = self.set_register(REG.LORA.LNA, val)
         if lna_gain is not None:
             # agc_auto_on must track lna_gain: GAIN=NOT_USED -> agc_auto=ON, otherwise =OFF
             self.set_agc_auto_on(lna_gain == GAIN.NOT_USED)
@@ -427,77 +786,57 @@ class GenericLoRa(object):
         self.set_lna(lna_gain=lna_gain)
 
     def get_fifo_addr_ptr(self):
-        return self.spi.xfer([REG.LORA.FIFO_ADDR_PTR, 0])[1]
+        return self.get_register(REG.LORA.FIFO_ADDR_PTR)
 
     def set_fifo_addr_ptr(self, ptr):
-        return self.spi.xfer([REG.LORA.FIFO_ADDR_PTR | 0x80, ptr])[1]
+        return self.set_register(REG.LORA.FIFO_ADDR_PTR, ptr)
 
     def get_fifo_tx_base_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_TX_BASE_ADDR, 0])[1]
+        return self.get_register(REG.LORA.FIFO_TX_BASE_ADDR)
 
     def set_fifo_tx_base_addr(self, ptr):
-        return self.spi.xfer([REG.LORA.FIFO_TX_BASE_ADDR | 0x80, ptr])[1]
+        return self.set_register(REG.LORA.FIFO_TX_BASE_ADDR, ptr)
 
     def get_fifo_rx_base_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_RX_BASE_ADDR, 0])[1]
+        return self.get_register(REG.LORA.FIFO_RX_BASE_ADDR)
 
     def set_fifo_rx_base_addr(self, ptr):
-        return self.spi.xfer([REG.LORA.FIFO_RX_BASE_ADDR | 0x80, ptr])[1]
+        return self.set_register(REG.LORA.FIFO_RX_BASE_ADDR, ptr)
 
     def get_fifo_rx_current_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_RX_CURR_ADDR, 0])[1]
+        return self.get_register(REG.LORA.FIFO_RX_CURR_ADDR)
 
     def get_fifo_rx_byte_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_RX_BYTE_ADDR, 0])[1]
+        return self.get_register(REG.LORA.FIFO_RX_BYTE_ADDR)
 
     def get_irq_flags_mask(self):
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK, 0])[1]
-        return dict(
-                rx_timeout     = v >> 7 & 0x01,
-                rx_done        = v >> 6 & 0x01,
-                crc_error      = v >> 5 & 0x01,
-                valid_header   = v >> 4 & 0x01,
-                tx_done        = v >> 3 & 0x01,
-                cad_done       = v >> 2 & 0x01,
-                fhss_change_ch = v >> 1 & 0x01,
-                cad_detected   = v >> 0 & 0x01,
-            )
+        return decode_irq_flags(self.get_register(REG.LORA.IRQ_FLAGS_MASK))
 
     def set_irq_flags_mask(self,
                            rx_timeout=None, rx_done=None, crc_error=None, valid_header=None, tx_done=None,
                            cad_done=None, fhss_change_ch=None, cad_detected=None):
         loc = locals()
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK, 0])[1]
+        v = self.get_register(REG.LORA.IRQ_FLAGS_MASK)
         for i, s in enumerate(['cad_detected', 'fhss_change_ch', 'cad_done', 'tx_done', 'valid_header',
                                'crc_error', 'rx_done', 'rx_timeout']):
             this_bit = locals()[s]
             if this_bit is not None:
                 v = set_bit(v, i, this_bit)
-        return self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK | 0x80, v])[1]
+        return self.set_register(REG.LORA.IRQ_FLAGS_MASK, v)
 
     def get_irq_flags(self):
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS, 0])[1]
-        return dict(
-                rx_timeout     = v >> 7 & 0x01,
-                rx_done        = v >> 6 & 0x01,
-                crc_error      = v >> 5 & 0x01,
-                valid_header   = v >> 4 & 0x01,
-                tx_done        = v >> 3 & 0x01,
-                cad_done       = v >> 2 & 0x01,
-                fhss_change_ch = v >> 1 & 0x01,
-                cad_detected   = v >> 0 & 0x01,
-            )
+        return decode_irq_flags(self.get_register(REG.LORA.IRQ_FLAGS))
 
     def set_irq_flags(self,
                       rx_timeout=None, rx_done=None, crc_error=None, valid_header=None, tx_done=None,
                       cad_done=None, fhss_change_ch=None, cad_detected=None):
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS, 0])[1]
+        v = self.get_register(REG.LORA.IRQ_FLAGS)
         for i, s in enumerate(['cad_detected', 'fhss_change_ch', 'cad_done', 'tx_done', 'valid_header',
                                'crc_error', 'rx_done', 'rx_timeout']):
             this_bit = locals()[s]
             if this_bit is not None:
                 v = set_bit(v, i, this_bit)
-        return self.spi.xfer([REG.LORA.IRQ_FLAGS | 0x80, v])[1]
+        return self.set_register(REG.LORA.IRQ_FLAGS, v)
 
     def clear_irq_flags(self,
                         RxTimeout=None, RxDone=None, PayloadCrcError=None, 
@@ -510,65 +849,45 @@ class GenericLoRa(object):
             this_bit = locals()[s]
             if this_bit is not None:
                 v = set_bit(v, eval('MASK.IRQ_FLAGS.' + s), this_bit)
-        return self.spi.xfer([REG.LORA.IRQ_FLAGS | 0x80, v])[1]
+        return self.set_register(REG.LORA.IRQ_FLAGS, v)
 
 
     def get_rx_nb_bytes(self):
-        return self.spi.xfer([REG.LORA.RX_NB_BYTES, 0])[1]
+        return self.get_register(REG.LORA.RX_NB_BYTES)
 
     def get_rx_header_cnt(self):
-        msb, lsb = self.spi.xfer([REG.LORA.RX_HEADER_CNT_MSB, 0, 0])[1:]
+        msb, lsb = self.get_registers(REG.LORA.RX_HEADER_CNT_MSB, 2)
         return lsb + 256 * msb
 
     def get_rx_packet_cnt(self):
-        msb, lsb = self.spi.xfer([REG.LORA.RX_PACKET_CNT_MSB, 0, 0])[1:]
+        msb, lsb = self.get_registers(REG.LORA.RX_PACKET_CNT_MSB, 2)
         return lsb + 256 * msb
 
     def get_modem_status(self):
-        status = self.spi.xfer([REG.LORA.MODEM_STAT, 0])[1]
-        return dict(
-                rx_coding_rate    = status >> 5 & 0x03,
-                modem_clear       = status >> 4 & 0x01,
-                header_info_valid = status >> 3 & 0x01,
-                rx_ongoing        = status >> 2 & 0x01,
-                signal_sync       = status >> 1 & 0x01,
-                signal_detected   = status >> 0 & 0x01
-            )
+        return decode_modem_status(self.get_register(REG.LORA.MODEM_STAT))
 
     def get_pkt_snr_value(self):
-        v = self.spi.xfer([REG.LORA.PKT_SNR_VALUE, 0])[1]
-        return (float(v-256) if v > 127 else float(v)) / 4.
+        return decode_snr(self.get_register(REG.LORA.PKT_SNR_VALUE))
 
     def get_pkt_rssi_value(self):
-        v = self.spi.xfer([REG.LORA.PKT_RSSI_VALUE, 0])[1]
-        return v - (164 if self.low_band else 157)     # See datasheet 5.5.5. p. 87
+        return decode_rssi(self.get_register(REG.LORA.PKT_RSSI_VALUE), self.low_band)
 
     def get_rssi_value(self):
-        v = self.spi.xfer([REG.LORA.RSSI_VALUE, 0])[1]
-        return v - (164 if self.low_band else 157)     # See datasheet 5.5.5. p. 87
+        return decode_rssi(self.get_register(REG.LORA.RSSI_VALUE), self.low_band)
 
     def get_hop_channel(self):
-        v = self.spi.xfer([REG.LORA.HOP_CHANNEL, 0])[1]
-        return dict(
-                pll_timeout          = v >> 7,
-                crc_on_payload       = v >> 6 & 0x01,
-                fhss_present_channel = v >> 5 & 0b111111
-            )
+        return decode_hop_channel(self.get_register(REG.LORA.HOP_CHANNEL))
 
     def get_modem_config_1(self):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_1, 0])[1]
-        return dict(
-                bw = val >> 4 & 0x0F,
-                coding_rate = val >> 1 & 0x07,
-                implicit_header_mode = val & 0x01
-            )
+        return decode_modem_config_1(self.get_register(REG.LORA.MODEM_CONFIG_1))
         
+    @locked
     def set_modem_config_1(self, bw=None, coding_rate=None, implicit_header_mode=None):
         loc = locals()
         current = self.get_modem_config_1()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = loc['implicit_header_mode'] | (loc['coding_rate'] << 1) | (loc['bw'] << 4)
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_1 | 0x80, val])[1]
+        return self.set_register(REG.LORA.MODEM_CONFIG_1, val)
 
     def set_bw(self, bw):
         """ Set the bandwidth 0=7.8kHz ... 9=500kHz
@@ -588,23 +907,16 @@ class GenericLoRa(object):
         self.set_modem_config_1(implicit_header_mode=implicit_header_mode)
         
     def get_modem_config_2(self, include_symb_timout_lsb=False):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_2, 0])[1]
-        d = dict(
-                spreading_factor = val >> 4 & 0x0F,
-                tx_cont_mode = val >> 3 & 0x01,
-                rx_crc = val >> 2 & 0x01,
-            )
-        if include_symb_timout_lsb:
-            d['symb_timout_lsb'] = val & 0x03
-        return d
+        return decode_modem_config_2(self.get_register(REG.LORA.MODEM_CONFIG_2), include_symb_timout_lsb)
         
+    @locked
     def set_modem_config_2(self, spreading_factor=None, tx_cont_mode=None, rx_crc=None):
         loc = locals()
         # RegModemConfig2 contains the SymbTimout MSB bits. We tack the back on when writing this register.
         current = self.get_modem_config_2(include_symb_timout_lsb=True)
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['spreading_factor'] << 4) | (loc['tx_cont_mode'] << 3) | (loc['rx_crc'] << 2) | current['symb_timout_lsb']
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_2 | 0x80, val])[1]
+        return self.set_register(REG.LORA.MODEM_CONFIG_2, val)
 
     def set_spreading_factor(self, spreading_factor):
         self.set_modem_config_2(spreading_factor=spreading_factor)
@@ -613,18 +925,15 @@ class GenericLoRa(object):
         self.set_modem_config_2(rx_crc=rx_crc)
 
     def get_modem_config_3(self):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_3, 0])[1]
-        return dict(
-                low_data_rate_optim = val >> 3 & 0x01,
-                agc_auto_on = val >> 2 & 0x01
-            )
+        return decode_modem_config_3(self.get_register(REG.LORA.MODEM_CONFIG_3))
 
+    @locked
     def set_modem_config_3(self, low_data_rate_optim=None, agc_auto_on=None):
         loc = locals()
         current = self.get_modem_config_3()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['low_data_rate_optim'] << 3) | (loc['agc_auto_on'] << 2)
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_3 | 0x80, val])[1]
+        return self.set_register(REG.LORA.MODEM_CONFIG_3, val)
 
     @setter(REG.LORA.INVERT_IQ)
     def set_invert_iq(self, invert):
@@ -648,34 +957,34 @@ class GenericLoRa(object):
         self.set_modem_config_3(agc_auto_on=agc_auto_on)
 
     def get_low_data_rate_optim(self):
-        return self.set_modem_config_3()['low_data_rate_optim']
+        return self.get_modem_config_3()['low_data_rate_optim']
 
     def set_low_data_rate_optim(self, low_data_rate_optim):
         self.set_modem_config_3(low_data_rate_optim=low_data_rate_optim)
 
     def get_symb_timeout(self):
         SYMB_TIMEOUT_MSB = REG.LORA.MODEM_CONFIG_2
-        msb, lsb = self.spi.xfer([SYMB_TIMEOUT_MSB, 0, 0])[1:]    # the MSB bits are stored in REG.LORA.MODEM_CONFIG_2
-        msb = msb & 0b11
-        return lsb + 256 * msb
+        msb, lsb = self.get_registers(SYMB_TIMEOUT_MSB, 2)    # the MSB bits are stored in REG.LORA.MODEM_CONFIG_2
+        return decode_symb_timeout(msb, lsb)
 
+    @locked
     def set_symb_timeout(self, timeout):
-        bkup_reg_modem_config_2 = self.spi.xfer([REG.LORA.MODEM_CONFIG_2, 0])[1]
+        bkup_reg_modem_config_2 = self.get_register(REG.LORA.MODEM_CONFIG_2)
         msb = timeout >> 8 & 0b11    # bits 8-9
         lsb = timeout - 256 * msb    # bits 0-7
         reg_modem_config_2 = bkup_reg_modem_config_2 & 0xFC | msb    # bits 2-7 of bkup_reg_modem_config_2 ORed with the two msb bits
-        old_msb = self.spi.xfer([REG.LORA.MODEM_CONFIG_2  | 0x80, reg_modem_config_2])[1] & 0x03
-        old_lsb = self.spi.xfer([REG.LORA.SYMB_TIMEOUT_LSB | 0x80, lsb])[1]
+        old_msb = self.set_register(REG.LORA.MODEM_CONFIG_2, reg_modem_config_2) & 0x03
+        old_lsb = self.set_register(REG.LORA.SYMB_TIMEOUT_LSB, lsb)
         return old_lsb + 256 * old_msb
 
     def get_preamble(self):
-        msb, lsb = self.spi.xfer([REG.LORA.PREAMBLE_MSB, 0, 0])[1:]
+        msb, lsb = self.get_registers(REG.LORA.PREAMBLE_MSB, 2)
         return lsb + 256 * msb
 
     def set_preamble(self, preamble):
         msb = preamble >> 8
         lsb = preamble - msb * 256
-        old_msb, old_lsb = self.spi.xfer([REG.LORA.PREAMBLE_MSB | 0x80, msb, lsb])[1:]
+        old_msb, old_lsb = self.set_registers(REG.LORA.PREAMBLE_MSB, [msb, lsb])
         return old_lsb + 256 * old_msb
         
     @getter(REG.LORA.PAYLOAD_LENGTH)
@@ -703,10 +1012,7 @@ class GenericLoRa(object):
         return hop_period
 
     def get_fei(self):
-        msb, mid, lsb = self.spi.xfer([REG.LORA.FEI_MSB, 0, 0, 0])[1:]
-        msb &= 0x0F
-        freq_error = lsb + 256 * (mid + 256 * msb)
-        return freq_error
+        return decode_fei(*self.get_registers(REG.LORA.FEI_MSB, 3))
 
     @getter(REG.LORA.DETECT_OPTIMIZE)
     def get_detect_optimize(self, val):
@@ -758,8 +1064,7 @@ class GenericLoRa(object):
         :return: Value of the mapping list
         :rtype: list[int]
         """
-        self.dio_mapping = [mapping>>6 & 0x03, mapping>>4 & 0x03, mapping>>2 & 0x03, mapping>>0 & 0x03] \
-                           + self.dio_mapping[4:6]
+        self.dio_mapping = decode_dio_mapping(mapping, 0)[0:4] + self.dio_mapping[4:6]
         return self.dio_mapping
 
     @setter(REG.LORA.DIO_MAPPING_1)
@@ -770,8 +1075,7 @@ class GenericLoRa(object):
         :return: New value of the register
         :rtype: int
         """
-        self.dio_mapping = [mapping>>6 & 0x03, mapping>>4 & 0x03, mapping>>2 & 0x03, mapping>>0 & 0x03] \
-                           + self.dio_mapping[4:6]
+        self.dio_mapping = decode_dio_mapping(mapping, 0)[0:4] + self.dio_mapping[4:6]
         return mapping
 
     @getter(REG.LORA.DIO_MAPPING_2)
@@ -782,7 +1086,7 @@ class GenericLoRa(object):
         :return: Value of the mapping list
         :rtype: list[int]
         """
-        self.dio_mapping = self.dio_mapping[0:4] + [mapping>>6 & 0x03, mapping>>4 & 0x03]
+        self.dio_mapping = self.dio_mapping[0:4] + decode_dio_mapping(0, mapping)[4:6]
         return self.dio_mapping
 
     @setter(REG.LORA.DIO_MAPPING_2)
@@ -794,7 +1098,7 @@ class GenericLoRa(object):
         :rtype: int
         """
         assert mapping & 0b00001110 == 0
-        self.dio_mapping = self.dio_mapping[0:4] + [mapping>>6 & 0x03, mapping>>4 & 0x03]
+        self.dio_mapping = self.dio_mapping[0:4] + decode_dio_mapping(0, mapping)[4:6]
         return mapping
 
     def get_dio_mapping(self):
@@ -805,6 +1109,7 @@ class GenericLoRa(object):
         self.get_dio_mapping_1()
         return self.get_dio_mapping_2()
 
+    @locked
     def set_dio_mapping(self, mapping):
         """ Utility function that returns the list of current DIO mappings. Object variable dio_mapping will be set.
         :param mapping: DIO mapping list
@@ -835,7 +1140,7 @@ class GenericLoRa(object):
         :return: TCXO or XTAL input setting
         :type: int (0 or 1)
         """
-        return tcxo & 0b00010000
+        return decode_tcxo(tcxo)
 
     @setter(REG.LORA.TCXO)
     def set_tcxo(self, tcxo):
@@ -855,13 +1160,7 @@ class GenericLoRa(object):
         :return: True/False if +20dBm option on PA_BOOST on/off
         :rtype: bool
         """
-        pa_dac &= 0x07      # only bits 0-2
-        if pa_dac == 0x04:
-            return False
-        elif pa_dac == 0x07:
-            return True
-        else:
-            raise RuntimeError("Bad PA_DAC value %s" % hex(pa_dac))
+        return decode_pa_dac(pa_dac)
 
     @setter(REG.LORA.PA_DAC)
     def set_pa_dac(self, pa_dac):
@@ -874,6 +1173,7 @@ class GenericLoRa(object):
         """
         return 0x87 if pa_dac else 0x84
 
+    @locked
     def rx_chain_calibration(self, freq=868.):
         """ Run the image calibration (see Semtech documentation section 4.2.3.8)
         :param freq: Frequency for the HF calibration
@@ -904,105 +1204,233 @@ class GenericLoRa(object):
         self.set_register(REG.LORA.PA_CONFIG, pa_config_bkup)
         self.set_freq(freq_bkup)
 
+    @locked
+    def apply_profile(self, profile, verify=False):
+        """ Apply a profiles.RadioProfile, sending its register image in as few burst writes as possible.
+        The transceiver is put into STDBY mode, unless it is in SLEEP mode.
+        :param profile: The RadioProfile to apply
+        :param verify: If True, read the registers back from the modem afterwards
+        :return: None
+        """
+        if self.mode != MODE.SLEEP:
+            self.set_mode(MODE.STDBY)
+        with self.batch():
+            for register_address, values in profile.bursts:
+                self.set_registers(register_address, values)
+        if verify:
+            for register_address, values in profile.bursts:
+                got_values = self.get_registers(register_address, len(values), nocache=True)
+                for reg_number, stored, got in zip(range(register_address, register_address + len(values)),
+                                                   values, got_values):
+                    if stored != got:
+                        raise RuntimeError("Failed to apply register %02X: stored %02X but got %02X" %
+                                           (reg_number, stored, got))
+
     def dump_registers(self):
         """ Returns a list of [reg_addr, reg_name, reg_value] tuples. Chip is put into mode SLEEP.
         :return: List of [reg_addr, reg_name, reg_value] tuples
         :rtype: list[tuple]
         """
         self.set_mode(MODE.SLEEP)
-        values = self.get_all_registers()
-        skip_set = set([REG.LORA.FIFO])
-        result_list = []
-        for i, s in REG.LORA.lookup.items():
-            if i in skip_set:
-                continue
-            if i < len(values):
-                v = values[i]
-            else:
-                v = None
-            result_list.append((i, s, v))
-        return result_list
+        return dump_registers(self.snapshot().registers)
 
     def get_register(self, register_address):
-        return self.spi.xfer([register_address & 0x7F, 0])[1]
+        return self.get_registers(register_address, 1)[0]
 
     def set_register(self, register_address, val):
-        return self.spi.xfer([register_address | 0x80, val])[1]
-
+        return self.set_registers(register_address, [val])[0]
+
+    def get_registers(self, register_address, count, nocache=False):
+        """ Read count consecutive registers in a single burst. Reading the FIFO reads count bytes from it.
+        Answered from the register cache instead, if it is enabled and holds all of the registers.
+        :param register_address: First register address
+        :param count: Number of registers to read
+        :param nocache: If True, always read from the modem, even if the values are cached
+        :return: List of register values
+        :rtype: list[int]
+        """
+        with self.lock:
+            register_address &= 0x7F
+            pending = self._batch
+            if pending and all(a in pending for a in range(register_address, register_address + count)):
+                return [pending[a] for a in range(register_address, register_address + count)]
+            cache = self.register_cache if self._lora_mode() else None
+            values = cache.read(register_address, count) if cache is not None and not nocache else None
+            if values is None:
+                values = self.spi.xfer([register_address] + [0] * count)[1:]
+                if cache is not None:
+                    cache.store(register_address, values)
+            if pending:
+                # Reads inside a batch see the writes it has collected so far
+                values = [pending.get(a, v) for a, v in enumerate(values, register_address)]
+            return values
+
+    def set_registers(self, register_address, values):
+        """ Write consecutive registers in a single burst. Writing the FIFO writes all the values to it.
+        If the register cache is enabled and already holds all the values, nothing is sent to the modem.
+        :param register_address: First register address
+        :param values: List of register values
+        :return: Previous register values
+        :rtype: list[int]
+        """
+        with self.lock:
+            register_address &= 0x7F
+            values = list(values)
+            if self._batch is not None:
+                if self._lora_mode() and RegisterCache.cacheable(register_address, len(values)):
+                    self._batch.update(enumerate(values, register_address))
+                    return values
+                # Mode changes, FIFO access etc. must happen in order with the configuration writes before them
+                self._flush_batch()
+            cache = self.register_cache
+            if cache is not None and not self._lora_mode():
+                # The FSK register map differs from the LoRa one, so we can't know what we just did to the cache.
+                cache.invalidate(register_address, len(values))
+                cache = None
+            if cache is not None and not cache.write_needed(register_address, values):
+                return values
+            old_values = self.spi.xfer([register_address | 0x80] + values)[1:]
+            if cache is not None:
+                cache.store(register_address, values)
+            return old_values
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Context manager that collects configuration register writes and sends them all when it exits.
+
+        Writes are deduplicated, sorted by address and merged into as few burst transfers as possible. Reads inside
+        the batch see the collected writes. Writes to volatile registers such as OP_MODE or the FIFO, and any writes
+        while not in LoRa mode, first send everything collected so far and then go straight to the modem. Inside a
+        batch, setters return the new register values instead of the old ones. Batches may be nested; the outermost
+        one sends the writes. If the batch exits with an exception, the collected writes are discarded.
+
+            with lora.batch():
+                lora.set_freq(868.1)
+                lora.set_bw(BW.BW125)
+                lora.set_spreading_factor(7)
+        """
+        with self.lock:
+            self._batch_depth += 1
+            if self._batch is None:
+                self._batch = {}
+            completed = False
+            try:
+                yield self
+                completed = True
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    if completed:
+                        self._flush_batch()
+                    self._batch = None
+
+    def atomic(self):
+        """ Get a context manager that holds the lock, so that everything done in it happens without another
+        thread's SPI transfers or IRQ handlers getting in between. It may be nested, and IRQ handlers can use it too.
+        Don't wait for an IRQ from another thread inside it, since that thread needs the lock to handle it.
+
+            with lora.atomic():
+                lora.set_fifo_addr_ptr(lora.get_fifo_rx_current_addr())
+                payload = lora.read_payload_bytes(nocheck=True)
+
+        :return: The lock, a lock.InstrumentedLock whose stats() give its contention and hold times
+        """
+        return self.lock
+
+    def _flush_batch(self):
+        """ Send the writes collected by batch() in as few bursts as possible, and start collecting anew. If the SPI
+        connection has xfer_many(), like spidev_ioc.IocSpiDev, the bursts all go in one call. """
+        pending, self._batch = self._batch, None
+        cache = self.register_cache
+        if cache is not None:
+            pending = {a: v for a, v in pending.items() if cache.values[a] != v}
+        try:
+            runs = self._burst_runs(pending)
+            xfer_many = getattr(self.spi, 'xfer_many', None)
+            if xfer_many is not None and len(runs) > 1 and self._lora_mode():
+                if cache is not None:
+                    runs = [(a, values) for a, values in runs if cache.write_needed(a, values)]
+                xfer_many([[register_address | 0x80] + values for register_address, values in runs])
+                if cache is not None:
+                    for register_address, values in runs:
+                        cache.store(register_address, values)
+            else:
+                for register_address, values in runs:
+                    self.set_registers(register_address, values)
+        finally:
+            self._batch = {}
+
+    def _burst_runs(self, pending):
+        """ Group register writes into runs of consecutive addresses.
+        Short gaps between runs are filled in with cached register values, when the register cache knows them, since
+        a few more bytes in a burst are cheaper than another transfer.
+        :param pending: Dict from register address to value
+        :return: List of (register_address, values) tuples
+        :rtype: list[tuple]
+        """
+        runs = []
+        for address in sorted(pending):
+            if runs:
+                start, values = runs[-1]
+                gap = range(start + len(values), address)
+                if len(gap) == 0:
+                    values.append(pending[address])
+                    continue
+                if len(gap) <= self.BATCH_MAX_GAP and self.register_cache is not None and \
+                        all(self.register_cache.values[a] is not None for a in gap):
+                    values.extend(self.register_cache.values[a] for a in gap)
+                    values.append(pending[address])
+                    continue
+            runs.append((address, [pending[address]]))
+        return runs
+
+    @locked
     def get_all_registers(self):
+        if self._batch:
+            self._flush_batch()
         # Determine range to read
         first_register = REG.LORA.OP_MODE
         last_register = REG.LORA.PLL
         # read all registers into an array mirroring memory
         reg = [0]*first_register + self.spi.xfer([first_register]+[0]*(last_register - first_register + 1))[1:]
         self.mode = reg[1]
+        if self.register_cache is not None and self._lora_mode():
+            self.register_cache.seed(reg)
         return reg
 
+    @locked
+    def resync(self):
+        """ Re-read all registers in one burst and reseed the register cache from them.
+        Call this if something other than this object may have changed the modem registers, e.g. a reset.
+        :return: List of register values indexed by address
+        :rtype: list[int]
+        """
+        if self.register_cache is not None:
+            self.register_cache.clear()
+        self.backup_registers = self.get_all_registers()
+        return self.backup_registers
+
+    def _lora_mode(self):
+        """ Check if the modem is known to be in LoRa mode, where the register cache applies. """
+        return self.mode is not None and self.mode & 0x80 != 0
+
     def __del__(self):
         self.set_mode(MODE.SLEEP)
         if self.verbose:
             sys.stderr.write("MODE=SLEEP\n")
 
+    def snapshot(self):
+        """ Read all registers in a single SPI transfer and decode them.
+        The result can also be rendered with status.format_status(), like __str__ does.
+        :return: Decoded modem state
+        :rtype: status.LoRaStatus
+        """
+        return decode_status(self.get_all_registers(), self.low_band)
+
     def __str__(self):
         # don't use __str__ while in any mode other that SLEEP or STDBY
         assert(self.mode == MODE.SLEEP or self.mode == MODE.STDBY)
-
-        onoff = lambda i: 'ON' if i else 'OFF'
-        f = self.get_freq()
-        cfg1 = self.get_modem_config_1()
-        cfg2 = self.get_modem_config_2()
-        cfg3 = self.get_modem_config_3()
-        pa_config = self.get_pa_config(convert_dBm=True)
-        ocp = self.get_ocp(convert_mA=True)
-        lna = self.get_lna()
-        s =  "SX127x LoRa registers:\n"
-        s += " mode               %s\n" % MODE.lookup[self.get_mode()]
-        s += " freq               %f MHz\n" % f
-        s += " coding_rate        %s\n" % CODING_RATE.lookup[cfg1['coding_rate']]
-        s += " bw                 %s\n" % BW.lookup[cfg1['bw']]
-        s += " spreading_factor   %s chips/symb\n" % (1 << cfg2['spreading_factor'])
-        s += " implicit_hdr_mode  %s\n" % onoff(cfg1['implicit_header_mode'])
-        s += " rx_payload_crc     %s\n" % onoff(cfg2['rx_crc'])
-        s += " tx_cont_mode       %s\n" % onoff(cfg2['tx_cont_mode'])
-        s += " preamble           %d\n" % self.get_preamble()
-        s += " low_data_rate_opti %s\n" % onoff(cfg3['low_data_rate_optim'])
-        s += " agc_auto_on        %s\n" % onoff(cfg3['agc_auto_on'])
-        s += " symb_timeout       %s\n" % self.get_symb_timeout()
-        s += " freq_hop_period    %s\n" % self.get_hop_period()
-        s += " hop_channel        %s\n" % self.get_hop_channel()
-        s += " payload_length     %s\n" % self.get_payload_length()
-        s += " max_payload_length %s\n" % self.get_max_payload_length()
-        s += " irq_flags_mask     %s\n" % self.get_irq_flags_mask()
-        s += " irq_flags          %s\n" % self.get_irq_flags()
-        s += " rx_nb_byte         %d\n" % self.get_rx_nb_bytes()
-        s += " rx_header_cnt      %d\n" % self.get_rx_header_cnt()
-        s += " rx_packet_cnt      %d\n" % self.get_rx_packet_cnt()
-        s += " pkt_snr_value      %f\n" % self.get_pkt_snr_value()
-        s += " pkt_rssi_value     %d\n" % self.get_pkt_rssi_value()
-        s += " rssi_value         %d\n" % self.get_rssi_value()
-        s += " fei                %d\n" % self.get_fei()
-        s += " pa_select          %s\n" % PA_SELECT.lookup[pa_config['pa_select']]
-        s += " max_power          %f dBm\n" % pa_config['max_power']
-        s += " output_power       %f dBm\n" % pa_config['output_power']
-        s += " ocp                %s\n"     % onoff(ocp['ocp_on'])
-        s += " ocp_trim           %f mA\n"  % ocp['ocp_trim']
-        s += " lna_gain           %s\n" % GAIN.lookup[lna['lna_gain']]
-        s += " lna_boost_lf       %s\n" % bin(lna['lna_boost_lf'])
-        s += " lna_boost_hf       %s\n" % bin(lna['lna_boost_hf'])
-        s += " detect_optimize    %#02x\n" % self.get_detect_optimize()
-        s += " detection_thresh   %#02x\n" % self.get_detection_threshold()
-        s += " sync_word          %#02x\n" % self.get_sync_word()
-        s += " dio_mapping 0..5   %s\n" % self.get_dio_mapping()
-        s += " tcxo               %s\n" % ['XTAL', 'TCXO'][self.get_tcxo()]
-        s += " pa_dac             %s\n" % ['default', 'PA_BOOST'][self.get_pa_dac()]
-        s += " fifo_addr_ptr      %#02x\n" % self.get_fifo_addr_ptr()
-        s += " fifo_tx_base_addr  %#02x\n" % self.get_fifo_tx_base_addr()
-        s += " fifo_rx_base_addr  %#02x\n" % self.get_fifo_rx_base_addr()
-        s += " fifo_rx_curr_addr  %#02x\n" % self.get_fifo_rx_current_addr()
-        s += " fifo_rx_byte_addr  %#02x\n" % self.get_fifo_rx_byte_addr()
-        s += " status             %s\n" % self.get_modem_status()
-        s += " version            %#02x\n" % self.get_version()
-        return s
+        return format_status(self.snapshot())
         
 ############################################### Definition of the LoRa class ###########################################
 
@@ -1019,7 +1447,7 @@ class LoRa(GenericLoRa):
     handle_irq_flags() occasionally in order for interrupts to be handled. 
     """
     
-    def __init__(self, board=None, verbose=True, do_calibration=True, calibration_freq=868):
+    def __init__(self, board=None, verbose=True, do_calibration=True, calibration_freq=868, cache_registers=False):
         if board is False or board is True:
             # Someone is calling us expexcting verbose to be the first parameter.
             verbose = board
@@ -1038,5 +1466,5 @@ class LoRa(GenericLoRa):
         # Pass along the parameters we derived from the board definition 
         super(LoRa, self).__init__(spi_connection, low_band, add_events=add_events,
                                    verbose=verbose, do_calibration=do_calibration,
-                                   calibration_freq=calibration_freq)
+                                   calibration_freq=calibration_freq, cache_registers=cache_registers)
 
@@ -66,11 +66,12 @@ class LoRaArgumentParser(argparse.ArgumentParser):
         assert(args.bw is not None)
         assert(args.coding_rate is not None)
         assert(args.sf >=6 and args.sf <= 12)
-        # set the LoRa object
-        lora.set_freq(args.freq)
-        lora.set_preamble(args.preamble)
-        lora.set_spreading_factor(args.sf)
-        lora.set_bw(args.bw)
-        lora.set_coding_rate(args.coding_rate)
-        lora.set_ocp_trim(args.ocp)
+        # set the LoRa object, sending all the register writes together at the end
+        with lora.batch():
+            lora.set_freq(args.freq)
+            lora.set_preamble(args.preamble)
+            lora.set_spreading_factor(args.sf)
+            lora.set_bw(args.bw)
+            lora.set_coding_rate(args.coding_rate)
+            lora.set_ocp_trim(args.ocp)
         return args
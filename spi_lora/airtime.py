@@ -0,0 +1,235 @@
+""" LoRa time on air, for one packet or whole tables of payload lengths and settings, and duty cycle accounting. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import collections
+import math
+import time
+
+from .constants import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def symbol_time(spreading_factor=7, bw_hz=125000):
+    """ Compute how long one LoRa symbol lasts, 2^SF / BW.
+    :rtype: float
+    """
+    return (1 << spreading_factor) / float(bw_hz)
+
+
+def preamble_time(preamble=8, spreading_factor=7, bw_hz=125000):
+    """ Compute how long the preamble lasts: the programmed preamble symbols plus 4.25 for the sync word and SFD.
+    :rtype: float
+    """
+    return (preamble + 4.25) * symbol_time(spreading_factor, bw_hz)
+
+
+def payload_symbols(payload_length, spreading_factor=7, coding_rate=CODING_RATE.CR4_5, implicit_header_mode=False,
+                    rx_crc=True, low_data_rate_optim=False):
+    """ Compute the number of symbols after the preamble: header, payload and CRC, see datasheet 4.1.1.7.
+    :param coding_rate: CODING_RATE constant (1 for 4/5 .. 4 for 4/8)
+    :rtype: int
+    """
+    bits = 8 * payload_length - 4 * spreading_factor + 28 + 16 * bool(rx_crc) - 20 * bool(implicit_header_mode)
+    return 8 + max(int(math.ceil(bits / (4. * (spreading_factor - 2 * bool(low_data_rate_optim))))) *
+                   (coding_rate + 4), 0)
+
+
+def time_on_air(payload_length, spreading_factor=7, bw_hz=125000, coding_rate=CODING_RATE.CR4_5, preamble=8,
+                implicit_header_mode=False, rx_crc=True, low_data_rate_optim=False):
+    """ Compute how long a LoRa packet takes to send, see datasheet 4.1.1.7.
+    :param payload_length: Payload length in bytes
+    :param bw_hz: Bandwidth in Hz
+    :param coding_rate: CODING_RATE constant (1 for 4/5 .. 4 for 4/8)
+    :return: Time on air in seconds
+    :rtype: float
+    """
+    symbols = payload_symbols(payload_length, spreading_factor, coding_rate, implicit_header_mode, rx_crc,
+                              low_data_rate_optim)
+    return preamble_time(preamble, spreading_factor, bw_hz) + symbols * symbol_time(spreading_factor, bw_hz)
+
+
+class AirtimeParams(collections.namedtuple('AirtimeParams', ['spreading_factor', 'bw_hz', 'coding_rate', 'preamble',
+                                                             'implicit_header_mode', 'rx_crc',
+                                                             'low_data_rate_optim'])):
+    """ The modem settings that decide how long a packet is on the air. """
+
+    __slots__ = ()
+
+    # The registers these come from, as (first address, count) runs: MODEM_CONFIG_1 through PAYLOAD_LENGTH, then
+    # MODEM_CONFIG_3. FIFO_RX_BYTE_ADDR between them is volatile, so leaving it out lets the register cache answer both.
+    REGISTER_RUNS = ((REG.LORA.MODEM_CONFIG_1, REG.LORA.PAYLOAD_LENGTH - REG.LORA.MODEM_CONFIG_1 + 1),
+                     (REG.LORA.MODEM_CONFIG_3, 1))
+
+    @classmethod
+    def from_registers(cls, registers):
+        """ Decode the settings from register values.
+        :param registers: Anything indexed by register address, e.g. a full register image
+        :rtype: AirtimeParams
+        """
+        modem_config_1 = registers[REG.LORA.MODEM_CONFIG_1]
+        modem_config_2 = registers[REG.LORA.MODEM_CONFIG_2]
+        return cls(spreading_factor     = modem_config_2 >> 4,
+                   bw_hz                = BANDWIDTH_HZ[modem_config_1 >> 4],
+                   coding_rate          = modem_config_1 >> 1 & 0b111,
+                   preamble             = registers[REG.LORA.PREAMBLE_MSB] << 8 | registers[REG.LORA.PREAMBLE_LSB],
+                   implicit_header_mode = bool(modem_config_1 & 0x01),
+                   rx_crc               = bool(modem_config_2 >> 2 & 0x01),
+                   low_data_rate_optim  = bool(registers[REG.LORA.MODEM_CONFIG_3] >> 3 & 0x01))
+
+    def symbol_time(self):
+        return symbol_time(self.spreading_factor, self.bw_hz)
+
+    def time_on_air(self, payload_length):
+        return time_on_air(payload_length, *self)
+
+
+def time_on_air_table(payload_lengths, params):
+    """ Compute the time on air of every payload length under every group of settings.
+
+    With NumPy installed this is done in a few array operations and returns an
+    array, so that tables with thousands of entries are cheap. Without NumPy it
+    returns nested lists of the same values.
+    :param payload_lengths: Sequence of payload lengths in bytes
+    :param params: Sequence of AirtimeParams
+    :return: Times on air in seconds, one row per AirtimeParams and one column per payload length
+    :rtype: numpy.ndarray or list[list[float]]
+    """
+    if numpy is None:
+        return [[p.time_on_air(n) for n in payload_lengths] for p in params]
+    n = numpy.asarray(payload_lengths, dtype=float)[numpy.newaxis, :]
+    p = numpy.array(params, dtype=float).reshape(-1, len(AirtimeParams._fields))
+    sf, bw_hz, coding_rate, preamble, implicit_header_mode, rx_crc, low_data_rate_optim = \
+        [column[:, numpy.newaxis] for column in p.T]
+    t_sym = 2 ** sf / bw_hz
+    bits = 8 * n - 4 * sf + 28 + 16 * rx_crc - 20 * implicit_header_mode
+    symbols = 8 + numpy.maximum(numpy.ceil(bits / (4 * (sf - 2 * low_data_rate_optim))) * (coding_rate + 4), 0)
+    return (preamble + 4.25 + symbols) * t_sym
+
+
+class DutyCycleExceeded(RuntimeError):
+    """ Raised when a transmission would go over the duty cycle limit. """
+
+    def __init__(self, airtime, wait):
+        super(DutyCycleExceeded, self).__init__("%.3f s transmission exceeds the duty cycle; wait %.3f s" %
+                                                (airtime, wait))
+        self.airtime = airtime
+        self.wait = wait
+
+
+class DutyCycleLedger(object):
+    """
+    Keeps track of time on air over a sliding window, to stay within a duty
+    cycle limit such as the 1% per hour of most EU868 sub-bands.
+
+    A transmission counts against the window until the window has moved past
+    its end, which is slightly conservative for transmissions the window
+    start cuts through.
+
+    Set one as the duty_cycle of a GenericLoRa, and the driver records every
+    transmission in it and raises DutyCycleExceeded instead of starting one
+    that does not fit.
+    """
+
+    def __init__(self, duty_cycle=0.01, window=3600., clock=time.monotonic):
+        """
+        :param duty_cycle: Fraction of the window that may be spent transmitting
+        :param window: Window length in seconds
+        :param clock: Function giving the time in seconds
+        """
+        self.duty_cycle = duty_cycle
+        self.window = window
+        self.clock = clock
+        self.budget = duty_cycle * window
+        self.total = 0.                         # all time on air ever recorded
+        self.refused = 0
+        self._transmissions = collections.deque()   # (end time, time on air), oldest first
+        self._used = 0.
+
+    def _expire(self, now):
+        start = now - self.window
+        while self._transmissions and self._transmissions[0][0] <= start:
+            self._used -= self._transmissions.popleft()[1]
+        if not self._transmissions:
+            self._used = 0.
+
+    def used(self, now=None):
+        """ Get the time on air in the window ending now, in seconds. """
+        self._expire(self.clock() if now is None else now)
+        return self._used
+
+    def available(self, now=None):
+        """ Get the time on air left in the budget, in seconds. """
+        return self.budget - self.used(now)
+
+    def wait_time(self, airtime, now=None):
+        """ Get how long to wait before a transmission of airtime seconds fits in the budget.
+        :return: Seconds, 0 if it fits now
+        :rtype: float
+        """
+        now = self.clock() if now is None else now
+        self._expire(now)
+        excess = self._used + airtime - self.budget
+        if excess <= 1e-12:
+            return 0.
+        if airtime > self.budget:
+            return float('inf')
+        for end, duration in self._transmissions:
+            excess -= duration
+            if excess <= 1e-12:
+                return end + self.window - now
+        return float('inf')
+
+    def can_send(self, airtime, now=None):
+        return self.wait_time(airtime, now) == 0
+
+    def record(self, airtime, start=None):
+        """ Count a transmission of airtime seconds that starts at start (default now). """
+        start = self.clock() if start is None else start
+        self._transmissions.append((start + airtime, airtime))
+        self._used += airtime
+        self.total += airtime
+
+    def charge(self, airtime):
+        """ Record a transmission that starts now, or raise DutyCycleExceeded if it does not fit.
+        :raises DutyCycleExceeded: if it does not fit, with the time to wait
+        """
+        now = self.clock()
+        wait = self.wait_time(airtime, now)
+        if wait:
+            self.refused += 1
+            raise DutyCycleExceeded(airtime, wait)
+        self.record(airtime, now)
+
+    def stats(self):
+        now = self.clock()
+        return dict(
+                used       = self.used(now),
+                available  = self.available(now),
+                total      = self.total,
+                refused    = self.refused,
+                duty_cycle = self._used / self.window
+            )
@@ -0,0 +1,319 @@
+""" Benchmarks the SPI traffic and wall time of common driver operations. Run with python -m spi_lora.bench. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import collections
+import importlib
+import json
+import math
+import platform
+import sys
+import time
+
+from .constants import *
+from .channels import EU868
+from .fhss import FhssEngine
+from .LoRa import GenericLoRa
+from .profiles import EU868_SF7BW125, EU868_SF12BW125
+
+
+class CountingSpi(object):
+    """ Wraps a spidev.SpiDev and counts the transfers and bytes that go through it. """
+
+    def __init__(self, spi):
+        self.spi = spi
+        self.xfers = 0
+        self.bytes = 0
+        # The driver checks for these, so only offer them if the real connection has them
+        for name in ('xfer3', 'writebytes2', 'xfer_many'):
+            if getattr(spi, name, None) is None:
+                setattr(self, name, None)
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    def xfer(self, data, *args):
+        self.xfers += 1
+        self.bytes += len(data)
+        return self.spi.xfer(data, *args)
+
+    def xfer2(self, data, *args):
+        self.xfers += 1
+        self.bytes += len(data)
+        return self.spi.xfer2(data, *args)
+
+    def xfer3(self, data, *args):
+        self.xfers += 1
+        self.bytes += len(data)
+        return self.spi.xfer3(data, *args)
+
+    def writebytes2(self, data):
+        self.xfers += 1
+        self.bytes += len(data)
+        return self.spi.writebytes2(data)
+
+    def xfer_many(self, transfers, *args):
+        # These go to the kernel together, so count as one
+        self.xfers += 1
+        self.bytes += sum(len(data) for data in transfers)
+        return self.spi.xfer_many(transfers, *args)
+
+
+# Each scenario takes the GenericLoRa under test and returns a (prepare, operation) pair. Both are called with the
+# iteration number; only operation is timed and counted, and prepare may be None. A scenario that leaves something to
+# undo adds a third function, called with no arguments at the end. A scenario that can't run on the board returns a
+# string saying why instead.
+
+def mode_switch(lora):
+    lora.set_mode(MODE.SLEEP)
+    modes = (MODE.STDBY, MODE.SLEEP)
+    return None, lambda i: lora.set_mode(modes[i % 2])
+
+
+def set_freq(lora):
+    lora.set_mode(MODE.STDBY)
+    return None, lambda i: lora.set_freq(868.1 + 0.2 * (i % 2))
+
+
+def tune(lora):
+    """ Hop between EU868 channels while receiving, as a channel scan does. """
+    lora.set_mode(MODE.STDBY)
+    lora.set_mode(MODE.RXCONT)
+    return None, lambda i: lora.tune(i % len(EU868), MODE.RXCONT, plan=EU868)
+
+
+def _configure(lora, i):
+    lora.set_freq(868.1 + 0.2 * (i % 2))
+    lora.set_bw(BW.BW125)
+    lora.set_coding_rate(CODING_RATE.CR4_5)
+    lora.set_spreading_factor(7 + i % 2)
+    lora.set_rx_crc(True)
+    lora.set_preamble(8)
+    lora.set_pa_config(pa_select=1, max_power=0x04, output_power=0x0F)
+    lora.set_ocp_trim(100)
+    lora.set_sync_word(0x12)
+
+
+def configure(lora):
+    lora.set_mode(MODE.STDBY)
+    return None, lambda i: _configure(lora, i)
+
+
+def configure_batch(lora):
+    lora.set_mode(MODE.STDBY)
+    def operation(i):
+        with lora.batch():
+            _configure(lora, i)
+    return None, operation
+
+
+def apply_profile(lora):
+    lora.set_mode(MODE.STDBY)
+    profiles = (EU868_SF7BW125, EU868_SF12BW125)
+    return None, lambda i: lora.apply_profile(profiles[i % 2])
+
+
+def write_payload(lora):
+    lora.set_mode(MODE.STDBY)
+    payload = bytes(range(64))
+    return None, lambda i: lora.write_payload(payload)
+
+
+def tx_loop(lora):
+    """ Send a 16 byte packet and poll for TxDone. On real hardware this includes the time on air. """
+    lora.apply_profile(EU868_SF7BW125)
+    lora.set_dio_mapping([1, 0, 0, 0, 0, 0])
+    payload = bytes(16)
+    def operation(i):
+        lora.write_payload(payload)
+        lora.set_mode(MODE.TX)
+        deadline = time.monotonic() + 5
+        while not lora.get_irq_flags()['tx_done']:
+            if time.monotonic() > deadline:
+                raise RuntimeError("TxDone did not come")
+        lora.clear_irq_flags(TxDone=1)
+    return None, operation
+
+
+def rx_loop(lora):
+    """ Handle one received 32 byte packet through the receive pipeline. Needs a simulated radio to send it. """
+    radio = lora.spi.spi
+    if not hasattr(radio, 'deliver'):
+        return "needs a simulated radio to produce packets"
+    ring = lora.start_rx_pipeline()
+    payload = bytes(range(32))
+    def operation(i):
+        lora.handle_irq_flags()
+        if ring.get_nowait() is None:
+            raise RuntimeError("No packet received")
+    return lambda i: radio.deliver(payload, -60, 9.5), operation
+
+
+def fhss_hop(lora):
+    """ Handle one FhssChangeChannel IRQ with the FHSS engine. A simulated radio raises the IRQ before each one;
+    on a real board the engine counts the hops itself, since nothing is being sent. """
+    radio = lora.spi.spi
+    simulated = hasattr(radio, 'hop')
+    lora.apply_profile(EU868_SF7BW125)
+    engine = FhssEngine(lora, [868.1 + 0.2 * i for i in range(8)], sequence=[0, 5, 2, 7, 4, 1, 6, 3],
+                        track_channel=simulated)
+    engine.start()
+    def prepare(i):
+        if simulated:
+            radio.hop(i + 1)
+        lora.irq_timestamp = time.monotonic()
+    return prepare, lambda i: engine.hop(), engine.stop
+
+
+def register_dump(lora):
+    lora.set_mode(MODE.STDBY)
+    return None, lambda i: lora.snapshot()
+
+
+def calibration(lora):
+    lora.set_mode(MODE.SLEEP)
+    return None, lambda i: lora.rx_chain_calibration(868.)
+
+
+SCENARIOS = collections.OrderedDict((f.__name__, f) for f in (
+    mode_switch, set_freq, tune, configure, configure_batch, apply_profile, write_payload, tx_loop, rx_loop, fhss_hop,
+    register_dump, calibration))
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of a sorted list. """
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(math.ceil(p / 100. * len(sorted_values))) - 1))]
+
+
+def run_scenario(lora, scenario, iterations):
+    """ Run one scenario.
+    :param lora: GenericLoRa whose spi is a CountingSpi
+    :param scenario: Scenario function
+    :param iterations: Number of timed operations, after one untimed warm-up operation
+    :return: Statistics
+    :rtype: dict
+    """
+    spi = lora.spi
+    setup = scenario(lora)
+    if isinstance(setup, str):
+        return dict(skipped=setup)
+    prepare, operation = setup[:2]
+    times = []
+    xfers = 0
+    n_bytes = 0
+    for i in range(iterations + 1):
+        if prepare is not None:
+            prepare(i)
+        xfers_before, bytes_before = spi.xfers, spi.bytes
+        start = time.perf_counter()
+        operation(i)
+        elapsed = time.perf_counter() - start
+        if i > 0:
+            times.append(elapsed)
+            xfers += spi.xfers - xfers_before
+            n_bytes += spi.bytes - bytes_before
+    if len(setup) > 2:
+        setup[2]()
+    times.sort()
+    speed = getattr(spi, 'max_speed_hz', None)
+    return dict(
+            iterations   = iterations,
+            p50_us       = percentile(times, 50) * 1e6,
+            p99_us       = percentile(times, 99) * 1e6,
+            mean_us      = sum(times) / len(times) * 1e6,
+            max_us       = times[-1] * 1e6,
+            xfers_per_op = xfers / float(iterations),
+            bytes_per_op = n_bytes / float(iterations),
+            # Time the clock alone needs to move the bytes, which is what a faster SPI clock can save
+            bus_us_per_op = n_bytes * 8e6 / speed / iterations if speed else None
+        )
+
+
+def run_benchmarks(board, iterations=200, scenarios=None, cache_registers=False):
+    """ Run benchmark scenarios against a board.
+    The IRQ lines are not used; operations poll the IRQ flags, so that all the SPI traffic happens in the benchmark.
+    :param board: BaseBoard subclass (real or from sim.sim_board())
+    :param iterations: Number of timed operations per scenario
+    :param scenarios: Names of the scenarios to run, or None for all of them
+    :param cache_registers: Enable the register cache
+    :return: Report that can be dumped as JSON
+    :rtype: dict
+    """
+    spi = CountingSpi(board.SpiDev())
+    lora = GenericLoRa(spi, board.low_band, verbose=False, do_calibration=False, cache_registers=cache_registers)
+    results = collections.OrderedDict()
+    for name in scenarios or SCENARIOS:
+        results[name] = run_scenario(lora, SCENARIOS[name], iterations)
+    lora.set_mode(MODE.SLEEP)
+    try:
+        driver_version = importlib.import_module('importlib.metadata').version('spi-lora')
+    except Exception:
+        driver_version = None
+    return collections.OrderedDict((
+        ('driver_version', driver_version),
+        ('python', platform.python_version()),
+        ('board', board.__module__ + '.' + board.__name__),
+        ('max_speed_hz', getattr(spi, 'max_speed_hz', None)),
+        ('cache_registers', cache_registers),
+        ('scenarios', results),
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SPI transfers and wall time of LoRa driver operations. "
+                                                 "Prints a JSON report.")
+    parser.add_argument('--board', dest='board', default=None, type=str,
+                        help="Board module in spi_lora.boards, e.g. Generic_RFM95W. Default is a simulated radio.")
+    parser.add_argument('--speed', dest='speed', default=None, type=int, help="SPI clock in Hz")
+    parser.add_argument('--iterations', '-n', dest='iterations', default=200, type=int,
+                        help="Timed operations per scenario. Default is 200.")
+    parser.add_argument('--scenario', '-s', dest='scenarios', default=None, action='append',
+                        choices=list(SCENARIOS), help="Scenario to run; may be repeated. Default is all of them.")
+    parser.add_argument('--ioctl', dest='ioctl', default=False, action='store_true',
+                        help="Talk to the board through spidev_ioc.IocSpiDev instead of spidev")
+    parser.add_argument('--cache', dest='cache', default=False, action='store_true', help="Enable the register cache")
+    parser.add_argument('--output', '-o', dest='output', default=None, type=argparse.FileType('w'),
+                        help="File to write the report to. Default is stdout.")
+    args = parser.parse_args(argv)
+
+    if args.board is None:
+        from .sim import sim_board
+        board = sim_board(name='bench')
+    else:
+        board = importlib.import_module('spi_lora.boards.' + args.board).BOARD
+        if args.ioctl:
+            from .spidev_ioc import ioc_board
+            board = ioc_board(board)
+    if args.speed is not None:
+        board.max_speed_hz = args.speed
+    board.setup()
+    try:
+        report = run_benchmarks(board, args.iterations, args.scenarios, args.cache)
+    finally:
+        board.teardown()
+    json.dump(report, args.output or sys.stdout, indent=2)
+    (args.output or sys.stdout).write("\n")
+
+
+if __name__ == '__main__':
+    main()
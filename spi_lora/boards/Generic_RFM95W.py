@@ -46,7 +46,7 @@ class BOARD(BaseBoard):
         """
         cls.spi = spidev.SpiDev()
         cls.spi.open(spi_bus, spi_cs)
-        cls.spi.max_speed_hz = 5000000    # SX127x can go up to 10MHz, pick half that to be safe
+        cls.spi.max_speed_hz = cls.max_speed_hz
         return cls.spi
 
 
@@ -117,7 +117,7 @@ class BOARD(BaseBoard):
         # *,
         # preamble_length=8,
         # high_power=True,
-        baudrate=5000000
+        baudrate=cls.max_speed_hz
         #         self._device = spidev.SPIDevice(spi, cs, baudrate=baudrate, polarity=0, phase=0)
         cls.spi = spidev.SpiDev()
         cls.spi.open(spi_bus, spi_cs)
@@ -36,6 +36,11 @@ class BaseBoard(object):
     # low band (called band 1&2) are 137-175 MHz and 410-525 MHz
     # high band (called band 3) is 862-1020 MHz
     low_band = True
+
+    # SPI clock for SpiDev() to set. The SX127x can go up to 10MHz; boards pick half that to be safe. Set it on the
+    # board class before calling SpiDev() to try other speeds, or use link.calibrate_board() to find the fastest one
+    # that works with this board's wiring, and link.apply_saved_speed() to use it.
+    max_speed_hz = 5000000
     
     @classmethod
     def setup(cls):
@@ -60,7 +65,7 @@ class BaseBoard(object):
     @classmethod
     def SpiDev(cls, spi_bus=None, spi_cs=None):
         """ Init and return the SpiDev object used to talk to the modem.
-        Responsible for setting a reasonable SPI speed.
+        Responsible for setting the SPI speed to max_speed_hz.
         :return: SpiDev object
         :param spi_bus: The SPI bus to use, if the board has several. Some boards may only allow using one at a time.
         :param spi_cs: The SPI chip select to use, if the board has several. Some boards may only allow using one at a time.
@@ -68,6 +73,28 @@ class BaseBoard(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def derive(cls, spi_bus=None, spi_cs=None, name=None, **attributes):
+        """ Make a board class for one of several modems of this kind on the same host.
+
+        Boards keep their SPI connection and pin numbers in class attributes,
+        so two modems sharing one board class would clobber each other. The
+        derived class has its own, and its SpiDev() opens the given bus and
+        chip select by default.
+        :param spi_bus: SPI bus for SpiDev() to use, or None for the board's default
+        :param spi_cs: SPI chip select for SpiDev() to use, or None for the board's default
+        :param name: Name of the new class
+        :param attributes: Class attributes to set, e.g. DIO0=5, RESET=6
+        :return: A subclass of this board
+        """
+        def SpiDev(board, spi_bus=spi_bus, spi_cs=spi_cs):
+            # Leave out what wasn't given, so the board's own defaults apply
+            kwargs = {k: v for k, v in (('spi_bus', spi_bus), ('spi_cs', spi_cs)) if v is not None}
+            return super(derived, board).SpiDev(**kwargs)
+        namespace = dict(attributes, spi=None, SpiDev=classmethod(SpiDev))
+        derived = type(name or "%s_%s_%s" % (cls.__name__, spi_bus, spi_cs), (cls,), namespace)
+        return derived
+
     # If the board supports interrupt lines, it should add an add_events class
     # method. This method must take 5 DIO callbacks and one optional switch_cb
     # callback. It will call the given callbacks when the modem DIO pins are
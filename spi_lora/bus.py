@@ -0,0 +1,251 @@
+""" Defines SpiBus, which serializes and prioritizes the transfers of several modems sharing one SPI bus. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+from .stats import LatencyCounter
+
+
+# Transfer priorities, most urgent first. Transfers made while handling a DIO interrupt go at IRQ priority, so that a
+# packet is read out of one modem while another is having its registers dumped.
+IRQ = 0
+NORMAL = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {IRQ: 'irq', NORMAL: 'normal', BACKGROUND: 'background'}
+
+
+class SpiBus(object):
+    """
+    Arbiter for one SPI bus shared by several modems on different chip
+    selects.
+
+    Every transfer through a BusSpi takes the bus first. While the bus is
+    busy, waiting transfers queue by priority, then in order of arrival,
+    and the bus is handed straight to the first in the queue when it comes
+    free. The priority of a transfer is that of the thread's innermost
+    priority() block, or else the BusSpi's own. Transfers from DIO
+    callbacks hooked up through a board from board() go at IRQ priority.
+
+    Holding the bus is reentrant, so hold() can keep it across several
+    transfers, e.g. to read a packet out without another modem's transfers
+    getting in between.
+
+        bus = SpiBus()
+        lora_a = LoRa(bus.board(BOARD.derive(spi_cs=0)))
+        lora_b = LoRa(bus.board(BOARD.derive(spi_cs=1)))
+        with bus.priority(BACKGROUND):
+            print(lora_a)
+    """
+
+    def __init__(self, name=None, clock=time.perf_counter):
+        """
+        :param name: Name for display purposes
+        :param clock: Function giving the time in seconds
+        """
+        self.name = name
+        self.clock = clock
+        self.transfers = 0
+        self.bytes = 0
+        self.busy_time = 0.
+        self.max_queue = 0
+        self.waits = {priority: LatencyCounter() for priority in PRIORITY_NAMES}
+        self.started = clock()
+        self._lock = threading.Lock()
+        self._owner = None
+        self._depth = 0
+        self._held_since = None
+        self._queue = []
+        self._sequence = itertools.count()
+        self._local = threading.local()
+
+    def current_priority(self, default=NORMAL):
+        """ Get the priority set by the calling thread's innermost priority() block, or default if there is none. """
+        priority = getattr(self._local, 'priority', None)
+        return default if priority is None else priority
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """ Context manager that makes the calling thread's transfers go at the given priority. """
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def acquire(self, priority=NORMAL):
+        """ Wait for the bus and take it. A thread that already holds the bus takes it again at once. """
+        me = threading.get_ident()
+        start = self.clock()
+        with self._lock:
+            if self._owner == me:
+                self._depth += 1
+                return
+            if self._owner is None:
+                self._take(me, start)
+                self.waits[priority].add(0.)
+                return
+            event = threading.Event()
+            heapq.heappush(self._queue, (priority, next(self._sequence), me, event))
+            self.max_queue = max(self.max_queue, len(self._queue))
+        # release() makes us the owner before setting the event
+        event.wait()
+        self.waits[priority].add(self.clock() - start)
+
+    def release(self):
+        """ Give the bus up, handing it to the most urgent waiting thread. """
+        with self._lock:
+            assert self._owner == threading.get_ident(), "Releasing a bus this thread does not hold"
+            self._depth -= 1
+            if self._depth:
+                return
+            now = self.clock()
+            self.busy_time += now - self._held_since
+            if self._queue:
+                priority, _, owner, event = heapq.heappop(self._queue)
+                self._take(owner, now)
+                event.set()
+            else:
+                self._owner = None
+
+    def _take(self, owner, now):
+        self._owner = owner
+        self._depth = 1
+        self._held_since = now
+
+    @contextlib.contextmanager
+    def hold(self, priority=None):
+        """ Context manager that holds the bus, at the thread's current priority if priority is None. """
+        self.acquire(self.current_priority() if priority is None else priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def queue_depth(self):
+        """ Get the number of threads waiting for the bus. """
+        return len(self._queue)
+
+    def board(self, board, priority=NORMAL):
+        """ Put a board's modem on this bus.
+        :param board: BaseBoard subclass for the modem, e.g. from BaseBoard.derive()
+        :param priority: Priority of the modem's transfers outside of priority() blocks and DIO callbacks
+        :return: A subclass of board whose SpiDev() goes through the bus, and whose DIO callbacks make their transfers
+        at IRQ priority
+        """
+        bus = self
+
+        class BusBoard(board):
+            @classmethod
+            def SpiDev(cls, *args, **kwargs):
+                cls.spi = BusSpi(bus, super(BusBoard, cls).SpiDev(*args, **kwargs), priority)
+                return cls.spi
+
+        if hasattr(board, 'add_events'):
+            def add_events(cls, *callbacks, **kwargs):
+                super(BusBoard, cls).add_events(*[bus.irq_callback(c) for c in callbacks], **kwargs)
+            BusBoard.add_events = classmethod(add_events)
+        BusBoard.__name__ = board.__name__
+        return BusBoard
+
+    def irq_callback(self, callback):
+        """ Wrap a DIO callback so that its transfers go at IRQ priority. """
+        if callback is None:
+            return None
+        def on_irq(*args):
+            with self.priority(IRQ):
+                return callback(*args)
+        return on_irq
+
+    def stats(self):
+        """ Get the transfer counters, the fraction of the time the bus was held, and the queue wait times by
+        priority.
+        :rtype: dict
+        """
+        elapsed = self.clock() - self.started
+        return dict(
+                transfers   = self.transfers,
+                bytes       = self.bytes,
+                busy_time   = self.busy_time,
+                utilisation = self.busy_time / elapsed if elapsed else 0.,
+                max_queue   = self.max_queue,
+                waits       = {PRIORITY_NAMES[p]: waits.stats() for p, waits in self.waits.items()}
+            )
+
+
+class BusSpi(object):
+    """ Wraps the spidev.SpiDev of one modem on a SpiBus, so that its transfers take turns with the other modems'. """
+
+    def __init__(self, bus, spi, priority=NORMAL):
+        """
+        :param bus: The SpiBus
+        :param spi: The modem's spidev.SpiDev
+        :param priority: Priority of transfers outside of priority() blocks
+        """
+        self.bus = bus
+        self.spi = spi
+        self.priority = priority
+        # The driver checks for these, so only offer them if the real connection has them
+        for name in ('xfer3', 'writebytes2', 'xfer_many'):
+            if getattr(spi, name, None) is None:
+                setattr(self, name, None)
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    def _transfer(self, method, data, *args):
+        bus = self.bus
+        bus.acquire(bus.current_priority(self.priority))
+        try:
+            bus.transfers += 1
+            bus.bytes += len(data)
+            return method(data, *args)
+        finally:
+            bus.release()
+
+    def xfer(self, data, *args):
+        return self._transfer(self.spi.xfer, data, *args)
+
+    def xfer2(self, data, *args):
+        return self._transfer(self.spi.xfer2, data, *args)
+
+    def xfer3(self, data, *args):
+        return self._transfer(self.spi.xfer3, data, *args)
+
+    def writebytes2(self, data):
+        return self._transfer(self.spi.writebytes2, data)
+
+    def xfer_many(self, transfers, *args):
+        bus = self.bus
+        bus.acquire(bus.current_priority(self.priority))
+        try:
+            bus.transfers += len(transfers)
+            bus.bytes += sum(len(data) for data in transfers)
+            return self.spi.xfer_many(transfers, *args)
+        finally:
+            bus.release()
@@ -0,0 +1,118 @@
+""" Defines RegisterCache, a shadow copy of the SX127x configuration registers. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+from .constants import REG, VOLATILE_REGISTERS
+
+
+# Only named LoRa registers that the modem does not change by itself are cached.
+CACHEABLE_REGISTERS = frozenset(REG.LORA.lookup) - VOLATILE_REGISTERS
+
+
+class RegisterCache(object):
+    """
+    Shadow copy of the cacheable LoRa registers.
+
+    Reads of known registers are answered from memory and writes that would not
+    change a register can be skipped. Every access to a range of cacheable
+    registers counts as a hit (no SPI transfer needed) or a miss. Accesses that
+    touch any volatile register bypass the cache and are not counted.
+    """
+
+    def __init__(self):
+        self.values = [None] * 0x80
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(register_address, count=1):
+        """ Check if a range of registers may be cached.
+        :param register_address: First register address
+        :param count: Number of consecutive registers
+        :rtype: bool
+        """
+        return all(a in CACHEABLE_REGISTERS for a in range(register_address, register_address + count))
+
+    def clear(self):
+        """ Forget all cached values. Hit and miss counters are kept. """
+        self.values = [None] * 0x80
+
+    def seed(self, registers):
+        """ Fill the cache from a register image, as returned by GenericLoRa.get_all_registers().
+        :param registers: List of register values indexed by address
+        """
+        self.clear()
+        for address, value in enumerate(registers):
+            if address in CACHEABLE_REGISTERS:
+                self.values[address] = value
+
+    def read(self, register_address, count):
+        """ Look up a range of registers.
+        :return: List of register values, or None if they must be read from the modem.
+        :rtype: list[int]
+        """
+        if not self.cacheable(register_address, count):
+            return None
+        values = self.values[register_address:register_address + count]
+        if None in values:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return values
+
+    def store(self, register_address, values):
+        """ Remember values read from or written to the modem. Volatile registers in the range are ignored. """
+        if register_address == REG.LORA.FIFO:
+            # FIFO bursts do not auto-increment the address
+            return
+        for address, value in enumerate(values, register_address):
+            if address in CACHEABLE_REGISTERS:
+                self.values[address] = value
+
+    def write_needed(self, register_address, values):
+        """ Check if a write would change anything on the modem, counting a hit if it would not.
+        :rtype: bool
+        """
+        if not self.cacheable(register_address, len(values)):
+            return True
+        if self.values[register_address:register_address + len(values)] == list(values):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    def invalidate(self, register_address, count=1):
+        """ Forget the cached values of a range of registers. """
+        if register_address == REG.LORA.FIFO:
+            return
+        for address in range(register_address, min(register_address + count, len(self.values))):
+            self.values[address] = None
+
+    def stats(self):
+        """ Get the hit and miss counters.
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return dict(
+                hits     = self.hits,
+                misses   = self.misses,
+                hit_rate = float(self.hits) / total if total else 0.
+            )
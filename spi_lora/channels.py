@@ -0,0 +1,122 @@
+""" Defines ChannelPlan, a table of channels with their frequency register values worked out in advance. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from .constants import *
+from .LoRa import encode_freq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ChannelPlan(object):
+    """
+    A numbered set of channel frequencies, held as the exact FR_MSB, FR_MID
+    and FR_LSB values for each, so that switching channels needs no
+    arithmetic.
+
+        lora.channel_plan = EU868
+        lora.tune(3)
+        readings = EU868.scan(lora)
+
+    Build a custom plan from a list of frequencies, or with
+    ChannelPlan.spaced() for evenly spaced channels.
+    """
+
+    def __init__(self, frequencies, name=None):
+        """
+        :param frequencies: Channel frequencies in MHz, in channel number order
+        :param name: Name for display purposes
+        """
+        self.frequencies = tuple(frequencies)
+        self.name = name
+        self.registers = tuple(tuple(encode_freq(f)) for f in self.frequencies)
+        self._channels = {}
+        for channel, frf in enumerate(self.registers):
+            self._channels.setdefault(frf, channel)
+
+    @classmethod
+    def spaced(cls, first, spacing, count, name=None):
+        """ Make a plan of evenly spaced channels.
+        :param first: Frequency of channel 0 in MHz
+        :param spacing: MHz between channels
+        :param count: Number of channels
+        :rtype: ChannelPlan
+        """
+        # Multiplying rather than adding up keeps rounding errors from building up along the band
+        return cls([first + spacing * i for i in range(count)], name=name)
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __getitem__(self, channel):
+        return self.frequencies[channel]
+
+    def channel(self, registers):
+        """ Look up the channel tuned to by the given FR_MSB, FR_MID and FR_LSB values.
+        :return: Channel number, or None if the frequency is not in the plan
+        :rtype: int
+        """
+        return self._channels.get(tuple(registers))
+
+    def scan(self, lora, channels=None, dwell=0.001, samples=1, interval=0., sleep=time.sleep):
+        """ Measure the RSSI on each channel in RXCONT mode. The transceiver is left in STDBY mode, on the last
+        channel scanned.
+        :param lora: The GenericLoRa to scan with
+        :param channels: Channel numbers to scan. Defaults to all of them.
+        :param dwell: Seconds to listen on each channel before the first reading
+        :param samples: RSSI readings to take on each channel
+        :param interval: Seconds between readings on a channel
+        :param sleep: Function to wait a number of seconds
+        :return: RSSI in dBm, one row per channel and one column per reading
+        :rtype: numpy.ndarray or list[list[float]]
+        """
+        channels = range(len(self)) if channels is None else channels
+        readings = []
+        for channel in channels:
+            lora.tune(channel, MODE.RXCONT, plan=self)
+            sleep(dwell)
+            row = []
+            for i in range(samples):
+                if i:
+                    sleep(interval)
+                row.append(lora.get_rssi_value())
+            readings.append(row)
+        lora.set_mode(MODE.STDBY)
+        if numpy is None:
+            return readings
+        return numpy.array(readings, dtype=float).reshape(-1, samples)
+
+    def __repr__(self):
+        return "ChannelPlan(%s)" % (self.name or list(self.frequencies))
+
+
+# The LoRaWAN regional parameters' channels. EU868 has the three default channels first, then the five that networks
+# commonly add; US915 has the 64 125 kHz uplink channels, then the 8 500 kHz ones; AS923 is AS923-1.
+EU868 = ChannelPlan([868.1, 868.3, 868.5, 867.1, 867.3, 867.5, 867.7, 867.9], name='EU868')
+US915 = ChannelPlan(ChannelPlan.spaced(902.3, 0.2, 64).frequencies + ChannelPlan.spaced(903.0, 1.6, 8).frequencies,
+                    name='US915')
+AS923 = ChannelPlan([923.2, 923.4, 922.2, 922.4, 922.6, 922.8, 923.0, 922.0], name='AS923')
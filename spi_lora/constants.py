@@ -57,6 +57,21 @@ class BW:
     BW500   = 9
 
 
+# Signal bandwidth in Hz for each BW setting
+BANDWIDTH_HZ = {
+    BW.BW7_8:   7800.,
+    BW.BW10_4:  10400.,
+    BW.BW15_6:  15600.,
+    BW.BW20_8:  20800.,
+    BW.BW31_25: 31250.,
+    BW.BW41_7:  41700.,
+    BW.BW62_5:  62500.,
+    BW.BW125:   125000.,
+    BW.BW250:   250000.,
+    BW.BW500:   500000.,
+}
+
+
 @add_lookup
 class CODING_RATE:
     CR4_5 = 1
@@ -194,3 +209,27 @@ class REG:
         IMAGE_CAL          = 0x3B
         DIO_MAPPING_1      = 0x40
         DIO_MAPPING_2      = 0x41
+
+
+# Registers that the modem changes on its own, or whose access has side effects. They are never served from the
+# register cache. Addresses without a name in REG.LORA (e.g. the LSBs of the packet counters) are not cached either.
+VOLATILE_REGISTERS = frozenset([
+    REG.LORA.FIFO,
+    REG.LORA.OP_MODE,
+    REG.LORA.FIFO_ADDR_PTR,
+    REG.LORA.FIFO_RX_CURR_ADDR,
+    REG.LORA.IRQ_FLAGS,
+    REG.LORA.RX_NB_BYTES,
+    REG.LORA.RX_HEADER_CNT_MSB,
+    REG.LORA.RX_PACKET_CNT_MSB,
+    REG.LORA.MODEM_STAT,
+    REG.LORA.PKT_SNR_VALUE,
+    REG.LORA.PKT_RSSI_VALUE,
+    REG.LORA.RSSI_VALUE,
+    REG.LORA.HOP_CHANNEL,
+    REG.LORA.FIFO_RX_BYTE_ADDR,
+    REG.LORA.FEI_MSB,
+])
+
+# The payload length registers are 8 bits wide, so this is the longest payload the 256 byte FIFO can hold.
+MAX_PAYLOAD_LENGTH = 255
@@ -0,0 +1,154 @@
+""" Defines FhssEngine, which retunes the modem on every FhssChangeChannel IRQ of a frequency hopping packet. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from .constants import *
+from .LoRa import encode_freq
+from .stats import LatencyCounter
+
+
+# The FhssChangeChannel bit, to clear it with one write to IRQ_FLAGS
+FHSS_CHANGE_CHANNEL = 1 << MASK.IRQ_FLAGS.FhssChangeChannel
+
+# FhssPresentChannel is the low 6 bits of HOP_CHANNEL, so it wraps every 64 hops
+HOP_CHANNEL_MASK = 0b111111
+
+
+class FhssEngine(object):
+    """
+    Frequency hopping for GenericLoRa.
+
+    With a hop period set, the modem raises FhssChangeChannel every
+    hop_period symbols of a packet, counting the hops in FhssPresentChannel,
+    and the host has to retune it to the next channel before the hop is
+    over. The FR_MSB, FR_MID and FR_LSB values of every channel in the hop
+    sequence are worked out up front, so each hop is a HOP_CHANNEL read, one
+    3-byte frequency burst and the IRQ flag clear.
+
+        engine = FhssEngine(lora, [868.1, 868.3, 868.5], sequence=[0, 2, 1, 2])
+        engine.start()
+        lora.transmit(b'hello')
+
+    While the engine is started, GenericLoRa hands it the FhssChangeChannel
+    IRQs instead of calling on_fhss_change_channel(), from DIO1 (mapping 1),
+    DIO2 or handle_irq_flags(). write_payload(), reset_ptr_rx() and
+    fetch_packet() go back to the first channel of the sequence, where
+    every packet starts. Sender and receiver need the same channels,
+    sequence and hop period.
+
+    A hop is missed if FhssPresentChannel moved on by more than one since
+    the last one was handled, and late if it was handled more than deadline
+    seconds after its IRQ.
+    """
+
+    def __init__(self, lora, channels, sequence=None, hop_period=10, deadline=None, track_channel=True,
+                 clock=time.monotonic):
+        """
+        :param lora: The GenericLoRa to hop
+        :param channels: Channel frequencies in MHz
+        :param sequence: Indexes into channels, in hop order. Defaults to each channel in turn. A packet starts on the
+        first one, and the sequence repeats if the packet is longer.
+        :param hop_period: Symbols between hops, 1 to 255
+        :param deadline: Seconds from the IRQ by which a hop must be handled. Defaults to the length of a hop.
+        :param track_channel: Read FhssPresentChannel on every hop, to stay in step and count missed hops. If False,
+        the engine counts the hops itself, saving a transfer per hop.
+        :param clock: Function giving the time in seconds, on the same clock as GenericLoRa.irq_timestamp
+        """
+        if not 0 < hop_period < 256:
+            raise ValueError("hop_period must be 1 to 255 symbols")
+        self.lora = lora
+        self.channels = list(channels)
+        self.sequence = list(sequence) if sequence is not None else list(range(len(self.channels)))
+        if not self.sequence:
+            raise ValueError("Empty hop sequence")
+        self.hop_period = hop_period
+        self.deadline = deadline
+        self.track_channel = track_channel
+        self.clock = clock
+        self.frequencies = [encode_freq(self.channels[i]) for i in self.sequence]
+        self.hop_time = None
+        self.hops = 0
+        self.missed = 0
+        self.late = 0
+        self.latency = LatencyCounter()     # from the IRQ to the new frequency being written
+        self._present = 0
+        self._hop_count = 0
+
+    def start(self):
+        """ Set the hop period, tune to the first channel and take over the FhssChangeChannel IRQ. The transceiver
+        should be in SLEEP or STDBY mode, with the modem settings it will hop with. """
+        self.hop_time = self.hop_period * self.lora.get_airtime_params().symbol_time()
+        if self.deadline is None:
+            self.deadline = self.hop_time
+        self.lora.set_hop_period(self.hop_period)
+        self.rewind()
+        self.lora.fhss = self
+
+    def stop(self):
+        """ Stop hopping. The modem stays on whichever channel it was on. """
+        self.lora.fhss = None
+        self.lora.set_hop_period(0)
+
+    def rewind(self):
+        """ Tune to the first channel of the sequence, ready for the next packet. """
+        self._present = 0
+        self._hop_count = 0
+        self.lora.set_registers(REG.LORA.FR_MSB, self.frequencies[0])
+
+    def hop(self):
+        """ Handle a FhssChangeChannel IRQ: write the frequency of the channel the modem has moved to, and clear the
+        IRQ. """
+        lora = self.lora
+        if self.track_channel:
+            present = lora.get_register(REG.LORA.HOP_CHANNEL) & HOP_CHANNEL_MASK
+            step = (present - self._present) & HOP_CHANNEL_MASK
+            if not step:
+                # Already handled, e.g. by an event and a poll racing each other
+                lora.set_register(REG.LORA.IRQ_FLAGS, FHSS_CHANGE_CHANNEL)
+                return
+            self._present = present
+            self.missed += step - 1
+        else:
+            step = 1
+        self._hop_count += step
+        lora.set_registers(REG.LORA.FR_MSB, self.frequencies[self._hop_count % len(self.frequencies)])
+        lora.set_register(REG.LORA.IRQ_FLAGS, FHSS_CHANGE_CHANNEL)
+        self.hops += 1
+        if lora.irq_timestamp is not None:
+            latency = self.clock() - lora.irq_timestamp
+            self.latency.add(latency)
+            if self.deadline is not None and latency > self.deadline:
+                self.late += 1
+
+    def stats(self):
+        """ Get the hop counters.
+        :rtype: dict
+        """
+        return dict(
+                hops     = self.hops,
+                missed   = self.missed,
+                late     = self.late,
+                hop_time = self.hop_time,
+                latency  = self.latency.stats()
+            )
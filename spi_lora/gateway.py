@@ -0,0 +1,265 @@
+""" Defines LoRaGateway, an asyncio server that shares one modem between many TCP or Unix socket clients. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import asyncio
+import struct
+import sys
+import time
+
+from .airtime import DutyCycleExceeded
+from .constants import MAX_PAYLOAD_LENGTH
+from .stats import LatencyCounter
+
+
+# Every message in either direction is a 2-byte big-endian length followed by that many payload bytes. Clients send
+# packets to transmit, and the gateway sends every packet it receives to every client.
+FRAME_HEADER = struct.Struct('>H')
+
+
+def encode_frame(payload):
+    """ Frame a payload for the socket protocol.
+    :rtype: bytes
+    """
+    return FRAME_HEADER.pack(len(payload)) + bytes(payload)
+
+
+async def read_frame(reader):
+    """ Read one frame from an asyncio.StreamReader.
+    :return: The payload, or None at end of stream
+    :rtype: bytes
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class GatewayClient(object):
+    """ One connected client, with its queue of received packets still to be sent to it. """
+
+    def __init__(self, name, writer, queue_size):
+        self.name = name
+        self.writer = writer
+        self.task = None
+        self.rx_queue = asyncio.Queue(queue_size)
+        self.tx_pending = 0             # packets from this client waiting to be transmitted
+        self.tx_sent = 0
+        self.tx_failed = 0              # packets the radio could not send
+        self.rx_delivered = 0
+        self.rx_dropped = 0
+        self.tx_latency = LatencyCounter()      # from reading the frame to TxDone
+        self.rx_latency = LatencyCounter()      # from RxDone to writing the frame to the socket
+
+    def deliver(self, packet):
+        """ Queue a received packet for this client, dropping its oldest one if the client is not keeping up. """
+        if self.rx_queue.full():
+            self.rx_queue.get_nowait()
+            self.rx_dropped += 1
+        self.rx_queue.put_nowait(packet)
+
+    def stats(self):
+        return dict(
+                tx_pending     = self.tx_pending,
+                tx_sent        = self.tx_sent,
+                tx_failed      = self.tx_failed,
+                tx_latency     = self.tx_latency.stats(),
+                rx_queue_depth = self.rx_queue.qsize(),
+                rx_delivered   = self.rx_delivered,
+                rx_dropped     = self.rx_dropped,
+                rx_latency     = self.rx_latency.stats()
+            )
+
+
+class LoRaGateway(object):
+    """
+    Shares one AsyncLoRa radio between any number of socket clients.
+
+    Packets from clients go into one bounded TX queue. When it is full, the
+    gateway stops reading from the sending client, so backpressure reaches it
+    through the socket instead of packets being dropped. Every packet the radio
+    receives goes to every connected client, through a bounded queue per
+    client so that one slow client cannot hold up the others.
+
+        gateway = LoRaGateway(radio)
+        await gateway.start_tcp('localhost', 20000)
+        await gateway.serve_forever()
+    """
+
+    def __init__(self, radio, tx_queue_size=16, client_queue_size=64, scheduler=None, tx_timeout_margin=1.,
+                 verbose=False):
+        """
+        :param radio: A started AsyncLoRa
+        :param tx_queue_size: Number of packets waiting for transmission before clients are held off
+        :param client_queue_size: Number of received packets to hold for each client before dropping the oldest
+        :param scheduler: A scheduler.TxScheduler for the radio's modem, to hold each packet until the duty cycle
+        allows it to go
+        :param tx_timeout_margin: Seconds to wait for TxDone beyond the packet's time on air, before giving up on it
+        :param verbose: Log connections and packets to stderr
+        """
+        self.radio = radio
+        self.client_queue_size = client_queue_size
+        self.scheduler = scheduler
+        self.tx_timeout_margin = tx_timeout_margin
+        self.verbose = verbose
+        self.clients = set()
+        self.tx_queue = asyncio.Queue(tx_queue_size)
+        self.servers = []
+        self._tasks = []
+        self._next_client = 0
+
+    async def start_tcp(self, host, port):
+        """ Listen for clients on a TCP port. Use port 0 to pick a free one.
+        :return: The asyncio Server
+        """
+        server = await asyncio.start_server(self._serve_client, host, port)
+        return self._add_server(server)
+
+    async def start_unix(self, path):
+        """ Listen for clients on a Unix domain socket.
+        :return: The asyncio Server
+        """
+        server = await asyncio.start_unix_server(self._serve_client, path)
+        return self._add_server(server)
+
+    def _add_server(self, server):
+        self.servers.append(server)
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._transmit()), asyncio.ensure_future(self._fan_out())]
+        return server
+
+    async def serve_forever(self):
+        await asyncio.gather(*self._tasks)
+
+    async def close(self):
+        """ Stop listening, disconnect all clients and stop the TX and RX tasks. """
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        clients = list(self.clients)
+        for client in clients:
+            client.writer.close()
+        # Closing the writers ends the clients' reads, so their tasks finish by themselves
+        await asyncio.gather(*[client.task for client in clients], return_exceptions=True)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        """ Get counters for the gateway and each client.
+        :rtype: dict
+        """
+        stats = dict(
+                tx_queue_depth = self.tx_queue.qsize(),
+                rx_dropped     = self.radio.rx_dropped,
+                clients        = {client.name: client.stats() for client in self.clients}
+            )
+        if self.scheduler is not None:
+            stats['scheduler'] = self.scheduler.stats()
+        return stats
+
+    def _log(self, message):
+        if self.verbose:
+            sys.stderr.write(message + "\n")
+
+    async def _serve_client(self, reader, writer):
+        self._next_client += 1
+        client = GatewayClient("%d:%s" % (self._next_client, writer.get_extra_info('peername')), writer,
+                               self.client_queue_size)
+        client.task = asyncio.current_task()
+        self.clients.add(client)
+        self._log("Connection from %s" % client.name)
+        sender = asyncio.ensure_future(self._send_to_client(client))
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                if len(payload) == 0 or len(payload) > MAX_PAYLOAD_LENGTH:
+                    # The modem can't send an empty packet
+                    self._log("Dropping %d byte packet from %s" % (len(payload), client.name))
+                    continue
+                client.tx_pending += 1
+                # This waits while the TX queue is full, which stops us reading from the client
+                await self.tx_queue.put((client, payload, time.monotonic()))
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+            self._log("Client %s disconnected" % client.name)
+
+    async def _send_to_client(self, client):
+        try:
+            while True:
+                packet = await client.rx_queue.get()
+                client.writer.write(encode_frame(packet.payload))
+                await client.writer.drain()
+                client.rx_delivered += 1
+                client.rx_latency.add(time.monotonic() - packet.timestamp)
+        except ConnectionError:
+            pass
+
+    async def _transmit(self):
+        while True:
+            client, payload, queued = await self.tx_queue.get()
+            try:
+                if self.scheduler is not None and not await self._wait_for_duty_cycle(payload):
+                    self._log("Dropping %d byte packet from %s: too long for the duty cycle" % (len(payload),
+                                                                                              client.name))
+                    continue
+                self._log("Send: %r" % payload)
+                # A lost TxDone must not hold up every client's packets forever
+                timeout = self.radio.lora.time_on_air(len(payload)) + self.tx_timeout_margin
+                await self.radio.send(payload, timeout)
+            except (DutyCycleExceeded, asyncio.TimeoutError, OSError) as e:
+                # Only this packet is lost; the other clients' packets still go out
+                self._log("Failed to send %d byte packet from %s: %s" % (len(payload), client.name, e))
+                client.tx_failed += 1
+                continue
+            finally:
+                client.tx_pending -= 1
+            client.tx_sent += 1
+            client.tx_latency.add(time.monotonic() - queued)
+
+    async def _wait_for_duty_cycle(self, payload):
+        """ Wait until the scheduler lets the packet go.
+        :return: False if it never can
+        """
+        request = self.scheduler.submit(payload)
+        while True:
+            released, wait = self.scheduler.next_request()
+            if released is request:
+                return True
+            if wait is None:
+                # Dropped, and nothing else is queued
+                return False
+            await asyncio.sleep(wait)
+
+    async def _fan_out(self):
+        async for packet in self.radio:
+            self._log("Recv: %r" % packet.payload)
+            for client in list(self.clients):
+                client.deliver(packet)
@@ -0,0 +1,276 @@
+""" Watch modem DIO lines through the Linux GPIO character device (/dev/gpiochipN), with kernel timestamps. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import errno
+import fcntl
+import os
+import select
+import struct
+import threading
+
+from .boards import BaseBoard
+
+
+# GPIO character device uAPI v2, from linux/gpio.h. Needs Linux 5.10 or newer.
+
+def _IOWR(type, nr, size):
+    return 3 << 30 | size << 16 | type << 8 | nr
+
+GPIO_V2_LINES_MAX = 64
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+
+# struct gpio_v2_line_request: offsets[64], consumer[32], config (flags, num_attrs, padding[5],
+# attrs[10] of (id, padding, value, mask)), num_lines, event_buffer_size, padding[5], fd
+LINE_REQUEST = struct.Struct('=64I32sQI5I' + 'IIQQ' * GPIO_V2_LINE_NUM_ATTRS_MAX + 'II5Ii')
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno, padding[6]
+LINE_EVENT = struct.Struct('=QIIII24x')
+
+GPIO_V2_GET_LINE_IOCTL = _IOWR(0xB4, 0x07, LINE_REQUEST.size)
+
+GPIO_V2_LINE_FLAG_INPUT          = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING    = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING   = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP   = 1 << 8
+GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN = 1 << 9
+GPIO_V2_LINE_FLAG_BIAS_DISABLED  = 1 << 10
+
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+
+GPIO_V2_LINE_EVENT_RISING_EDGE  = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+BIAS_FLAGS = {
+    None:        0,
+    'pull_up':   GPIO_V2_LINE_FLAG_BIAS_PULL_UP,
+    'pull_down': GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN,
+    'disabled':  GPIO_V2_LINE_FLAG_BIAS_DISABLED,
+}
+
+# Events read from the kernel in one go
+READ_EVENTS = 16
+
+
+def chip_path(chip):
+    """ Get the device path of a GPIO chip given by number or path. """
+    return '/dev/gpiochip%d' % chip if isinstance(chip, int) else chip
+
+
+class GpioLines(object):
+    """
+    Edge events from a set of input lines on one GPIO chip, requested through
+    the character device.
+
+    The kernel timestamps each edge as it happens, in CLOCK_MONOTONIC, so the
+    timestamps are time.monotonic() values however late the event is read.
+    Events are read and handed to callback(offset, timestamp) on a thread of
+    our own, see start_thread(), or on an asyncio event loop, see attach().
+
+    The kernel queues events for a line request, so none are lost while a
+    callback runs unless the queue fills; missed counts those, from gaps in
+    the line sequence numbers.
+    """
+
+    def __init__(self, chip, offsets, callback, consumer='spi-lora', rising=True, falling=False, bias=None,
+                 debounce_us=None, event_buffer_size=0):
+        """
+        :param chip: GPIO chip number, or the path of its device
+        :param offsets: Line numbers on the chip. On a Raspberry Pi these are the BCM GPIO numbers.
+        :param callback: Function to call with the line number and time.monotonic() timestamp of each edge
+        :param consumer: Label for the lines, shown by gpioinfo
+        :param rising: Report rising edges
+        :param falling: Report falling edges
+        :param bias: None to leave the bias alone, or 'pull_up', 'pull_down' or 'disabled'
+        :param debounce_us: Dict of debounce periods in microseconds, by line number
+        :param event_buffer_size: Number of events the kernel queues, or 0 for its default
+        """
+        offsets = list(offsets)
+        if not 0 < len(offsets) <= GPIO_V2_LINES_MAX:
+            raise ValueError("Need 1 to %d lines" % GPIO_V2_LINES_MAX)
+        debounce_us = debounce_us or {}
+        if len(debounce_us) > GPIO_V2_LINE_NUM_ATTRS_MAX:
+            raise ValueError("At most %d lines can have a debounce period" % GPIO_V2_LINE_NUM_ATTRS_MAX)
+        self.offsets = offsets
+        self.callback = callback
+        self.events = 0
+        self.missed = 0
+        self._line_seqno = {}
+        self._loop = None
+        self._thread = None
+        self._wake = None
+
+        flags = GPIO_V2_LINE_FLAG_INPUT | BIAS_FLAGS[bias]
+        if rising:
+            flags |= GPIO_V2_LINE_FLAG_EDGE_RISING
+        if falling:
+            flags |= GPIO_V2_LINE_FLAG_EDGE_FALLING
+        attrs = []
+        for offset, period in sorted(debounce_us.items()):
+            # Each attribute applies to the lines set in its mask, which indexes into offsets
+            attrs += [GPIO_V2_LINE_ATTR_ID_DEBOUNCE, 0, period, 1 << offsets.index(offset)]
+        attrs += [0] * (4 * GPIO_V2_LINE_NUM_ATTRS_MAX - len(attrs))
+        request = bytearray(LINE_REQUEST.pack(*(offsets + [0] * (GPIO_V2_LINES_MAX - len(offsets)) +
+                                                [consumer.encode('utf-8')[:31], flags, len(debounce_us)] + [0] * 5 +
+                                                attrs + [len(offsets), event_buffer_size] + [0] * 5 + [-1])))
+        chip_fd = os.open(chip_path(chip), os.O_RDWR | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+        self.fd = LINE_REQUEST.unpack(request)[-1]
+        os.set_blocking(self.fd, False)
+        self._buffer = bytearray(LINE_EVENT.size * READ_EVENTS)
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """ Read the events waiting in the kernel and call the callback for each. Does not block.
+        :return: Number of events handled
+        :rtype: int
+        """
+        handled = 0
+        while True:
+            try:
+                count = os.readv(self.fd, [self._buffer])
+            except BlockingIOError:
+                return handled
+            for timestamp_ns, event_id, offset, seqno, line_seqno in LINE_EVENT.iter_unpack(self._buffer[:count]):
+                last = self._line_seqno.get(offset)
+                if last is not None and line_seqno > last + 1:
+                    self.missed += line_seqno - last - 1
+                self._line_seqno[offset] = line_seqno
+                self.events += 1
+                handled += 1
+                self.callback(offset, timestamp_ns / 1e9)
+            if count < len(self._buffer):
+                return handled
+
+    def start_thread(self, name='gpiochip-events'):
+        """ Read events and run the callback on a new daemon thread, which waits for them in epoll. """
+        assert self._thread is None and self._loop is None
+        self._wake = os.pipe()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def attach(self, loop):
+        """ Read events and run the callback on an asyncio event loop. Call from the loop's thread. """
+        assert self._thread is None and self._loop is None
+        self._loop = loop
+        loop.add_reader(self.fd, self.read_events)
+
+    def close(self):
+        """ Stop reading events and release the lines. """
+        if self._loop is not None:
+            self._loop.remove_reader(self.fd)
+            self._loop = None
+        if self._thread is not None:
+            os.write(self._wake[1], b'\0')
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            for fd in self._wake:
+                os.close(fd)
+            self._thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _run(self):
+        poll = select.epoll()
+        try:
+            poll.register(self.fd, select.EPOLLIN)
+            poll.register(self._wake[0], select.EPOLLIN)
+            while True:
+                try:
+                    ready = poll.poll()
+                except InterruptedError:
+                    continue
+                if any(fd == self._wake[0] for fd, _ in ready):
+                    return
+                self.read_events()
+        finally:
+            poll.close()
+
+
+class GpioChipBoard(BaseBoard):
+    """
+    Board mixin that watches the DIO lines through the GPIO character device
+    instead of RPi.GPIO, so it works on any Linux board and hands the on_
+    handlers the kernel's timestamp of each interrupt, in the driver's
+    irq_timestamp.
+
+    Put it first in the bases of a board with DIO0 .. DIO5 (and SWITCH) line
+    numbers, and leave those lines out of the board's own GPIO setup:
+
+        class BOARD(GpioChipBoard, Generic_RFM95W.BOARD):
+            GPIO_CHIP = 0
+            DIO0 = 22
+            DIO1 = 23
+
+    DIO callbacks run on a thread of their own, or on irq_loop if it is set to
+    an asyncio event loop before the driver is made. With AsyncLoRa, set it to
+    the running loop, so that the whole driver runs on the loop's thread.
+    """
+
+    GPIO_CHIP = 0                   # chip number, or the path of its device
+    DIO_BIAS = 'pull_down'
+    SWITCH_DEBOUNCE_US = 300000
+    irq_loop = None                 # asyncio event loop to run the DIO callbacks on, or None for a thread
+    irq_lines = None                # GpioLines, once add_events() has been called
+
+    @classmethod
+    def add_events(cls, cb_dio0, cb_dio1, cb_dio2, cb_dio3, cb_dio4, cb_dio5, switch_cb=None):
+        callbacks = {}
+        for n, callback in enumerate([cb_dio0, cb_dio1, cb_dio2, cb_dio3, cb_dio4, cb_dio5]):
+            offset = getattr(cls, 'DIO%d' % n, None)
+            if offset is not None:
+                callbacks[offset] = callback
+        debounce_us = {}
+        if switch_cb is not None and getattr(cls, 'SWITCH', None) is not None:
+            # RPi.GPIO calls switch callbacks with just the channel
+            callbacks[cls.SWITCH] = lambda channel, timestamp: switch_cb(channel)
+            debounce_us[cls.SWITCH] = cls.SWITCH_DEBOUNCE_US
+        if not callbacks:
+            raise RuntimeError("Board %s has no DIO lines" % cls.__name__)
+
+        def on_edge(offset, timestamp):
+            callbacks[offset](offset, timestamp)
+
+        cls.release_events()
+        cls.irq_lines = GpioLines(cls.GPIO_CHIP, sorted(callbacks), on_edge, bias=cls.DIO_BIAS,
+                                  debounce_us=debounce_us)
+        if cls.irq_loop is not None:
+            cls.irq_lines.attach(cls.irq_loop)
+        else:
+            cls.irq_lines.start_thread()
+
+    @classmethod
+    def release_events(cls):
+        """ Stop watching the DIO lines and release them. """
+        if cls.irq_lines is not None:
+            cls.irq_lines.close()
+            cls.irq_lines = None
+
+    @classmethod
+    def teardown(cls):
+        cls.release_events()
+        super(GpioChipBoard, cls).teardown()
@@ -0,0 +1,140 @@
+""" Defines ListenBeforeTalk, which checks the channel with CAD and RSSI before each transmission and backs off while it is busy. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import random
+import time
+
+from .constants import *
+from .stats import LatencyCounter
+
+
+class ChannelBusy(RuntimeError):
+    """ Raised when the channel stays busy for all the attempts of a ListenBeforeTalk. """
+
+
+class ListenBeforeTalk(object):
+    """
+    Listen-before-talk policy for GenericLoRa.transmit().
+
+    Each attempt runs CAD, which catches LoRa preambles with the current
+    spreading factor and bandwidth. If rssi_threshold is set, the attempt
+    also samples the RSSI in RX mode, which catches anything else loud on
+    the frequency. If the channel is busy, the next attempt comes after a
+    random back-off, drawn uniformly from zero up to slot seconds, doubled
+    for each busy attempt so far and capped at max_backoff.
+
+        lora.lbt = ListenBeforeTalk(rssi_threshold=-90)
+        lora.transmit(b'hello')
+
+    The counters show how often the channel was found busy, and how long
+    transmissions were held back, for comparing throughput with and without
+    LBT.
+    """
+
+    def __init__(self, rssi_threshold=None, max_attempts=8, slot=0.01, max_backoff=1., rssi_time=0.001,
+                 cad_timeout=1., rng=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rssi_threshold: Also call the channel busy when the RSSI is above this, in dBm. None to only use CAD.
+        :param max_attempts: Channel checks before giving up with ChannelBusy
+        :param slot: Longest back-off after the first busy check, in seconds
+        :param max_backoff: Longest back-off ever, in seconds
+        :param rssi_time: Seconds to stay in RX mode before reading the RSSI
+        :param cad_timeout: Seconds to wait for each CadDone
+        :param rng: random.Random to draw back-offs from
+        :param clock: Function giving the time in seconds
+        :param sleep: Function to wait a number of seconds
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.rssi_threshold = rssi_threshold
+        self.max_attempts = max_attempts
+        self.slot = slot
+        self.max_backoff = max_backoff
+        self.rssi_time = rssi_time
+        self.cad_timeout = cad_timeout
+        self.rng = rng if rng is not None else random.Random()
+        self.clock = clock
+        self.sleep = sleep
+        self.acquired = 0
+        self.gave_up = 0
+        self.checks = 0
+        self.busy_cad = 0
+        self.busy_rssi = 0
+        self.backoff_time = 0.
+        self.access_delay = LatencyCounter()    # from acquire() to a clear channel
+
+    def backoff(self, busy_count):
+        """ Draw the back-off after busy_count busy checks in a row.
+        :rtype: float
+        """
+        return self.rng.uniform(0, min(self.max_backoff, self.slot * 2 ** (busy_count - 1)))
+
+    def channel_clear(self, lora):
+        """ Check the channel once. Leaves the transceiver in STDBY mode.
+        :rtype: bool
+        """
+        self.checks += 1
+        if lora.cad(self.cad_timeout):
+            self.busy_cad += 1
+            return False
+        if self.rssi_threshold is not None:
+            lora.set_mode(MODE.RXCONT)
+            self.sleep(self.rssi_time)
+            rssi = lora.get_rssi_value()
+            lora.set_mode(MODE.STDBY)
+            if rssi > self.rssi_threshold:
+                self.busy_rssi += 1
+                return False
+        return True
+
+    def acquire(self, lora):
+        """ Wait until the channel is clear, backing off while it is busy.
+        :raises ChannelBusy: if it is busy for max_attempts checks
+        """
+        start = self.clock()
+        for attempt in range(1, self.max_attempts + 1):
+            if self.channel_clear(lora):
+                self.acquired += 1
+                self.access_delay.add(self.clock() - start)
+                return
+            if attempt < self.max_attempts:
+                delay = self.backoff(attempt)
+                self.backoff_time += delay
+                self.sleep(delay)
+        self.gave_up += 1
+        raise ChannelBusy("Channel busy for %d checks" % self.max_attempts)
+
+    def stats(self):
+        """ Get the channel check and back-off counters.
+        :rtype: dict
+        """
+        return dict(
+                acquired      = self.acquired,
+                gave_up       = self.gave_up,
+                checks        = self.checks,
+                busy_cad      = self.busy_cad,
+                busy_rssi     = self.busy_rssi,
+                busy_fraction = (self.busy_cad + self.busy_rssi) / float(self.checks) if self.checks else 0.,
+                backoff_time  = self.backoff_time,
+                access_delay  = self.access_delay.stats()
+            )
@@ -0,0 +1,333 @@
+""" SPI link checks: picking the fastest reliable SPI clock for a board, and watching for bit errors in use. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import collections
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from .cache import CACHEABLE_REGISTERS
+from .constants import MODE, REG
+from .stats import LatencyCounter
+
+
+# SPI clocks to try, slowest first. The SX127x is specified up to 10MHz.
+DEFAULT_SPEEDS = (1000000, 2000000, 4000000, 5000000, 6000000, 8000000, 10000000)
+
+# Bytes with every bit set, cleared and alternating, which show up stuck and crosstalking lines
+TEST_PATTERNS = (0x00, 0xFF, 0x55, 0xAA, 0x0F, 0xF0, 0x33, 0xCC)
+
+# How many FIFO bytes each test round writes and reads back
+TEST_LENGTH = 64
+
+# Where calibrate_board() keeps the speed it found for each board
+DEFAULT_SPEED_FILE = os.path.join(os.path.expanduser('~'), '.config', 'spi-lora', 'spi-speed.json')
+
+SpeedCalibration = collections.namedtuple('SpeedCalibration', ['speed', 'errors'])
+
+
+def _write(spi, register_address, values):
+    spi.xfer([register_address | 0x80] + list(values))
+
+
+def _read(spi, register_address, count):
+    return spi.xfer([register_address] + [0] * count)[1:]
+
+
+def link_errors(spi, rounds=8):
+    """ Write test patterns to the FIFO and SYNC_WORD at the connection's current clock, and read them back.
+    The modem must be in LoRa STDBY mode. The FIFO, FIFO_ADDR_PTR and SYNC_WORD are left holding test data.
+    :param spi: The SPI connection
+    :param rounds: Number of patterns to try
+    :return: Number of bytes that came back wrong
+    :rtype: int
+    """
+    errors = 0
+    for r in range(rounds):
+        # Alternate a fixed pattern with a sequence that moves every round, so each byte value goes through
+        pattern = [TEST_PATTERNS[(r + i) % len(TEST_PATTERNS)] if i % 2 == 0 else (i * 37 + r * 101) & 0xFF
+                   for i in range(TEST_LENGTH)]
+        _write(spi, REG.LORA.FIFO_ADDR_PTR, [0])
+        _write(spi, REG.LORA.FIFO, pattern)
+        _write(spi, REG.LORA.FIFO_ADDR_PTR, [0])
+        errors += sum(a != b for a, b in zip(_read(spi, REG.LORA.FIFO, TEST_LENGTH), pattern))
+        sync_word = TEST_PATTERNS[r % len(TEST_PATTERNS)]
+        _write(spi, REG.LORA.SYNC_WORD, [sync_word])
+        errors += _read(spi, REG.LORA.SYNC_WORD, 1) != [sync_word]
+    return errors
+
+
+def calibrate_speed(spi, speeds=DEFAULT_SPEEDS, rounds=8, margin=1):
+    """ Find the fastest SPI clock that the modem can be talked to at without errors.
+
+    Tries each speed in turn with link_errors(), up to the first one that
+    gives errors, and then backs off by margin speeds. The FIFO bytes used,
+    FIFO_ADDR_PTR, SYNC_WORD and the mode are put back afterwards, at the
+    slowest speed. A bit error in an address byte can write some other
+    register, so calibrate before configuring the modem, or resync() a
+    GenericLoRa afterwards.
+    :param spi: The SPI connection, with the modem in LoRa mode
+    :param speeds: Clocks to try in Hz, slowest first
+    :param rounds: Number of test patterns to try at each speed
+    :param margin: Number of speeds to back off from the fastest one without errors
+    :return: The chosen speed, which the connection is left at, and the number of bad bytes at each speed tried
+    :rtype: SpeedCalibration
+    :raises RuntimeError: if even the slowest speed gives errors
+    """
+    original_speed = spi.max_speed_hz
+    spi.max_speed_hz = speeds[0]
+    op_mode = _read(spi, REG.LORA.OP_MODE, 1)[0]
+    if not op_mode & 0x80:
+        spi.max_speed_hz = original_speed
+        raise RuntimeError("The modem must be in LoRa mode to calibrate the SPI clock")
+    # The FIFO can't be accessed in SLEEP mode
+    _write(spi, REG.LORA.OP_MODE, [MODE.STDBY])
+    fifo_addr_ptr, = _read(spi, REG.LORA.FIFO_ADDR_PTR, 1)
+    sync_word, = _read(spi, REG.LORA.SYNC_WORD, 1)
+    _write(spi, REG.LORA.FIFO_ADDR_PTR, [0])
+    fifo = _read(spi, REG.LORA.FIFO, TEST_LENGTH)
+    errors = collections.OrderedDict()
+    try:
+        for speed in speeds:
+            spi.max_speed_hz = speed
+            errors[speed] = link_errors(spi, rounds)
+            if errors[speed]:
+                break
+    finally:
+        spi.max_speed_hz = speeds[0]
+        _write(spi, REG.LORA.FIFO_ADDR_PTR, [0])
+        _write(spi, REG.LORA.FIFO, fifo)
+        _write(spi, REG.LORA.FIFO_ADDR_PTR, [fifo_addr_ptr])
+        _write(spi, REG.LORA.SYNC_WORD, [sync_word])
+        _write(spi, REG.LORA.OP_MODE, [op_mode])
+    good = sum(1 for e in errors.values() if e == 0)
+    if good == 0:
+        spi.max_speed_hz = original_speed
+        raise RuntimeError("SPI errors at %d Hz, the slowest speed tried" % speeds[0])
+    speed = speeds[max(good - 1 - margin, 0)]
+    spi.max_speed_hz = speed
+    return SpeedCalibration(speed, dict(errors))
+
+
+def _board_key(board):
+    return board.__module__ + '.' + board.__name__
+
+
+def load_speed(board, path=DEFAULT_SPEED_FILE):
+    """ Get the SPI clock saved for a board by calibrate_board().
+    :return: Speed in Hz, or None if there is none
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get(_board_key(board))
+    except FileNotFoundError:
+        return None
+
+
+def save_speed(board, speed, path=DEFAULT_SPEED_FILE):
+    """ Save the SPI clock for a board, keeping those of other boards. """
+    try:
+        with open(path) as f:
+            speeds = json.load(f)
+    except FileNotFoundError:
+        speeds = {}
+    speeds[_board_key(board)] = speed
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(speeds, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def apply_saved_speed(board, path=DEFAULT_SPEED_FILE):
+    """ Set a board's max_speed_hz to the speed saved for it, if there is one. Call before SpiDev().
+    :return: The speed, or None if there is none saved
+    """
+    speed = load_speed(board, path)
+    if speed is not None:
+        board.max_speed_hz = speed
+    return speed
+
+
+def calibrate_board(board, path=DEFAULT_SPEED_FILE, **kwargs):
+    """ Open a board's SPI connection, find its fastest reliable clock with calibrate_speed(), and set the board's
+    max_speed_hz to it.
+    :param board: The board class, already set up
+    :param path: File to save the speed in for apply_saved_speed(), or None to not save it
+    :return: The calibration result
+    :rtype: SpeedCalibration
+    """
+    calibration = calibrate_speed(board.SpiDev(), **kwargs)
+    board.max_speed_hz = calibration.speed
+    if path is not None:
+        save_speed(board, calibration.speed, path)
+    return calibration
+
+
+class LinkMonitor(object):
+    """
+    Checks that a GenericLoRa's configuration registers still hold what its
+    register cache says, so that SPI bit errors show up in stats() instead
+    of as a quietly misconfigured modem.
+
+    Each check() reads all the cacheable registers in one burst, bypassing
+    the cache, and compares a CRC of the values the cache knows with one of
+    what came back. On a mismatch the registers are read again. If the second
+    read agrees with the cache, the error was on the way back and counts as a
+    read error. Otherwise the modem's configuration really differs, which
+    counts as a config error, and the cached values are written back if
+    repair is on.
+
+        monitor = LinkMonitor(lora)
+        monitor.start(interval=10)
+        ...
+        print(monitor.stats())
+    """
+
+    def __init__(self, lora, repair=True, clock=time.perf_counter):
+        """
+        :param lora: A GenericLoRa made with cache_registers=True
+        :param repair: Write the cached values back to registers that differ
+        :param clock: Function giving the time in seconds, for the check latencies
+        """
+        if lora.register_cache is None:
+            raise ValueError("LinkMonitor needs a GenericLoRa with cache_registers=True")
+        self.lora = lora
+        self.repair = repair
+        self.clock = clock
+        self.first = min(CACHEABLE_REGISTERS)
+        self.count = max(CACHEABLE_REGISTERS) - self.first + 1
+        self.checks = 0
+        self.skipped = 0
+        self.read_errors = 0
+        self.config_errors = 0
+        self.repaired = 0
+        self.last_crc = None
+        self.by_register = collections.Counter()
+        self.latency = LatencyCounter()
+        self._stop = None
+        self._thread = None
+
+    def _differences(self, expected, actual):
+        return [a for a, v in expected if actual[a - self.first] != v]
+
+    def check(self):
+        """ Compare the configuration registers with the register cache once.
+        :return: True if they match, False if they didn't, or None if the check was skipped because the modem is not
+        in LoRa mode
+        """
+        lora = self.lora
+        with lora.atomic():
+            if not lora._lora_mode():
+                self.skipped += 1
+                return None
+            if lora._batch:
+                lora._flush_batch()
+            start = self.clock()
+            values = lora.register_cache.values
+            expected = [(a, values[a]) for a in sorted(CACHEABLE_REGISTERS) if values[a] is not None]
+            actual = _read(lora.spi, self.first, self.count)
+            self.last_crc = zlib.crc32(bytes(actual[a - self.first] for a, v in expected))
+            match = self.last_crc == zlib.crc32(bytes(v for a, v in expected))
+            if not match:
+                differences = self._differences(expected, _read(lora.spi, self.first, self.count))
+                if not differences:
+                    self.read_errors += 1
+                    self.by_register.update(REG.LORA.lookup[a] for a in self._differences(expected, actual))
+                else:
+                    self.config_errors += 1
+                    self.by_register.update(REG.LORA.lookup[a] for a in differences)
+                    if self.repair:
+                        for a in differences:
+                            _write(lora.spi, a, [values[a]])
+                        self.repaired += len(differences)
+            self.checks += 1
+            self.latency.add(self.clock() - start)
+            return match
+
+    def start(self, interval=10.):
+        """ Run check() every interval seconds on a daemon thread. """
+        assert self._thread is None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='spi-link-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the thread started by start(). """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.check()
+
+    def stats(self):
+        return dict(
+                checks        = self.checks,
+                skipped       = self.skipped,
+                read_errors   = self.read_errors,
+                config_errors = self.config_errors,
+                repaired      = self.repaired,
+                by_register   = dict(self.by_register),
+                latency       = self.latency.stats()
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the fastest SPI clock a board's modem works at without errors, "
+                                                 "and save it for apply_saved_speed(). Prints a JSON report.")
+    parser.add_argument('--board', dest='board', required=True, type=str,
+                        help="Board module in spi_lora.boards, e.g. Generic_RFM95W")
+    parser.add_argument('--rounds', '-n', dest='rounds', default=8, type=int,
+                        help="Test patterns to try at each speed. Default is 8.")
+    parser.add_argument('--margin', dest='margin', default=1, type=int,
+                        help="Speeds to back off from the fastest one without errors. Default is 1.")
+    parser.add_argument('--file', dest='path', default=DEFAULT_SPEED_FILE, type=str,
+                        help="File to save the speed in. Default is %s." % DEFAULT_SPEED_FILE)
+    args = parser.parse_args(argv)
+
+    board = importlib.import_module('spi_lora.boards.' + args.board).BOARD
+    board.setup()
+    try:
+        # Start from reset, and switch to LoRa mode, which calibrate_speed() needs
+        board.reset()
+        spi = board.SpiDev()
+        spi.max_speed_hz = DEFAULT_SPEEDS[0]
+        _write(spi, REG.LORA.OP_MODE, [MODE.SLEEP & 0x7F])
+        _write(spi, REG.LORA.OP_MODE, [MODE.SLEEP])
+        calibration = calibrate_speed(spi, rounds=args.rounds, margin=args.margin)
+        save_speed(board, calibration.speed, args.path)
+    finally:
+        board.teardown()
+    json.dump(dict(board=_board_key(board), speed=calibration.speed, errors=calibration.errors), sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+""" Defines InstrumentedLock, a re-entrant lock that keeps count of its contention and hold times. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+
+from .stats import LatencyCounter
+
+
+class InstrumentedLock(object):
+    """
+    A re-entrant lock, like threading.RLock, that counts how often it was
+    taken and how often a thread had to wait for it, and keeps the wait
+    times and the hold times of the outermost acquisitions.
+
+        with lock:
+            ...
+        lock.stats()
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        :param clock: Function giving the time in seconds
+        """
+        self.clock = clock
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = LatencyCounter()
+        self.hold = LatencyCounter()
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._held_since = 0.
+
+    def acquire(self):
+        if not self._lock.acquire(False):
+            start = self.clock()
+            self._lock.acquire()
+            self.contended += 1
+            self.wait.add(self.clock() - start)
+        self._depth += 1
+        if self._depth == 1:
+            self.acquisitions += 1
+            self._held_since = self.clock()
+        return self
+
+    def release(self):
+        self._depth -= 1
+        if not self._depth:
+            self.hold.add(self.clock() - self._held_since)
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def stats(self):
+        """ Get the acquisition and contention counters, and the wait and hold times.
+        :rtype: dict
+        """
+        return dict(
+                acquisitions = self.acquisitions,
+                contended    = self.contended,
+                contention   = self.contended / float(self.acquisitions) if self.acquisitions else 0.,
+                wait         = self.wait.stats(),
+                hold         = self.hold.stats()
+            )
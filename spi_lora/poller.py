@@ -0,0 +1,174 @@
+""" Defines IrqPoller, which polls the IRQ flags of a modem without DIO lines at a rate that follows what it is doing. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from .constants import *
+from .stats import LatencyCounter
+
+
+# MODEM_STAT bits that mean a packet is coming in, so RxDone is due within one time on air
+MODEM_STAT_RX_BUSY = 0b00000111     # RX on-going, signal synchronized, signal detected
+
+# Transceiver modes that end with an IRQ (TxDone or CadDone) and drop back to STDBY by themselves
+JOB_MODES = (MODE.TX, MODE.CAD)
+
+IRQ_PACKET = 1 << MASK.IRQ_FLAGS.RxDone | 1 << MASK.IRQ_FLAGS.TxDone
+
+
+class IrqPoller(object):
+    """
+    Calls handle_irq_flags() on a GenericLoRa whose board has no DIO lines,
+    polling fast only while something is about to happen.
+
+    Each poll reads IRQ_FLAGS through MODEM_STAT (0x12 .. 0x18) in one burst.
+    While the modem reports a signal or a packet coming in, while a TX or CAD
+    is in flight, and right after an IRQ, the next poll is latency_target
+    seconds away. Otherwise the interval grows by the backoff factor with every
+    quiet poll, up to max_interval. Keep max_interval below the time on air of
+    the shortest expected packet, so that every packet is seen coming in and
+    the poller tightens before its RxDone.
+
+    The CPU time each poll takes is measured, and the interval never drops
+    below what keeps polling within cpu_budget of one CPU.
+
+        poller = IrqPoller(lora)
+        poller.run()                        # or: sleep(poller.poll()) in your own loop
+    """
+
+    def __init__(self, lora, latency_target=0.005, max_interval=0.1, backoff=1.5, cpu_budget=0.05,
+                 clock=time.monotonic, sleep=time.sleep, cpu_clock=time.thread_time):
+        """
+        :param lora: The GenericLoRa object to poll
+        :param latency_target: Seconds between polls while an IRQ is expected
+        :param max_interval: Longest time between polls when the modem is idle, in seconds
+        :param backoff: Factor the interval grows by with each poll that finds nothing going on
+        :param cpu_budget: Fraction of one CPU that polling may use, or None for no limit
+        :param clock: Wall clock function, in seconds
+        :param sleep: Function to wait a number of seconds, used by run()
+        :param cpu_clock: CPU time function, in seconds
+        """
+        if not 0 < latency_target <= max_interval:
+            raise ValueError("latency_target must be positive and no more than max_interval")
+        if backoff < 1:
+            raise ValueError("backoff must be at least 1")
+        self.lora = lora
+        self.latency_target = latency_target
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.cpu_budget = cpu_budget
+        self.clock = clock
+        self.sleep = sleep
+        self.cpu_clock = cpu_clock
+        self.interval = latency_target
+        self.polls = 0
+        self.active_polls = 0
+        self.irqs = 0
+        self.packets = 0                        # RxDone and TxDone IRQs handled
+        self.cpu_time = 0.                      # spent in poll(), handlers included
+        self.poll_cost = None                   # moving average of the CPU time of one poll, handlers excluded
+        self.latency = LatencyCounter()         # upper bound on the time from each IRQ to its handling
+        self._started = None
+        self._last_poll = None
+
+    def poll(self):
+        """ Poll the IRQ flags once, handle any that are set, and work out when to poll next.
+        :return: Seconds to wait before the next poll
+        :rtype: float
+        """
+        start_cpu = self.cpu_clock()
+        now = self.clock()
+        if self._started is None:
+            self._started = now
+        lora = self.lora
+        r = lora.get_registers(REG.LORA.IRQ_FLAGS, REG.LORA.MODEM_STAT - REG.LORA.IRQ_FLAGS + 1)
+        irq_flags = r[0]
+        if irq_flags:
+            active = True
+        elif r[REG.LORA.MODEM_STAT - REG.LORA.IRQ_FLAGS] & MODEM_STAT_RX_BUSY:
+            active = True
+        elif lora.mode in JOB_MODES:
+            # The driver's mode stays TX or CAD after the job is done, until someone sets another, so ask the modem
+            active = lora.get_register(REG.LORA.OP_MODE) == lora.mode
+        else:
+            active = False
+        cost = self.cpu_clock() - start_cpu
+        self.poll_cost = cost if self.poll_cost is None else .9 * self.poll_cost + .1 * cost
+
+        self.polls += 1
+        if irq_flags:
+            self.irqs += 1
+            if irq_flags & IRQ_PACKET:
+                self.packets += 1
+            if self._last_poll is not None:
+                # The IRQ came some time after the last poll finished
+                self.latency.add(now - self._last_poll)
+            lora.handle_irq_flags(irq_flags)
+
+        if active:
+            self.active_polls += 1
+            self.interval = self.latency_target
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        if self.cpu_budget:
+            self.interval = max(self.interval, self.poll_cost / self.cpu_budget)
+        self.cpu_time += self.cpu_clock() - start_cpu
+        self._last_poll = self.clock()
+        return self.interval
+
+    def run(self, until=None, timeout=None):
+        """ Poll and sleep in a loop.
+        :param until: Function to call after each poll; stop when it returns True
+        :param timeout: Stop after this many seconds, or None to run forever
+        :return: True if until() stopped the loop, False if the timeout did
+        :rtype: bool
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            interval = self.poll()
+            if until is not None and until():
+                return True
+            if deadline is not None:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            self.sleep(interval)
+
+    def stats(self):
+        """ Get the poll counters, measured IRQ latency and CPU use.
+        :rtype: dict
+        """
+        elapsed = self._last_poll - self._started if self.polls else 0.
+        return dict(
+                polls          = self.polls,
+                active_polls   = self.active_polls,
+                irqs           = self.irqs,
+                packets        = self.packets,
+                interval       = self.interval,
+                poll_cost      = self.poll_cost,
+                cpu_time       = self.cpu_time,
+                cpu_fraction   = self.cpu_time / elapsed if elapsed else 0.,
+                cpu_per_packet = self.cpu_time / self.packets if self.packets else None,
+                latency        = self.latency.stats()
+            )
@@ -0,0 +1,210 @@
+""" Defines RadioPool, which drives several modems from one asyncio event loop. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import time
+
+from .AsyncLoRa import AsyncLoRa
+from .LoRa import LoRa
+
+
+# A packet from the merged receive stream: the index of the radio that got it, and the LoRa.RxPacket
+PoolPacket = collections.namedtuple('PoolPacket', ['radio', 'packet'])
+
+
+class PoolRadio(object):
+    """ One modem in a RadioPool, with its AsyncLoRa and counters. """
+
+    def __init__(self, index, radio):
+        self.index = index
+        self.radio = radio
+        self.task = None            # forwards received packets to the pool
+        self.tx_pending = 0         # sends given to this radio and not finished yet
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        self.tx_airtime = 0.
+        self.tx_errors = 0
+        self.rx_packets = 0
+        self.rx_bytes = 0
+
+    @property
+    def lora(self):
+        return self.radio.lora
+
+    def stats(self, elapsed):
+        return dict(
+                tx_pending     = self.tx_pending,
+                tx_packets     = self.tx_packets,
+                tx_bytes       = self.tx_bytes,
+                tx_airtime     = self.tx_airtime,
+                tx_errors      = self.tx_errors,
+                rx_packets     = self.rx_packets,
+                rx_bytes       = self.rx_bytes,
+                rx_dropped     = self.radio.rx_dropped,
+                tx_rate        = self.tx_packets / elapsed if elapsed else 0.,
+                rx_rate        = self.rx_packets / elapsed if elapsed else 0.,
+                tx_bytes_per_s = self.tx_bytes / elapsed if elapsed else 0.,
+                rx_bytes_per_s = self.rx_bytes / elapsed if elapsed else 0.
+            )
+
+
+class RadioPool(object):
+    """
+    Several GenericLoRa modems, each on its own SPI connection and DIO lines,
+    driven from one asyncio event loop through an AsyncLoRa each.
+
+    Packets received by any of the radios come out of one merged stream,
+    tagged with the radio they came in on. send() hands each packet to the
+    radio with the fewest sends in progress, and among those, the one that
+    has spent the least time on the air.
+
+        boards = [BOARD.derive(spi_cs=cs) for cs in (0, 1)]
+        async with RadioPool.from_boards(boards) as pool:
+            await pool.send(b'hello')
+            async for radio, packet in pool:
+                ...
+
+    Give each radio its own board class, e.g. from BaseBoard.derive(), since
+    boards keep their SPI connection in a class attribute.
+    """
+
+    def __init__(self, loras, rx_queue_size=256, poll_interval=0.01, clock=time.monotonic):
+        """
+        :param loras: The GenericLoRa objects, already configured
+        :param rx_queue_size: Number of received packets to hold. When full, the oldest packet is dropped.
+        :param poll_interval: Longest time between IRQ flag polls, for radios without IRQ events
+        :param clock: Function giving the time in seconds, for the rates in stats()
+        """
+        self.radios = [PoolRadio(i, AsyncLoRa(lora, poll_interval=poll_interval)) for i, lora in enumerate(loras)]
+        if not self.radios:
+            raise ValueError("A RadioPool needs at least one radio")
+        self.rx_queue_size = rx_queue_size
+        self.clock = clock
+        self.rx_dropped = 0
+        self.started = None
+        self._rx_queue = None
+
+    @classmethod
+    def from_boards(cls, boards, cache_registers=False, **kwargs):
+        """ Make a pool with a LoRa for each board.
+        :param boards: BaseBoard subclasses, one per modem
+        :param cache_registers: Enable the register cache of each LoRa
+        :param kwargs: Passed on to RadioPool()
+        :rtype: RadioPool
+        """
+        return cls([LoRa(board, verbose=False, cache_registers=cache_registers) for board in boards], **kwargs)
+
+    def __len__(self):
+        return len(self.radios)
+
+    async def start(self, listen=True):
+        """ Hook up all the modems to the running event loop.
+        :param listen: If True, keep each modem receiving whenever it is not transmitting
+        """
+        self._rx_queue = asyncio.Queue(self.rx_queue_size)
+        for radio in self.radios:
+            await radio.radio.start(listen=listen)
+            radio.task = asyncio.ensure_future(self._forward(radio))
+        self.started = self.clock()
+
+    async def close(self):
+        """ Stop driving the modems and put them to sleep. """
+        for radio in self.radios:
+            if radio.task is not None:
+                radio.task.cancel()
+                await asyncio.gather(radio.task, return_exceptions=True)
+                radio.task = None
+            await radio.radio.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def pick(self):
+        """ Choose the radio for the next send.
+        :rtype: PoolRadio
+        """
+        return min(self.radios, key=lambda r: (r.tx_pending, r.tx_airtime, r.index))
+
+    async def send(self, payload, timeout=None):
+        """ Transmit a packet on the least loaded radio and wait for the transmission to finish.
+        :param payload: Payload (bytes or list of ints)
+        :param timeout: Seconds to wait for TxDone, or None to wait forever
+        :return: Index of the radio that sent it
+        :rtype: int
+        """
+        radio = self.pick()
+        radio.tx_pending += 1
+        try:
+            await radio.radio.send(payload, timeout)
+        except Exception:
+            radio.tx_errors += 1
+            raise
+        finally:
+            radio.tx_pending -= 1
+        radio.tx_packets += 1
+        radio.tx_bytes += len(payload)
+        radio.tx_airtime += radio.lora.time_on_air(len(payload))
+        return radio.index
+
+    async def receive(self, timeout=None):
+        """ Wait for a packet from any of the radios.
+        :param timeout: Seconds to wait, or None to wait forever
+        :rtype: PoolPacket
+        :raises asyncio.TimeoutError: if no packet arrives in time
+        """
+        return await asyncio.wait_for(self._rx_queue.get(), timeout)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._rx_queue.get()
+
+    async def _forward(self, radio):
+        async for packet in radio.radio:
+            radio.rx_packets += 1
+            radio.rx_bytes += len(packet.payload)
+            if self._rx_queue.full():
+                self._rx_queue.get_nowait()
+                self.rx_dropped += 1
+            self._rx_queue.put_nowait(PoolPacket(radio.index, packet))
+
+    def stats(self):
+        """ Get the counters and rates of each radio, and their totals.
+        :rtype: dict
+        """
+        elapsed = self.clock() - self.started if self.started is not None else 0.
+        radios = [radio.stats(elapsed) for radio in self.radios]
+        total = {key: sum(r[key] for r in radios) for key in radios[0]}
+        total['rx_dropped'] += self.rx_dropped
+        return dict(
+                elapsed        = elapsed,
+                rx_queue_depth = self._rx_queue.qsize() if self._rx_queue is not None else 0,
+                total          = total,
+                radios         = radios
+            )
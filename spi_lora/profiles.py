@@ -0,0 +1,131 @@
+""" Defines RadioProfile, a complete modem configuration compiled into a register image, and some common profiles. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+from .constants import *
+from .LoRa import encode_freq, encode_ocp_trim
+from .status import parse_register_dump
+
+
+# The registers a profile sets. They form four runs of consecutive addresses, so a profile goes out in four bursts.
+PROFILE_REGISTERS = (
+    REG.LORA.FR_MSB, REG.LORA.FR_MID, REG.LORA.FR_LSB, REG.LORA.PA_CONFIG, REG.LORA.PA_RAMP, REG.LORA.OCP,
+    REG.LORA.LNA,
+    REG.LORA.MODEM_CONFIG_1, REG.LORA.MODEM_CONFIG_2, REG.LORA.SYMB_TIMEOUT_LSB, REG.LORA.PREAMBLE_MSB,
+    REG.LORA.PREAMBLE_LSB,
+    REG.LORA.MODEM_CONFIG_3,
+    REG.LORA.SYNC_WORD,
+)
+
+
+class RadioProfile(object):
+    """
+    A modem configuration, held as the exact values of the registers it sets.
+
+    Build one from settings with RadioProfile.compile(), or read one from a
+    register dump file with RadioProfile.load(). Apply it with
+    GenericLoRa.apply_profile().
+    """
+
+    def __init__(self, registers, name=None):
+        """
+        :param registers: Dict from register address to value
+        :param name: Name for display purposes
+        """
+        self.registers = dict(registers)
+        self.name = name
+        # Precompute the bursts, so applying the profile does no work beyond the transfers themselves
+        self.bursts = []
+        for address in sorted(self.registers):
+            if self.bursts and self.bursts[-1][0] + len(self.bursts[-1][1]) == address:
+                self.bursts[-1][1].append(self.registers[address])
+            else:
+                self.bursts.append((address, [self.registers[address]]))
+
+    @classmethod
+    def compile(cls, freq, bw=BW.BW125, coding_rate=CODING_RATE.CR4_5, spreading_factor=7,
+                implicit_header_mode=False, rx_crc=True, low_data_rate_optim=None, agc_auto_on=True, preamble=8,
+                symb_timeout=0x64, sync_word=0x12, pa_select=PA_SELECT.PA_BOOST, max_power=0x07, output_power=0x0F,
+                pa_ramp=PA_RAMP.RAMP_40_us, ocp_on=True, ocp_trim=100, lna_gain=GAIN.G1, lna_boost_lf=0b00,
+                lna_boost_hf=0b00, name=None):
+        """ Compile modem settings into a profile. The parameters mean the same as for the GenericLoRa setters.
+        :param freq: Frequency in MHz
+        :param low_data_rate_optim: If None, turn it on when a symbol lasts longer than 16 ms, as the datasheet
+        recommends.
+        :param ocp_trim: Over current protection limit in mA (45 .. 240 mA)
+        :rtype: RadioProfile
+        """
+        assert spreading_factor >= 6 and spreading_factor <= 12
+        assert lna_boost_hf == 0b00 or lna_boost_hf == 0b11
+        if low_data_rate_optim is None:
+            low_data_rate_optim = (1 << spreading_factor) / BANDWIDTH_HZ[bw] > 0.016
+        msb, mid, lsb = encode_freq(freq)
+        registers = {
+            REG.LORA.FR_MSB:           msb,
+            REG.LORA.FR_MID:           mid,
+            REG.LORA.FR_LSB:           lsb,
+            REG.LORA.PA_CONFIG:        pa_select << 7 | max_power << 4 | output_power,
+            REG.LORA.PA_RAMP:          pa_ramp & 0b1111,
+            REG.LORA.OCP:              bool(ocp_on) << 5 | encode_ocp_trim(ocp_trim),
+            REG.LORA.LNA:              lna_gain << 5 | lna_boost_lf << 3 | lna_boost_hf,
+            REG.LORA.MODEM_CONFIG_1:   bw << 4 | coding_rate << 1 | bool(implicit_header_mode),
+            REG.LORA.MODEM_CONFIG_2:   spreading_factor << 4 | bool(rx_crc) << 2 | symb_timeout >> 8 & 0b11,
+            REG.LORA.SYMB_TIMEOUT_LSB: symb_timeout & 0xFF,
+            REG.LORA.PREAMBLE_MSB:     preamble >> 8,
+            REG.LORA.PREAMBLE_LSB:     preamble & 0xFF,
+            REG.LORA.MODEM_CONFIG_3:   bool(low_data_rate_optim) << 3 | bool(agc_auto_on) << 2,
+            REG.LORA.SYNC_WORD:        sync_word,
+        }
+        return cls(registers, name=name)
+
+    @classmethod
+    def load(cls, dump_file, name=None):
+        """ Read a profile from a file in the register dump format of lora_util.py --dump. Registers in the file that
+        a profile does not set, such as OP_MODE or the IRQ flags, are ignored.
+        :param dump_file: Open file to read
+        :rtype: RadioProfile
+        """
+        registers = {a: v for a, v in parse_register_dump(dump_file) if a in PROFILE_REGISTERS}
+        return cls(registers, name=name or getattr(dump_file, 'name', None))
+
+    def save(self, dump_file):
+        """ Write the profile to a file in the register dump format of lora_util.py --dump.
+        :param dump_file: Open file to write
+        """
+        dump_file.write("%02s %18s %2s %8s\n" % ('i', 'reg_name', 'v', 'v'))
+        dump_file.write("-- ------------------ -- --------\n")
+        for reg_i in sorted(self.registers):
+            val = self.registers[reg_i]
+            dump_file.write("%02X %18s %02X %s\n" % (reg_i, REG.LORA.lookup[reg_i], val, format(val, '#010b')[2:]))
+
+    def __eq__(self, other):
+        return isinstance(other, RadioProfile) and self.registers == other.registers
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "RadioProfile(%s)" % (self.name or self.registers)
+
+
+EU868_SF7BW125 = RadioProfile.compile(868.1, bw=BW.BW125, spreading_factor=7, name='EU868_SF7BW125')
+EU868_SF12BW125 = RadioProfile.compile(868.1, bw=BW.BW125, spreading_factor=12, name='EU868_SF12BW125')
+US915_SF10BW500 = RadioProfile.compile(903.0, bw=BW.BW500, spreading_factor=10, name='US915_SF10BW500')
@@ -0,0 +1,276 @@
+""" Records a live driver session to a trace file and replays it as a fake SPI connection, without a modem. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import collections
+
+from .boards import BaseBoard
+from .trace import FileSink, TracingSpi, dio_trace, read_trace_file
+
+
+class Recorder(object):
+    """
+    Records a driver session, SPI transfers with their data and DIO interrupts, to a trace file for ReplaySpi.
+
+    To record from power-up, so that the replay can re-run the driver from
+    its constructor, wrap the board:
+
+        recorder = Recorder(open('session.trace', 'wb'))
+        lora = LoRa(recorder.board(BOARD))
+
+    Or record an already running driver object with recorder.attach(lora);
+    DIO interrupts are not recorded then.
+    """
+
+    def __init__(self, trace_file):
+        """
+        :param trace_file: File opened for binary writing
+        """
+        self.sink = FileSink(trace_file)
+        self.tracer = None
+
+    def attach(self, lora):
+        """ Record the SPI transfers of a GenericLoRa from now on.
+        :return: The TracingSpi that records them
+        """
+        self.tracer = TracingSpi(lora.spi, [self.sink], capture_data=True)
+        lora.spi = self.tracer
+        return self.tracer
+
+    def board(self, board):
+        """ Wrap a board class so that a driver made with it is recorded, including its DIO interrupts.
+        :param board: BaseBoard subclass
+        :return: BaseBoard subclass to use instead
+        """
+        recorder = self
+
+        class RecordingBoard(board):
+
+            @classmethod
+            def SpiDev(cls, *args, **kwargs):
+                recorder.tracer = TracingSpi(board.SpiDev(*args, **kwargs), [recorder.sink], capture_data=True)
+                return recorder.tracer
+
+            @classmethod
+            def add_events(cls, *callbacks, **kwargs):
+                board.add_events(*[recorder._recording_callback(n, cb) for n, cb in enumerate(callbacks)], **kwargs)
+
+        if getattr(board, 'add_events', None) is None:
+            del RecordingBoard.add_events
+        return RecordingBoard
+
+    def dio(self, dio_number):
+        """ Record an interrupt on a DIO line. """
+        self.sink(dio_trace(dio_number))
+
+    def _recording_callback(self, dio_number, callback):
+        def on_dio(channel, *args):
+            self.dio(dio_number)
+            return callback(channel, *args)
+        return on_dio
+
+    def stop(self):
+        """ Stop recording. The driver keeps working through the recording wrapper. """
+        if self.tracer is not None:
+            self.tracer.sinks.remove(self.sink)
+            self.tracer.disable()
+
+    def close(self):
+        """ Stop recording and close the trace file. """
+        self.stop()
+        self.sink.close()
+
+
+class ReplayDivergence(RuntimeError):
+    """ Raised by a strict ReplaySpi when the driver does something other than what was recorded. """
+    pass
+
+
+# A transfer that did not match the trace. index is the position in the trace where it was expected, expected is the
+# SpiTrace there, and mosi is what the driver actually sent.
+Divergence = collections.namedtuple('Divergence', ['index', 'expected', 'mosi'])
+
+
+class ReplaySpi(object):
+    """
+    Plays back a recorded trace as an SPI connection.
+
+    Each transfer is checked against the next recorded one, and gets the
+    recorded reply. Recorded DIO interrupts are delivered to the functions
+    given to add_events() at the point in the sequence where they happened:
+    before the transfer that followed them, or from pump() when the
+    application is just waiting for interrupts. Nothing waits for real time,
+    so a session replays as fast as the driver can run.
+
+    A transfer that does not match the trace is recorded in divergences, or
+    raises ReplayDivergence if strict is set. The replay then tries to get
+    back in step by looking a little way ahead for a matching transfer.
+    Transfers after the end of the trace, such as the driver putting the
+    modem to sleep when it is garbage collected, are only counted in overrun.
+
+        replay = ReplaySpi.load(open('session.trace', 'rb'))
+        lora = LoRa(replay.board(), verbose=False)
+        replay.run()
+        assert not replay.divergences
+    """
+
+    max_speed_hz = 5000000
+    mode = 0
+    bits_per_word = 8
+
+    # How far ahead to look for a matching transfer after a divergence
+    RESYNC_WINDOW = 16
+
+    def __init__(self, traces, strict=False):
+        """
+        :param traces: Iterable of trace.SpiTrace, recorded with data
+        :param strict: Raise ReplayDivergence on the first divergence
+        """
+        self.traces = list(traces)
+        self.strict = strict
+        self.position = 0
+        self.divergences = []
+        self.overrun = 0
+        self.dio_callbacks = [None] * 6
+        self._in_dio = False
+
+    @classmethod
+    def load(cls, trace_file, strict=False):
+        """ Read a trace file written by Recorder.
+        :param trace_file: File opened for binary reading
+        :rtype: ReplaySpi
+        """
+        return cls(read_trace_file(trace_file), strict=strict)
+
+    def board(self, low_band=False):
+        """ Make a board class to pass to LoRa(), whose SpiDev() is this replay.
+        :param low_band: Band of the recorded modem
+        """
+        replay = self
+
+        class ReplayBoard(BaseBoard):
+
+            @classmethod
+            def SpiDev(cls, spi_bus=None, spi_cs=None):
+                return replay
+
+            @classmethod
+            def add_events(cls, *callbacks, **kwargs):
+                replay.add_events(*callbacks)
+
+        ReplayBoard.low_band = low_band
+        return ReplayBoard
+
+    @property
+    def done(self):
+        """ Whether the whole trace has been played. """
+        return self.position >= len(self.traces)
+
+    def add_events(self, *callbacks):
+        for i, callback in enumerate(callbacks[:6]):
+            self.dio_callbacks[i] = callback
+
+    def pump(self):
+        """ Deliver the DIO interrupts that come next in the trace.
+        :return: Number of interrupts delivered
+        """
+        delivered = 0
+        while not self._in_dio and not self.done and self.traces[self.position].direction == 'D':
+            trace = self.traces[self.position]
+            self.position += 1
+            callback = self.dio_callbacks[trace.address]
+            if callback is not None:
+                self._in_dio = True
+                try:
+                    callback(trace.address)
+                finally:
+                    self._in_dio = False
+                delivered += 1
+        return delivered
+
+    def run(self):
+        """ Deliver interrupts until the trace is done, or until the next thing in it is a transfer that the
+        application, rather than an interrupt handler, has to make.
+        :return: Number of interrupts delivered
+        """
+        delivered = 0
+        while True:
+            count = self.pump()
+            if count == 0:
+                return delivered
+            delivered += count
+
+    # The spidev interface
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer(self, data, *args):
+        return list(self._transfer(bytes(data)))
+
+    xfer2 = xfer
+
+    def xfer3(self, data, *args):
+        return tuple(self._transfer(bytes(data)))
+
+    def writebytes2(self, data):
+        self._transfer(bytes(data))
+
+    def _transfer(self, mosi):
+        self.pump()
+        if self.done:
+            self.overrun += 1
+            return bytes(len(mosi))
+        index = self._find(mosi)
+        if index is None:
+            self._diverge(mosi)
+            return bytes(len(mosi))
+        if index != self.position:
+            self._diverge(mosi)
+        self.position = index + 1
+        trace = self.traces[index]
+        return trace.miso if trace.miso is not None else bytes(len(mosi))
+
+    def _matches(self, trace, mosi):
+        if trace.direction == 'D' or trace.mosi is None or trace.length != len(mosi) - 1:
+            return False
+        if trace.direction == 'W':
+            return trace.mosi == mosi
+        return trace.mosi[0] == mosi[0]
+
+    def _find(self, mosi):
+        """ Find the recorded transfer that matches mosi, at or shortly after the current position. """
+        for index in range(self.position, min(self.position + self.RESYNC_WINDOW, len(self.traces))):
+            if self._matches(self.traces[index], mosi):
+                return index
+        return None
+
+    def _diverge(self, mosi):
+        expected = self.traces[self.position]
+        divergence = Divergence(self.position, expected, mosi)
+        if self.strict:
+            raise ReplayDivergence("Transfer %s at trace position %d does not match the recorded %s" %
+                                   (mosi.hex(), self.position, expected))
+        self.divergences.append(divergence)
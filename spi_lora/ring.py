@@ -0,0 +1,158 @@
+""" Defines PacketRing, a bounded buffer that passes received packets from the IRQ handler to the application. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+
+
+# What PacketRing.push() does when the ring is full
+DROP_OLDEST = 'drop_oldest'     # overwrite the oldest packet, so the consumer always sees the newest ones
+DROP_NEWEST = 'drop_newest'     # discard the packet being pushed, so the consumer sees an unbroken run of old ones
+
+
+class PacketRing(object):
+    """
+    Fixed size ring buffer for one producer thread and one consumer thread.
+
+    The producer (normally the IRQ handler of GenericLoRa) and the consumer
+    never take a lock; each only advances its own counter, and the GIL makes
+    the slot stores atomic. With DROP_OLDEST the producer writes over unread
+    slots, and the consumer notices that it was lapped and skips ahead. Each
+    slot also holds the sequence number of its packet, which the consumer
+    checks after reading the packet, so a slot that was overwritten meanwhile
+    is skipped instead of returning a newer packet out of order.
+
+    Consumers in other threads can block in get(). An asyncio task can set
+    notify to a function that wakes it, e.g. one that calls
+    loop.call_soon_threadsafe(); it is called on the producer thread after
+    every push.
+    """
+
+    def __init__(self, capacity=64, overflow=DROP_OLDEST, notify=None):
+        """
+        :param capacity: Number of packets to hold
+        :param overflow: DROP_OLDEST or DROP_NEWEST
+        :param notify: Function to call after each push, or None
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown overflow policy %r" % (overflow,))
+        self.capacity = capacity
+        self.overflow = overflow
+        self.notify = notify
+        self._slots = [None] * capacity
+        self._seqs = [-1] * capacity   # sequence number of the packet in each slot, -1 while it is being written
+        self._head = 0              # number of packets ever stored; only the producer changes it
+        self._tail = 0              # number of packets consumed or skipped; only the consumer changes it
+        self._ready = threading.Event()
+        self.pushed = 0
+        self.dropped_newest = 0     # packets push() refused under DROP_NEWEST
+        self.dropped_oldest = 0     # packets overwritten before they were read under DROP_OLDEST
+
+    @property
+    def dropped(self):
+        return self.dropped_newest + self.dropped_oldest
+
+    def __len__(self):
+        return min(self._head - self._tail, self.capacity)
+
+    def push(self, packet):
+        """ Store a packet. Only call this from the producer thread.
+        :return: False if the packet was dropped
+        :rtype: bool
+        """
+        head = self._head
+        if head - self._tail >= self.capacity and self.overflow == DROP_NEWEST:
+            self.dropped_newest += 1
+            return False
+        index = head % self.capacity
+        self._seqs[index] = -1
+        self._slots[index] = packet
+        self._seqs[index] = head
+        self._head = head + 1
+        self.pushed += 1
+        self._ready.set()
+        if self.notify is not None:
+            self.notify()
+        return True
+
+    def get_nowait(self):
+        """ Take the oldest packet. Only call this from the consumer thread.
+        :return: The packet, or None if the ring is empty
+        """
+        tail = self._tail
+        while True:
+            head = self._head
+            if head == tail:
+                return None
+            if head - tail > self.capacity:
+                # Lapped by the producer; the slots we had not read yet were overwritten
+                self.dropped_oldest += head - tail - self.capacity
+                tail = head - self.capacity
+            index = tail % self.capacity
+            packet = self._slots[index]
+            if self._seqs[index] == tail:
+                self._tail = tail + 1
+                return packet
+            # Overwritten while we were reading it, so it is newer than it should be, and packet tail is gone
+            self.dropped_oldest += 1
+            tail += 1
+            self._tail = tail
+
+    def get(self, timeout=None):
+        """ Take the oldest packet, waiting for one if the ring is empty. Only call this from the consumer thread.
+        :param timeout: Seconds to wait, or None to wait forever
+        :return: The packet, or None if the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._ready.clear()
+            packet = self.get_nowait()
+            if packet is not None:
+                return packet
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self._ready.wait(remaining)
+
+    def drain(self):
+        """ Take all the packets in the ring.
+        :return: List of packets, oldest first
+        :rtype: list
+        """
+        packets = []
+        packet = self.get_nowait()
+        while packet is not None:
+            packets.append(packet)
+            packet = self.get_nowait()
+        return packets
+
+    def stats(self):
+        return dict(
+                capacity       = self.capacity,
+                depth          = len(self),
+                pushed         = self.pushed,
+                dropped_oldest = self.dropped_oldest,
+                dropped_newest = self.dropped_newest
+            )
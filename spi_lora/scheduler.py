@@ -0,0 +1,250 @@
+""" Defines TxScheduler, which queues packets by priority and sends each at the earliest time the duty cycle allows. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import collections
+import heapq
+import itertools
+import time
+
+from .constants import *
+from .stats import LatencyCounter
+
+
+# A frequency range with one duty cycle limit, in MHz
+SubBand = collections.namedtuple('SubBand', ['name', 'low', 'high', 'duty_cycle'])
+
+# The ETSI EN 300 220 sub-bands LoRa uses in Europe, with their limits for devices without LBT or AFA
+EU868_SUB_BANDS = (
+    SubBand('h1.3', 863.0, 865.0, 0.001),
+    SubBand('h1.4', 865.0, 868.0, 0.01),
+    SubBand('h1.5', 868.0, 868.6, 0.01),
+    SubBand('h1.6', 868.7, 869.2, 0.001),
+    SubBand('h1.7', 869.4, 869.65, 0.1),
+    SubBand('h1.9', 869.7, 870.0, 0.01),
+)
+
+# What became of a TxRequest
+QUEUED = 'queued'
+SENT = 'sent'
+EXPIRED = 'expired'         # its deadline passed before the duty cycle allowed it to go
+REJECTED = 'rejected'       # longer than the sub-band's whole budget, so it could never go
+
+
+class TokenBucket(object):
+    """ Airtime allowance that refills at the duty cycle rate, up to the budget of one window. Starts full. """
+
+    def __init__(self, rate, capacity, now):
+        """
+        :param rate: Seconds of airtime earned per second
+        :param capacity: Most seconds of airtime that can be saved up
+        :param now: Current time in seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, amount, now):
+        """ Get the seconds until amount tokens are available, inf if never. """
+        if amount > self.capacity:
+            return float('inf')
+        return max(0., (amount - self.refill(now)) / self.rate)
+
+    def consume(self, amount, now):
+        self.refill(now)
+        self.tokens -= amount
+
+
+class TxRequest(object):
+    """ A packet waiting in a TxScheduler, and what became of it. """
+
+    def __init__(self, payload, priority, deadline, not_before, submitted):
+        self.payload = payload
+        self.priority = priority
+        self.deadline = deadline
+        self.not_before = not_before
+        self.submitted = submitted
+        self.status = QUEUED
+        self.sent = None            # time the transmission started
+        self.band = None
+        self.airtime = None
+
+
+class TxScheduler(object):
+    """
+    Queues packets to send with a GenericLoRa, and starts each transmission at
+    the earliest time that stays within the duty cycle limit of its sub-band.
+
+    Each sub-band has a token bucket of airtime, refilled at its duty cycle
+    and holding up to one window's worth. The airtime of a packet and its
+    sub-band come from the modem's frequency and settings when it is due to
+    go, so they follow any reconfiguration in between.
+
+    Packets go out by priority, highest first, and in order of not_before
+    (or submission) within a priority. A packet whose deadline passes while
+    it waits is dropped.
+
+    Synchronous use: call poll() from the main loop. It writes the payload
+    and sets TX mode when the head of the queue is due, and says how long to
+    wait otherwise. The application's TxDone handler must put the modem back
+    in STDBY, as usual. With AsyncLoRa, call next_request() and send what it
+    gives you.
+    """
+
+    def __init__(self, lora, sub_bands=EU868_SUB_BANDS, window=3600., clock=time.monotonic):
+        """
+        :param lora: The GenericLoRa to transmit with
+        :param sub_bands: SubBands to keep within. A frequency outside all of them is not limited.
+        :param window: Window the duty cycle applies over, in seconds. Sets how much airtime a sub-band can save up.
+        :param clock: Function giving the time in seconds
+        """
+        self.lora = lora
+        self.sub_bands = tuple(sub_bands)
+        self.window = window
+        self.clock = clock
+        self.started = clock()
+        self.buckets = {band.name: TokenBucket(band.duty_cycle, band.duty_cycle * window, self.started)
+                        for band in self.sub_bands}
+        self.airtime = {band.name: 0. for band in self.sub_bands}
+        self.sent = 0
+        self.expired = 0
+        self.rejected = 0
+        self.wait = LatencyCounter()        # from submit() to the start of the transmission
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, payload, priority=0, deadline=None, not_before=None):
+        """ Queue a packet.
+        :param payload: Payload (bytes or list of ints)
+        :param priority: Higher goes first
+        :param deadline: Drop the packet if it cannot start by this clock time
+        :param not_before: Do not send the packet before this clock time
+        :rtype: TxRequest
+        """
+        now = self.clock()
+        request = TxRequest(payload, priority, deadline, not_before, now)
+        heapq.heappush(self._queue, (-priority, now if not_before is None else max(now, not_before),
+                                     next(self._sequence), request))
+        return request
+
+    def sub_band(self, freq):
+        """ Find the SubBand a frequency in MHz falls in, or None. """
+        for band in self.sub_bands:
+            if band.low <= freq < band.high:
+                return band
+        return None
+
+    def next_request(self):
+        """ Take the packet at the head of the queue if it may go now, and charge its airtime.
+
+        The caller must then send it right away. Packets whose deadline has
+        passed, or that can never fit, are dropped on the way.
+        :return: (request, 0) if one may go now, otherwise (None, seconds to wait), or (None, None) if the queue is
+        empty
+        """
+        while self._queue:
+            now = self.clock()
+            request = self._queue[0][-1]
+            band = self.sub_band(self.lora.get_freq())
+            airtime = self.lora.time_on_air(len(request.payload))
+            wait = max(0., (request.not_before or now) - now)
+            if band is not None:
+                wait = max(wait, self.buckets[band.name].wait_time(airtime, now))
+            if self.lora.duty_cycle is not None:
+                # The driver's own ledger would refuse the transmission until then
+                wait = max(wait, self.lora.duty_cycle.wait_time(airtime))
+            if wait == float('inf'):
+                self._drop(REJECTED)
+                continue
+            if request.deadline is not None and now + wait > request.deadline:
+                self._drop(EXPIRED)
+                continue
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self._queue)
+            if band is not None:
+                self.buckets[band.name].consume(airtime, now)
+                self.airtime[band.name] += airtime
+                request.band = band.name
+            request.airtime = airtime
+            request.sent = now
+            request.status = SENT
+            self.sent += 1
+            self.wait.add(now - request.submitted)
+            return request, 0.
+        return None, None
+
+    def poll(self):
+        """ Start the next transmission if one is due and the modem is not already transmitting.
+        :return: Seconds until a packet can go, 0 if one just did, or None if there is nothing to send or the modem is
+        busy transmitting
+        """
+        if self.lora.mode == MODE.TX:
+            return None
+        request, wait = self.next_request()
+        if request is None:
+            return wait
+        self.lora.write_payload(request.payload)
+        self.lora.set_mode(MODE.TX)
+        return 0.
+
+    def stats(self):
+        """ Get queue, wait and per sub-band utilisation figures. Utilisation is the airtime used as a fraction of
+        what the duty cycle allowed since the scheduler was made.
+        :rtype: dict
+        """
+        now = self.clock()
+        elapsed = now - self.started
+        bands = {}
+        for band in self.sub_bands:
+            airtime = self.airtime[band.name]
+            bands[band.name] = dict(
+                    duty_cycle  = band.duty_cycle,
+                    airtime     = airtime,
+                    available   = self.buckets[band.name].refill(now),
+                    utilisation = airtime / (elapsed * band.duty_cycle) if elapsed else 0.
+                )
+        return dict(
+                queue_depth = len(self._queue),
+                sent        = self.sent,
+                expired     = self.expired,
+                rejected    = self.rejected,
+                wait        = self.wait.stats(),
+                sub_bands   = bands
+            )
+
+    def _drop(self, status):
+        request = heapq.heappop(self._queue)[-1]
+        request.status = status
+        if status == EXPIRED:
+            self.expired += 1
+        else:
+            self.rejected += 1
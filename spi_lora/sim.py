@@ -0,0 +1,505 @@
+""" Defines SimulatedSX127x, a pure Python SX127x modem behind the spidev interface, and SimChannel to link them. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import heapq
+import itertools
+
+from .airtime import AirtimeParams
+from .constants import *
+from .boards import BaseBoard
+
+
+# Power-on values of the LoRa registers, from SX127x.regdump. Registers not listed here reset to 0.
+RESET_REGISTERS = {
+    0x01: 0x80, 0x06: 0x6C, 0x07: 0x80, 0x09: 0x4F, 0x0A: 0x09, 0x0B: 0x2B, 0x0C: 0x20, 0x0E: 0x80, 0x18: 0x10,
+    0x1D: 0x72, 0x1E: 0x70, 0x1F: 0x64, 0x21: 0x08, 0x22: 0x01, 0x23: 0xFF, 0x26: 0x04, 0x2F: 0x45, 0x30: 0x55,
+    0x31: 0xC3, 0x33: 0x27, 0x36: 0x03, 0x37: 0x0A, 0x39: 0x12, 0x3A: 0x52, 0x3B: 0x1D, 0x42: 0x12, 0x4B: 0x09,
+    0x4D: 0x84, 0x61: 0x1C, 0x62: 0x0E, 0x63: 0x5B, 0x64: 0xCC, 0x70: 0xD0,
+}
+
+# IRQ flag bits
+IRQ_RX_TIMEOUT = 1 << MASK.IRQ_FLAGS.RxTimeout
+IRQ_RX_DONE = 1 << MASK.IRQ_FLAGS.RxDone
+IRQ_CRC_ERROR = 1 << MASK.IRQ_FLAGS.PayloadCrcError
+IRQ_VALID_HEADER = 1 << MASK.IRQ_FLAGS.ValidHeader
+IRQ_TX_DONE = 1 << MASK.IRQ_FLAGS.TxDone
+IRQ_CAD_DONE = 1 << MASK.IRQ_FLAGS.CadDone
+IRQ_FHSS_CHANGE_CHANNEL = 1 << MASK.IRQ_FLAGS.FhssChangeChannel
+IRQ_CAD_DETECTED = 1 << MASK.IRQ_FLAGS.CadDetected
+
+# For each DIO line, the IRQ flag it signals under each mapping value (see GenericLoRa._dio0 etc.)
+DIO_IRQS = (
+    (IRQ_RX_DONE, IRQ_TX_DONE, IRQ_CAD_DONE),
+    (IRQ_RX_TIMEOUT, IRQ_FHSS_CHANGE_CHANNEL, IRQ_CAD_DETECTED),
+    (IRQ_FHSS_CHANGE_CHANNEL, IRQ_FHSS_CHANGE_CHANNEL, IRQ_FHSS_CHANGE_CHANNEL),
+    (IRQ_CAD_DONE, IRQ_VALID_HEADER, IRQ_CRC_ERROR),
+    (), (),
+)
+
+# Added to a signal level in dBm to get the PKT_RSSI_VALUE or RSSI_VALUE register, see datasheet 5.5.5
+RSSI_OFFSET_LF = 164
+RSSI_OFFSET_HF = 157
+
+
+class Transmission(object):
+    """ A packet on the air in a SimChannel. """
+
+    def __init__(self, sender, payload, settings, start, end):
+        self.sender = sender
+        self.payload = payload
+        self.settings = settings
+        self.start = start
+        self.end = end
+        self.listeners = []         # radios that were receiving on the right settings when it started
+        self.hops = None            # for a frequency hopping packet, the sender's frequency during each hop
+        self.listener_hops = {}     # and each listener's
+
+    def hop_frequencies(self):
+        """ Note down the frequency the sender and each listener were on for the hop that is ending. """
+        self.hops.append(self.sender.settings()[:3])
+        for radio in self.listeners:
+            self.listener_hops.setdefault(radio, []).append(radio.settings()[:3])
+
+    def received_by(self, radio):
+        """ Check if a listener stayed with the packet, on the same settings as the sender, all the way through. """
+        if not radio.listening():
+            return False
+        if self.hops is None:
+            return radio.settings() == self.settings
+        return radio.settings()[3:] == self.settings[3:] and self.listener_hops.get(radio) == self.hops
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+class SimChannel(object):
+    """
+    The air between any number of SimulatedSX127x radios, with a virtual clock.
+
+    Nothing happens between SPI transfers unless time moves on. Call advance()
+    or run() to move it, or leave fast_forward on: then whenever a radio's
+    IRQ_FLAGS register is read while no flags are set, the clock jumps to the
+    next scheduled event, so a driver polling for TxDone or RxDone runs at
+    full speed instead of waiting out the time on air.
+
+    A radio receives a packet if it was in RXCONT or RXSINGLE mode with the
+    same frequency, bandwidth, spreading factor and sync word for the whole
+    packet. Packets that overlap on the same settings are received with a CRC
+    error. If the sender has a hop period set, the packet hops: the sender
+    and its listeners get FhssChangeChannel every hop period, and a listener
+    only receives the packet if it was on the sender's frequency for every
+    hop.
+    """
+
+    def __init__(self, fast_forward=True, rssi=-60., snr=9.5, noise_floor=-120.):
+        """
+        :param fast_forward: Jump to the next event when the IRQ flags are polled and none are set
+        :param rssi: Signal level of received packets in dBm
+        :param snr: Signal to noise ratio of received packets in dB
+        :param noise_floor: RSSI when nothing is on the air in dBm
+        """
+        self.fast_forward = fast_forward
+        self.rssi = rssi
+        self.snr = snr
+        self.noise_floor = noise_floor
+        self.time = 0.
+        self.radios = []
+        self.on_air = []
+        self._ended = []            # finished transmissions that something on the air may still have collided with
+        self.sent = 0
+        self.delivered = 0
+        self.collisions = 0
+        self._events = []
+        self._sequence = itertools.count()
+        self._running = False
+
+    def attach(self, radio):
+        self.radios.append(radio)
+
+    def schedule(self, delay, callback, *args):
+        """ Call callback(*args) once the clock has moved on by delay seconds. """
+        heapq.heappush(self._events, (self.time + delay, next(self._sequence), callback, args))
+
+    def next_event_time(self):
+        """ Get the time of the next scheduled event, or None if there is none. """
+        return self._events[0][0] if self._events else None
+
+    def step(self):
+        """ Move the clock to the next scheduled event and run it.
+        :return: False if there was no event
+        :rtype: bool
+        """
+        if not self._events:
+            return False
+        when, _, callback, args = heapq.heappop(self._events)
+        self.time = max(self.time, when)
+        callback(*args)
+        return True
+
+    def advance(self, seconds):
+        """ Move the clock on by seconds, running the events that fall due on the way. """
+        until = self.time + seconds
+        while self._events and self._events[0][0] <= until:
+            self.step()
+        self.time = until
+
+    def run(self, limit=10000):
+        """ Run scheduled events until there are none left.
+        :param limit: Give up after this many events, e.g. when a radio keeps re-arming RXSINGLE
+        :return: Number of events run
+        """
+        for count in range(limit):
+            if not self.step():
+                return count
+        return limit
+
+    def poll(self):
+        """ Called by a radio whose IRQ flags are read while none are set. """
+        if self.fast_forward and not self._running:
+            self._running = True
+            try:
+                self.step()
+            finally:
+                self._running = False
+
+    def busy(self, settings):
+        """ Check if anything is on the air with the given radio settings. """
+        return any(t.settings == settings for t in self.on_air)
+
+    def start_transmission(self, sender, payload, duration):
+        settings = sender.settings()
+        transmission = Transmission(sender, payload, settings, self.time, self.time + duration)
+        for radio in self.radios:
+            if radio is not sender and radio.listening() and radio.settings() == settings:
+                transmission.listeners.append(radio)
+                radio.receiving += 1
+                radio.start_hopping()
+        self.on_air.append(transmission)
+        self.sent += 1
+        hop_period = sender.registers[REG.LORA.HOP_PERIOD]
+        if hop_period:
+            transmission.hops = []
+            hop_time = hop_period * sender.symbol_time()
+            self.schedule(hop_time, self._hop, transmission, 1, hop_time)
+        return transmission
+
+    def _hop(self, transmission, hop, hop_time):
+        if transmission not in self.on_air:
+            return
+        transmission.hop_frequencies()
+        for radio in [transmission.sender] + transmission.listeners:
+            radio.hop(hop)
+        if (hop + 1) * hop_time < transmission.end - transmission.start:
+            self.schedule(hop_time, self._hop, transmission, hop + 1, hop_time)
+
+    def end_transmission(self, transmission):
+        self.on_air.remove(transmission)
+        if transmission.hops is not None:
+            transmission.hop_frequencies()
+        collided = any(t.settings == transmission.settings and t.overlaps(transmission)
+                       for t in self.on_air + self._ended)
+        self._ended = [t for t in self._ended + [transmission] if any(o.start < t.end for o in self.on_air)]
+        if collided:
+            self.collisions += 1
+        for radio in transmission.listeners:
+            radio.receiving -= 1
+            # It must still be listening with the same settings to get the packet
+            if transmission.received_by(radio):
+                radio.deliver(transmission.payload, self.rssi, self.snr, crc_error=collided)
+                self.delivered += 1
+
+
+class SimulatedSX127x(object):
+    """
+    A SX127x modem in LoRa mode, simulated in Python, that can stand in for a
+    spidev.SpiDev.
+
+    Registers are plain memory, accessed in bursts with auto-increment; the
+    FIFO goes through FIFO_ADDR_PTR; IRQ flags are cleared by writing ones,
+    and IRQ_FLAGS_MASK keeps flags from being raised. Setting TX mode sends
+    the payload to the other radios on the SimChannel, and returns to STDBY
+    after the time on air. RXCONT, RXSINGLE (with its symbol timeout) and CAD
+    work as on the real modem. The DIO lines, as mapped by DIO_MAPPING_1 and
+    DIO_MAPPING_2, call the functions given to add_events().
+
+        channel = SimChannel()
+        lora_a = LoRa(sim_board(channel=channel), verbose=False)
+        lora_b = LoRa(sim_board(channel=channel), verbose=False)
+    """
+
+    max_speed_hz = 5000000
+    mode = 0
+    bits_per_word = 8
+
+    def __init__(self, channel=None, low_band=False, name=None):
+        """
+        :param channel: SimChannel to transmit and receive on. By default the radio gets a channel of its own.
+        :param low_band: Whether this is a low band modem, which changes the RSSI registers
+        :param name: Name for display purposes
+        """
+        self.channel = channel if channel is not None else SimChannel()
+        self.channel.attach(self)
+        self.low_band = low_band
+        self.name = name
+        self.registers = [RESET_REGISTERS.get(i, 0) for i in range(0x80)]
+        self.fifo = bytearray(256)
+        self.dio_callbacks = [None] * 6
+        self.receiving = 0          # packets on the air that this radio is receiving
+        self.xfer_count = 0
+        self.bytes_transferred = 0
+        self.hops = 0
+        self.missed_hops = 0        # hops that came while FhssChangeChannel was still set from the last one
+        self._rx_addr = 0
+        self._epoch = 0             # bumped on every mode change, to cancel the events of the old mode
+
+    def __repr__(self):
+        return "SimulatedSX127x(%s)" % (self.name or hex(id(self)))
+
+    # The spidev interface
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        data = list(data)
+        self.xfer_count += 1
+        self.bytes_transferred += len(data)
+        address = data[0] & 0x7F
+        if data[0] & 0x80:
+            result = [0]
+            for i, value in enumerate(data[1:]):
+                result.append(self._write(address if address == REG.LORA.FIFO else (address + i) & 0x7F, value))
+            return result
+        return [0] + [self._read(address if address == REG.LORA.FIFO else (address + i) & 0x7F)
+                      for i in range(len(data) - 1)]
+
+    xfer2 = xfer
+
+    def xfer3(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return tuple(self.xfer(data))
+
+    def writebytes(self, data):
+        self.xfer(data)
+
+    writebytes2 = writebytes
+
+    def readbytes(self, count):
+        return [0] * count
+
+    # Board interface
+
+    def add_events(self, *callbacks):
+        """ Connect the DIO lines. Takes up to 6 functions, for DIO0 to DIO5. Each is called with its DIO number. """
+        for i, callback in enumerate(callbacks[:6]):
+            self.dio_callbacks[i] = callback
+
+    # Things the test or the channel can do to the radio
+
+    def settings(self):
+        """ Get what a transmitter and receiver must agree on: frequency, bandwidth, spreading factor and sync word. """
+        r = self.registers
+        return (r[REG.LORA.FR_MSB], r[REG.LORA.FR_MID], r[REG.LORA.FR_LSB], r[REG.LORA.MODEM_CONFIG_1] >> 4,
+                r[REG.LORA.MODEM_CONFIG_2] >> 4, r[REG.LORA.SYNC_WORD])
+
+    def listening(self):
+        return self.registers[REG.LORA.OP_MODE] in (MODE.RXCONT, MODE.RXSINGLE)
+
+    def symbol_time(self):
+        r = self.registers
+        return (1 << (r[REG.LORA.MODEM_CONFIG_2] >> 4)) / float(BANDWIDTH_HZ[r[REG.LORA.MODEM_CONFIG_1] >> 4])
+
+    def time_on_air(self, payload_length):
+        """ Compute the time on air of a packet with the current register settings.
+        :rtype: float
+        """
+        return AirtimeParams.from_registers(self.registers).time_on_air(payload_length)
+
+    def start_hopping(self):
+        """ Reset FhssPresentChannel, as at the start of every packet. """
+        self.registers[REG.LORA.HOP_CHANNEL] &= ~0b111111
+
+    def hop(self, hop):
+        """ Move on to the given hop of a frequency hopping packet and raise FhssChangeChannel, if the hop period is
+        set. """
+        r = self.registers
+        if not r[REG.LORA.HOP_PERIOD]:
+            return
+        self.hops += 1
+        if r[REG.LORA.IRQ_FLAGS] & IRQ_FHSS_CHANGE_CHANNEL:
+            self.missed_hops += 1
+        r[REG.LORA.HOP_CHANNEL] = r[REG.LORA.HOP_CHANNEL] & ~0b111111 | hop & 0b111111
+        self._raise_irq(IRQ_FHSS_CHANGE_CHANNEL)
+
+    def deliver(self, payload, rssi, snr, crc_error=False):
+        """ Receive a packet into the FIFO, as if it just came in over the air. The radio should be listening. """
+        r = self.registers
+        start = self._rx_addr
+        for i, value in enumerate(payload):
+            self.fifo[(start + i) & 0xFF] = value
+        self._rx_addr = (start + len(payload)) & 0xFF
+        r[REG.LORA.FIFO_RX_CURR_ADDR] = start
+        r[REG.LORA.FIFO_RX_BYTE_ADDR] = self._rx_addr
+        r[REG.LORA.RX_NB_BYTES] = len(payload)
+        r[REG.LORA.PKT_RSSI_VALUE] = max(0, min(255, int(round(rssi)) + self._rssi_offset()))
+        r[REG.LORA.PKT_SNR_VALUE] = int(round(snr * 4)) & 0xFF
+        packets = (r[REG.LORA.RX_PACKET_CNT_MSB] << 8 | r[REG.LORA.RX_PACKET_CNT_MSB + 1]) + 1
+        r[REG.LORA.RX_PACKET_CNT_MSB], r[REG.LORA.RX_PACKET_CNT_MSB + 1] = packets >> 8 & 0xFF, packets & 0xFF
+        if r[REG.LORA.OP_MODE] == MODE.RXSINGLE:
+            self._set_mode(MODE.STDBY)
+        self._raise_irq(IRQ_VALID_HEADER | IRQ_RX_DONE | (IRQ_CRC_ERROR if crc_error else 0))
+
+    # Internals
+
+    def _rssi_offset(self):
+        return RSSI_OFFSET_LF if self.low_band else RSSI_OFFSET_HF
+
+    def _read(self, address):
+        r = self.registers
+        if address == REG.LORA.FIFO:
+            ptr = r[REG.LORA.FIFO_ADDR_PTR]
+            r[REG.LORA.FIFO_ADDR_PTR] = (ptr + 1) & 0xFF
+            return self.fifo[ptr]
+        if address == REG.LORA.IRQ_FLAGS and r[address] == 0:
+            self.channel.poll()
+        elif address == REG.LORA.RSSI_VALUE:
+            level = self.channel.rssi if self.channel.busy(self.settings()) else self.channel.noise_floor
+            return max(0, min(255, int(round(level)) + self._rssi_offset()))
+        elif address == REG.LORA.MODEM_STAT:
+            # Signal detected, synchronized and RX on-going while receiving, modem clear otherwise
+            return 0x0B if self.receiving else 0x10
+        return r[address]
+
+    def _write(self, address, value):
+        r = self.registers
+        if address == REG.LORA.FIFO:
+            ptr = r[REG.LORA.FIFO_ADDR_PTR]
+            old = self.fifo[ptr]
+            self.fifo[ptr] = value
+            r[REG.LORA.FIFO_ADDR_PTR] = (ptr + 1) & 0xFF
+            return old
+        old = r[address]
+        if address == REG.LORA.IRQ_FLAGS:
+            r[address] &= ~value
+        elif address == REG.LORA.OP_MODE:
+            self._set_mode(value)
+        elif address == REG.FSK.IMAGE_CAL and not r[REG.LORA.OP_MODE] & 0x80:
+            # Image calibration finishes at once: ImageCalStart and ImageCalRunning read back as 0
+            r[address] = value & ~0x60
+        elif address not in (REG.LORA.VERSION, REG.LORA.FIFO_RX_CURR_ADDR, REG.LORA.RX_NB_BYTES,
+                             REG.LORA.MODEM_STAT, REG.LORA.PKT_SNR_VALUE, REG.LORA.PKT_RSSI_VALUE,
+                             REG.LORA.RSSI_VALUE, REG.LORA.FIFO_RX_BYTE_ADDR, REG.LORA.HOP_CHANNEL):
+            r[address] = value
+        return old
+
+    def _set_mode(self, mode):
+        r = self.registers
+        previous = r[REG.LORA.OP_MODE]
+        r[REG.LORA.OP_MODE] = mode
+        if mode == previous:
+            return
+        self._epoch += 1
+        epoch = self._epoch
+        if mode in (MODE.RXCONT, MODE.RXSINGLE) and previous not in (MODE.RXCONT, MODE.RXSINGLE):
+            self._rx_addr = r[REG.LORA.FIFO_RX_BASE_ADDR]
+        if mode == MODE.TX:
+            length = r[REG.LORA.PAYLOAD_LENGTH]
+            base = r[REG.LORA.FIFO_TX_BASE_ADDR]
+            payload = bytes(self.fifo[(base + i) & 0xFF] for i in range(length))
+            duration = self.time_on_air(length)
+            self.start_hopping()
+            transmission = self.channel.start_transmission(self, payload, duration)
+            self.channel.schedule(duration, self._tx_done, epoch, transmission)
+        elif mode == MODE.RXSINGLE:
+            symb_timeout = (r[REG.LORA.MODEM_CONFIG_2] & 0b11) << 8 | r[REG.LORA.SYMB_TIMEOUT_LSB]
+            self.channel.schedule(symb_timeout * self.symbol_time(), self._rx_timeout, epoch)
+        elif mode == MODE.CAD:
+            # CAD takes about two symbols
+            self.channel.schedule(2 * self.symbol_time(), self._cad_done, epoch)
+
+    def _tx_done(self, epoch, transmission):
+        self.channel.end_transmission(transmission)
+        if epoch == self._epoch:
+            self._set_mode(MODE.STDBY)
+            self._raise_irq(IRQ_TX_DONE)
+
+    def _rx_timeout(self, epoch):
+        if epoch == self._epoch:
+            if self.receiving:
+                # Caught a preamble, so wait for the packet instead
+                self.channel.schedule(self.symbol_time(), self._rx_timeout, epoch)
+                return
+            self._set_mode(MODE.STDBY)
+            self._raise_irq(IRQ_RX_TIMEOUT)
+
+    def _cad_done(self, epoch):
+        if epoch == self._epoch:
+            detected = self.channel.busy(self.settings())
+            self._set_mode(MODE.STDBY)
+            self._raise_irq(IRQ_CAD_DONE | (IRQ_CAD_DETECTED if detected else 0))
+
+    def _raise_irq(self, flags):
+        r = self.registers
+        flags &= ~r[REG.LORA.IRQ_FLAGS_MASK]
+        r[REG.LORA.IRQ_FLAGS] |= flags
+        mapping = r[REG.LORA.DIO_MAPPING_1] << 8 | r[REG.LORA.DIO_MAPPING_2]
+        for dio, irqs in enumerate(DIO_IRQS):
+            dio_mapping = mapping >> (14 - 2 * dio) & 0b11
+            callback = self.dio_callbacks[dio]
+            if callback is not None and dio_mapping < len(irqs) and irqs[dio_mapping] & flags:
+                callback(dio)
+
+
+def sim_board(radio=None, channel=None, low_band=False, name=None, dio_lines=True):
+    """ Make a board class for a simulated radio, to pass to LoRa().
+    :param radio: The SimulatedSX127x. By default, a new one is made.
+    :param channel: SimChannel for the new radio, if radio is not given
+    :param low_band: Band of the new radio, if radio is not given
+    :param name: Name of the new radio, if radio is not given
+    :param dio_lines: If False, the board has no add_events(), like an SPI-only board, so the driver has to poll the
+    IRQ flags. With fast_forward on the SimChannel, polling is what moves the clock.
+    :return: A BaseBoard subclass whose SpiDev() is the radio, available as its radio attribute
+    """
+    if radio is None:
+        radio = SimulatedSX127x(channel, low_band=low_band, name=name)
+
+    class SimBoard(BaseBoard):
+        """ A board with a simulated modem, with all of its DIO lines connected. """
+
+        @classmethod
+        def SpiDev(cls, spi_bus=None, spi_cs=None):
+            cls.radio.max_speed_hz = cls.max_speed_hz
+            return cls.radio
+
+        @classmethod
+        def add_events(cls, cb_dio0, cb_dio1, cb_dio2, cb_dio3, cb_dio4, cb_dio5, switch_cb=None):
+            cls.radio.add_events(cb_dio0, cb_dio1, cb_dio2, cb_dio3, cb_dio4, cb_dio5)
+
+    if not dio_lines:
+        del SimBoard.add_events
+    SimBoard.radio = radio
+    SimBoard.spi = radio
+    SimBoard.low_band = radio.low_band
+    return SimBoard
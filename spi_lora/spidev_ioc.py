@@ -0,0 +1,237 @@
+""" Defines IocSpiDev, a spidev.SpiDev replacement that sends several transfers in one SPI_IOC_MESSAGE ioctl. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import ctypes
+import fcntl
+import inspect
+import os
+import struct
+
+
+# spidev uAPI, from linux/spi/spidev.h
+
+SPI_IOC_MAGIC = ord('k')
+
+def _IOR(type, nr, size):
+    return 2 << 30 | size << 16 | type << 8 | nr
+
+def _IOW(type, nr, size):
+    return 1 << 30 | size << 16 | type << 8 | nr
+
+# struct spi_ioc_transfer: tx_buf, rx_buf, len, speed_hz, delay_usecs, bits_per_word, cs_change, tx_nbits, rx_nbits,
+# word_delay_usecs, pad
+SPI_IOC_TRANSFER = struct.Struct('=QQIIHBBBBBB')
+
+SPI_IOC_RD_MODE          = _IOR(SPI_IOC_MAGIC, 1, 1)
+SPI_IOC_WR_MODE          = _IOW(SPI_IOC_MAGIC, 1, 1)
+SPI_IOC_RD_BITS_PER_WORD = _IOR(SPI_IOC_MAGIC, 3, 1)
+SPI_IOC_WR_BITS_PER_WORD = _IOW(SPI_IOC_MAGIC, 3, 1)
+SPI_IOC_RD_MAX_SPEED_HZ  = _IOR(SPI_IOC_MAGIC, 4, 4)
+SPI_IOC_WR_MAX_SPEED_HZ  = _IOW(SPI_IOC_MAGIC, 4, 4)
+
+# The ioctl size field is 14 bits, which limits how many transfers fit in one message
+SPI_IOC_MAX_TRANSFERS = ((1 << 14) - 1) // SPI_IOC_TRANSFER.size
+
+
+def SPI_IOC_MESSAGE(count):
+    """ Get the ioctl request number for a message of count transfers. """
+    return _IOW(SPI_IOC_MAGIC, 0, count * SPI_IOC_TRANSFER.size)
+
+
+class IocSpiDev(object):
+    """
+    Talks to /dev/spidevB.C through the SPI_IOC_MESSAGE ioctl directly, with
+    the same interface as spidev.SpiDev, plus xfer_many().
+
+    xfer_many() sends a list of transfers in one ioctl, with the chip select
+    released between them, as the SX127x needs between register accesses.
+    GenericLoRa uses it, when the connection has it, to send all the bursts
+    of a batch() or profile at once. The transfer structs and the data
+    buffers are allocated once, up front, so each call only packs the
+    structs and copies the data in and out.
+
+        spi = IocSpiDev()
+        spi.open(0, 1)
+        spi.max_speed_hz = 5000000
+        lora = GenericLoRa(spi, low_band=False)
+    """
+
+    def __init__(self, max_transfers=64, bufsiz=4096):
+        """
+        :param max_transfers: Most transfers to send in one ioctl
+        :param bufsiz: Most bytes to send in one ioctl. The spidev driver refuses messages over its bufsiz module
+        parameter, which is 4096 by default.
+        """
+        self.max_transfers = min(max_transfers, SPI_IOC_MAX_TRANSFERS)
+        self.bufsiz = bufsiz
+        self.fd = None
+        self.ioctls = 0
+        self.transfers = 0
+        self._mode = 0
+        self._bits_per_word = 8
+        self._max_speed_hz = 0
+        self._tx = ctypes.create_string_buffer(bufsiz)
+        self._rx = ctypes.create_string_buffer(bufsiz)
+        self._tx_view = memoryview(self._tx).cast('B')
+        self._rx_view = memoryview(self._rx).cast('B')
+        self._tx_address = ctypes.addressof(self._tx)
+        self._rx_address = ctypes.addressof(self._rx)
+        self._messages = bytearray(self.max_transfers * SPI_IOC_TRANSFER.size)
+        self._messages_view = memoryview(self._messages)
+
+    def open(self, bus, device):
+        self.fd = os.open('/dev/spidev%d.%d' % (bus, device), os.O_RDWR)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _set(self, request, format, value):
+        fcntl.ioctl(self.fd, request, struct.pack(format, value))
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        self._set(SPI_IOC_WR_MODE, '=B', mode)
+        self._mode = mode
+
+    @property
+    def bits_per_word(self):
+        return self._bits_per_word
+
+    @bits_per_word.setter
+    def bits_per_word(self, bits_per_word):
+        self._set(SPI_IOC_WR_BITS_PER_WORD, '=B', bits_per_word)
+        self._bits_per_word = bits_per_word
+
+    @property
+    def max_speed_hz(self):
+        return self._max_speed_hz
+
+    @max_speed_hz.setter
+    def max_speed_hz(self, max_speed_hz):
+        self._set(SPI_IOC_WR_MAX_SPEED_HZ, '=I', max_speed_hz)
+        self._max_speed_hz = max_speed_hz
+
+    def xfer_many(self, transfers, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        """ Make several transfers, releasing the chip select between them, in as few ioctls as the buffer sizes
+        allow.
+        :param transfers: List of transfers, each a list of ints or a bytes-like object
+        :return: The bytes received in each transfer
+        :rtype: list[list[int]]
+        """
+        results = []
+        start = 0
+        while start < len(transfers):
+            count = 0
+            size = 0
+            while start + count < len(transfers) and count < self.max_transfers and \
+                    size + len(transfers[start + count]) <= self.bufsiz:
+                size += len(transfers[start + count])
+                count += 1
+            if not count:
+                raise ValueError("A %d byte transfer does not fit in the %d byte buffer" %
+                                 (len(transfers[start]), self.bufsiz))
+            self._message(transfers, start, count, speed_hz, delay_usecs, bits_per_word)
+            offset = 0
+            for data in transfers[start:start + count]:
+                results.append(self._rx_view[offset:offset + len(data)].tolist())
+                offset += len(data)
+            start += count
+        return results
+
+    def _message(self, transfers, start, count, speed_hz, delay_usecs, bits_per_word):
+        """ Send transfers[start:start + count] in one ioctl. They must fit in the buffers. """
+        offset = 0
+        for i in range(count):
+            data = transfers[start + i]
+            length = len(data)
+            self._tx_view[offset:offset + length] = data if not isinstance(data, list) else bytes(data)
+            # cs_change on all but the last transfer releases the chip select after it
+            SPI_IOC_TRANSFER.pack_into(self._messages, i * SPI_IOC_TRANSFER.size, self._tx_address + offset,
+                                       self._rx_address + offset, length, speed_hz or self._max_speed_hz,
+                                       delay_usecs, bits_per_word, i < count - 1, 0, 0, 0, 0)
+            offset += length
+        fcntl.ioctl(self.fd, SPI_IOC_MESSAGE(count), self._messages_view[:count * SPI_IOC_TRANSFER.size])
+        self.ioctls += 1
+        self.transfers += count
+
+    def _xfer(self, data, speed_hz, delay_usecs, bits_per_word):
+        if len(data) > self.bufsiz:
+            raise ValueError("A %d byte transfer does not fit in the %d byte buffer" % (len(data), self.bufsiz))
+        self._message((data,), 0, 1, speed_hz, delay_usecs, bits_per_word)
+        return self._rx_view[:len(data)]
+
+    def xfer(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return self._xfer(data, speed_hz, delay_usecs, bits_per_word).tolist()
+
+    xfer2 = xfer
+
+    def xfer3(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return tuple(self._xfer(data, speed_hz, delay_usecs, bits_per_word))
+
+    def writebytes(self, data):
+        self._xfer(data, 0, 0, 0)
+
+    writebytes2 = writebytes
+
+    def readbytes(self, count):
+        return self._xfer(bytes(count), 0, 0, 0).tolist()
+
+
+def _default(board, parameter):
+    """ Find the default a board's SpiDev() uses for a parameter, looking past boards from BaseBoard.derive() that
+    leave it to their base class. """
+    for cls in board.__mro__:
+        if 'SpiDev' in cls.__dict__:
+            default = inspect.signature(cls.__dict__['SpiDev'].__func__).parameters[parameter].default
+            if default is not None and default is not inspect.Parameter.empty:
+                return default
+    return 0
+
+
+def ioc_board(board):
+    """ Make a board class that talks to its modem through IocSpiDev instead of spidev.
+    :param board: BaseBoard subclass, e.g. from BaseBoard.derive()
+    :return: A subclass of board whose SpiDev() opens an IocSpiDev, on the board's default bus and chip select unless
+    told otherwise
+    """
+    default_bus = _default(board, 'spi_bus')
+    default_cs = _default(board, 'spi_cs')
+
+    class IocBoard(board):
+        spi = None
+
+        @classmethod
+        def SpiDev(cls, spi_bus=None, spi_cs=None):
+            cls.spi = IocSpiDev()
+            cls.spi.open(default_bus if spi_bus is None else spi_bus, default_cs if spi_cs is None else spi_cs)
+            cls.spi.max_speed_hz = cls.max_speed_hz
+            return cls.spi
+
+    IocBoard.__name__ = board.__name__
+    return IocBoard
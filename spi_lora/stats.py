@@ -0,0 +1,42 @@
+""" Small statistics helpers shared by the driver, the gateway and the other modules. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+class LatencyCounter(object):
+    """ Keeps count, mean and max of a series of latencies in seconds. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def stats(self):
+        return dict(
+                count = self.count,
+                mean  = self.total / self.count if self.count else 0.,
+                max   = self.max
+            )
@@ -0,0 +1,376 @@
+""" Pure functions that decode SX127x LoRa register values, and the LoRaStatus snapshot built from them. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import collections
+import re
+import types
+
+from .constants import *
+
+
+# Number of registers in a full register image, as returned by GenericLoRa.get_all_registers()
+N_REGISTERS = REG.LORA.PLL + 1
+
+
+############################################## Single register decoders ################################################
+
+def decode_freq(msb, mid, lsb):
+    """ Convert the FR_MSB, FR_MID and FR_LSB register values to a frequency.
+    :return: Frequency in MHz
+    :rtype: float
+    """
+    f = lsb + 256*(mid + 256*msb)
+    return f / 16384.
+
+
+def decode_pa_config(v, convert_dBm=False):
+    pa_select    = v >> 7
+    max_power    = v >> 4 & 0b111
+    output_power = v & 0b1111
+    if convert_dBm:
+        max_power = max_power * .6 + 10.8
+        output_power = max_power - (15 - output_power)
+    return dict(
+            pa_select    = pa_select,
+            max_power    = max_power,
+            output_power = output_power
+        )
+
+
+def decode_ocp(v, convert_mA=False):
+    ocp_on = v >> 5 & 0x01
+    ocp_trim = v & 0b11111
+    if convert_mA:
+        if ocp_trim <= 15:
+            ocp_trim = 45. + 5. * ocp_trim
+        elif ocp_trim <= 27:
+            ocp_trim = -30. + 10. * ocp_trim
+        else:
+            assert ocp_trim <= 27
+    return dict(
+            ocp_on   = ocp_on,
+            ocp_trim = ocp_trim
+            )
+
+
+def decode_lna(v):
+    return dict(
+            lna_gain     = v >> 5,
+            lna_boost_lf = v >> 3 & 0b11,
+            lna_boost_hf = v & 0b11
+        )
+
+
+def decode_irq_flags(v):
+    """ Decode the IRQ_FLAGS or IRQ_FLAGS_MASK register.
+    :rtype: dict
+    """
+    return dict(
+            rx_timeout     = v >> 7 & 0x01,
+            rx_done        = v >> 6 & 0x01,
+            crc_error      = v >> 5 & 0x01,
+            valid_header   = v >> 4 & 0x01,
+            tx_done        = v >> 3 & 0x01,
+            cad_done       = v >> 2 & 0x01,
+            fhss_change_ch = v >> 1 & 0x01,
+            cad_detected   = v >> 0 & 0x01,
+        )
+
+
+def decode_modem_status(status):
+    return dict(
+            rx_coding_rate    = status >> 5 & 0x03,
+            modem_clear       = status >> 4 & 0x01,
+            header_info_valid = status >> 3 & 0x01,
+            rx_ongoing        = status >> 2 & 0x01,
+            signal_sync       = status >> 1 & 0x01,
+            signal_detected   = status >> 0 & 0x01
+        )
+
+
+def decode_snr(v):
+    """ Convert the PKT_SNR_VALUE register to dB. """
+    return (float(v-256) if v > 127 else float(v)) / 4.
+
+
+def decode_rssi(v, low_band):
+    """ Convert the PKT_RSSI_VALUE or RSSI_VALUE register to dBm. """
+    return v - (164 if low_band else 157)     # See datasheet 5.5.5. p. 87
+
+
+def decode_hop_channel(v):
+    return dict(
+            pll_timeout          = v >> 7,
+            crc_on_payload       = v >> 6 & 0x01,
+            fhss_present_channel = v & 0b111111
+        )
+
+
+def decode_modem_config_1(val):
+    return dict(
+            bw = val >> 4 & 0x0F,
+            coding_rate = val >> 1 & 0x07,
+            implicit_header_mode = val & 0x01
+        )
+
+
+def decode_modem_config_2(val, include_symb_timout_lsb=False):
+    d = dict(
+            spreading_factor = val >> 4 & 0x0F,
+            tx_cont_mode = val >> 3 & 0x01,
+            rx_crc = val >> 2 & 0x01,
+        )
+    if include_symb_timout_lsb:
+        d['symb_timout_lsb'] = val & 0x03
+    return d
+
+
+def decode_modem_config_3(val):
+    return dict(
+            low_data_rate_optim = val >> 3 & 0x01,
+            agc_auto_on = val >> 2 & 0x01
+        )
+
+
+def decode_symb_timeout(modem_config_2, symb_timeout_lsb):
+    """ The two MSBs of the symbol timeout live in MODEM_CONFIG_2. """
+    return symb_timeout_lsb + 256 * (modem_config_2 & 0b11)
+
+
+def decode_fei(msb, mid, lsb):
+    msb &= 0x0F
+    return lsb + 256 * (mid + 256 * msb)
+
+
+def decode_dio_mapping(mapping_1, mapping_2):
+    """ Convert the DIO_MAPPING_1 and DIO_MAPPING_2 registers into a list of the DIO0..5 mappings.
+    :rtype: list[int]
+    """
+    return [mapping_1>>6 & 0x03, mapping_1>>4 & 0x03, mapping_1>>2 & 0x03, mapping_1>>0 & 0x03,
+            mapping_2>>6 & 0x03, mapping_2>>4 & 0x03]
+
+
+def decode_tcxo(tcxo):
+    """ 0 -> "XTAL", 1 -> "TCXO" """
+    return tcxo >> 4 & 0x01
+
+
+def decode_pa_dac(pa_dac):
+    """ True if the +20dBm option on PA_BOOST is on. """
+    pa_dac &= 0x07      # only bits 0-2
+    if pa_dac == 0x04:
+        return False
+    elif pa_dac == 0x07:
+        return True
+    else:
+        raise RuntimeError("Bad PA_DAC value %s" % hex(pa_dac))
+
+
+############################################## Whole-register-file status ##############################################
+
+LoRaStatus = collections.namedtuple('LoRaStatus', [
+    'registers', 'low_band', 'mode', 'freq', 'bw', 'coding_rate', 'implicit_header_mode', 'spreading_factor', 'rx_crc',
+    'tx_cont_mode', 'preamble', 'low_data_rate_optim', 'agc_auto_on', 'symb_timeout', 'hop_period', 'hop_channel',
+    'payload_length', 'max_payload_length', 'irq_flags_mask', 'irq_flags', 'rx_nb_bytes', 'rx_header_cnt',
+    'rx_packet_cnt', 'pkt_snr_value', 'pkt_rssi_value', 'rssi_value', 'fei', 'pa_select', 'max_power', 'output_power',
+    'ocp_on', 'ocp_trim', 'lna_gain', 'lna_boost_lf', 'lna_boost_hf', 'detect_optimize', 'detection_threshold',
+    'sync_word', 'dio_mapping', 'tcxo', 'pa_dac', 'fifo_addr_ptr', 'fifo_tx_base_addr', 'fifo_rx_base_addr',
+    'fifo_rx_curr_addr', 'fifo_rx_byte_addr', 'modem_status', 'version'])
+LoRaStatus.__doc__ = """ Immutable snapshot of the LoRa modem state, decoded from one register image.
+Power values are in dBm and the OCP trim is in mA, as printed by GenericLoRa.__str__.
+Flag fields hold read-only dicts, as returned by the corresponding getters. """
+
+
+def decode_status(registers, low_band):
+    """ Decode a full register image, e.g. from GenericLoRa.get_all_registers() or parse_register_dump().
+    Touches no hardware.
+    :param registers: Register values indexed by address, up to at least REG.LORA.PLL
+    :param low_band: True if the modem uses the low-band RF pins. Affects the RSSI values.
+    :rtype: LoRaStatus
+    """
+    r = tuple(registers)
+    if len(r) < N_REGISTERS:
+        raise ValueError("Need %d registers but got %d" % (N_REGISTERS, len(r)))
+    frozen = types.MappingProxyType
+    cfg1 = decode_modem_config_1(r[REG.LORA.MODEM_CONFIG_1])
+    cfg2 = decode_modem_config_2(r[REG.LORA.MODEM_CONFIG_2])
+    cfg3 = decode_modem_config_3(r[REG.LORA.MODEM_CONFIG_3])
+    pa_config = decode_pa_config(r[REG.LORA.PA_CONFIG], convert_dBm=True)
+    ocp = decode_ocp(r[REG.LORA.OCP], convert_mA=True)
+    lna = decode_lna(r[REG.LORA.LNA])
+    return LoRaStatus(
+        registers            = r,
+        low_band             = low_band,
+        mode                 = r[REG.LORA.OP_MODE],
+        freq                 = decode_freq(*r[REG.LORA.FR_MSB:REG.LORA.FR_LSB + 1]),
+        bw                   = cfg1['bw'],
+        coding_rate          = cfg1['coding_rate'],
+        implicit_header_mode = cfg1['implicit_header_mode'],
+        spreading_factor     = cfg2['spreading_factor'],
+        rx_crc               = cfg2['rx_crc'],
+        tx_cont_mode         = cfg2['tx_cont_mode'],
+        preamble             = r[REG.LORA.PREAMBLE_LSB] + 256 * r[REG.LORA.PREAMBLE_MSB],
+        low_data_rate_optim  = cfg3['low_data_rate_optim'],
+        agc_auto_on          = cfg3['agc_auto_on'],
+        symb_timeout         = decode_symb_timeout(r[REG.LORA.MODEM_CONFIG_2], r[REG.LORA.SYMB_TIMEOUT_LSB]),
+        hop_period           = r[REG.LORA.HOP_PERIOD],
+        hop_channel          = frozen(decode_hop_channel(r[REG.LORA.HOP_CHANNEL])),
+        payload_length       = r[REG.LORA.PAYLOAD_LENGTH],
+        max_payload_length   = r[REG.LORA.MAX_PAYLOAD_LENGTH],
+        irq_flags_mask       = frozen(decode_irq_flags(r[REG.LORA.IRQ_FLAGS_MASK])),
+        irq_flags            = frozen(decode_irq_flags(r[REG.LORA.IRQ_FLAGS])),
+        rx_nb_bytes          = r[REG.LORA.RX_NB_BYTES],
+        rx_header_cnt        = r[REG.LORA.RX_HEADER_CNT_MSB + 1] + 256 * r[REG.LORA.RX_HEADER_CNT_MSB],
+        rx_packet_cnt        = r[REG.LORA.RX_PACKET_CNT_MSB + 1] + 256 * r[REG.LORA.RX_PACKET_CNT_MSB],
+        pkt_snr_value        = decode_snr(r[REG.LORA.PKT_SNR_VALUE]),
+        pkt_rssi_value       = decode_rssi(r[REG.LORA.PKT_RSSI_VALUE], low_band),
+        rssi_value           = decode_rssi(r[REG.LORA.RSSI_VALUE], low_band),
+        fei                  = decode_fei(*r[REG.LORA.FEI_MSB:REG.LORA.FEI_MSB + 3]),
+        pa_select            = pa_config['pa_select'],
+        max_power            = pa_config['max_power'],
+        output_power         = pa_config['output_power'],
+        ocp_on               = ocp['ocp_on'],
+        ocp_trim             = ocp['ocp_trim'],
+        lna_gain             = lna['lna_gain'],
+        lna_boost_lf         = lna['lna_boost_lf'],
+        lna_boost_hf         = lna['lna_boost_hf'],
+        detect_optimize      = r[REG.LORA.DETECT_OPTIMIZE] & 0b111,
+        detection_threshold  = r[REG.LORA.DETECTION_THRESH],
+        sync_word            = r[REG.LORA.SYNC_WORD],
+        dio_mapping          = tuple(decode_dio_mapping(r[REG.LORA.DIO_MAPPING_1], r[REG.LORA.DIO_MAPPING_2])),
+        tcxo                 = decode_tcxo(r[REG.LORA.TCXO]),
+        pa_dac               = decode_pa_dac(r[REG.LORA.PA_DAC]),
+        fifo_addr_ptr        = r[REG.LORA.FIFO_ADDR_PTR],
+        fifo_tx_base_addr    = r[REG.LORA.FIFO_TX_BASE_ADDR],
+        fifo_rx_base_addr    = r[REG.LORA.FIFO_RX_BASE_ADDR],
+        fifo_rx_curr_addr    = r[REG.LORA.FIFO_RX_CURR_ADDR],
+        fifo_rx_byte_addr    = r[REG.LORA.FIFO_RX_BYTE_ADDR],
+        modem_status         = frozen(decode_modem_status(r[REG.LORA.MODEM_STAT])),
+        version              = r[REG.LORA.VERSION],
+    )
+
+
+def format_status(status):
+    """ Render a LoRaStatus in the format of GenericLoRa.__str__.
+    :rtype: str
+    """
+    onoff = lambda i: 'ON' if i else 'OFF'
+    s =  "SX127x LoRa registers:\n"
+    s += " mode               %s\n" % MODE.lookup.get(status.mode, hex(status.mode))
+    s += " freq               %f MHz\n" % status.freq
+    s += " coding_rate        %s\n" % CODING_RATE.lookup[status.coding_rate]
+    s += " bw                 %s\n" % BW.lookup[status.bw]
+    s += " spreading_factor   %s chips/symb\n" % (1 << status.spreading_factor)
+    s += " implicit_hdr_mode  %s\n" % onoff(status.implicit_header_mode)
+    s += " rx_payload_crc     %s\n" % onoff(status.rx_crc)
+    s += " tx_cont_mode       %s\n" % onoff(status.tx_cont_mode)
+    s += " preamble           %d\n" % status.preamble
+    s += " low_data_rate_opti %s\n" % onoff(status.low_data_rate_optim)
+    s += " agc_auto_on        %s\n" % onoff(status.agc_auto_on)
+    s += " symb_timeout       %s\n" % status.symb_timeout
+    s += " freq_hop_period    %s\n" % status.hop_period
+    s += " hop_channel        %s\n" % dict(status.hop_channel)
+    s += " payload_length     %s\n" % status.payload_length
+    s += " max_payload_length %s\n" % status.max_payload_length
+    s += " irq_flags_mask     %s\n" % dict(status.irq_flags_mask)
+    s += " irq_flags          %s\n" % dict(status.irq_flags)
+    s += " rx_nb_byte         %d\n" % status.rx_nb_bytes
+    s += " rx_header_cnt      %d\n" % status.rx_header_cnt
+    s += " rx_packet_cnt      %d\n" % status.rx_packet_cnt
+    s += " pkt_snr_value      %f\n" % status.pkt_snr_value
+    s += " pkt_rssi_value     %d\n" % status.pkt_rssi_value
+    s += " rssi_value         %d\n" % status.rssi_value
+    s += " fei                %d\n" % status.fei
+    s += " pa_select          %s\n" % PA_SELECT.lookup[status.pa_select]
+    s += " max_power          %f dBm\n" % status.max_power
+    s += " output_power       %f dBm\n" % status.output_power
+    s += " ocp                %s\n"     % onoff(status.ocp_on)
+    s += " ocp_trim           %f mA\n"  % status.ocp_trim
+    s += " lna_gain           %s\n" % GAIN.lookup[status.lna_gain]
+    s += " lna_boost_lf       %s\n" % bin(status.lna_boost_lf)
+    s += " lna_boost_hf       %s\n" % bin(status.lna_boost_hf)
+    s += " detect_optimize    %#02x\n" % status.detect_optimize
+    s += " detection_thresh   %#02x\n" % status.detection_threshold
+    s += " sync_word          %#02x\n" % status.sync_word
+    s += " dio_mapping 0..5   %s\n" % list(status.dio_mapping)
+    s += " tcxo               %s\n" % ['XTAL', 'TCXO'][status.tcxo]
+    s += " pa_dac             %s\n" % ['default', 'PA_BOOST'][status.pa_dac]
+    s += " fifo_addr_ptr      %#02x\n" % status.fifo_addr_ptr
+    s += " fifo_tx_base_addr  %#02x\n" % status.fifo_tx_base_addr
+    s += " fifo_rx_base_addr  %#02x\n" % status.fifo_rx_base_addr
+    s += " fifo_rx_curr_addr  %#02x\n" % status.fifo_rx_curr_addr
+    s += " fifo_rx_byte_addr  %#02x\n" % status.fifo_rx_byte_addr
+    s += " status             %s\n" % dict(status.modem_status)
+    s += " version            %#02x\n" % status.version
+    return s
+
+
+def dump_registers(registers):
+    """ List the named LoRa registers in a register image, except the FIFO.
+    :return: List of [reg_addr, reg_name, reg_value] tuples. reg_value is None if the image is too short.
+    :rtype: list[tuple]
+    """
+    skip_set = set([REG.LORA.FIFO])
+    result_list = []
+    for i, s in REG.LORA.lookup.items():
+        if i in skip_set:
+            continue
+        if i < len(registers):
+            v = registers[i]
+        else:
+            v = None
+        result_list.append((i, s, v))
+    return result_list
+
+
+############################################## Register dump files #####################################################
+
+# Matches a line of the dump format written by lora_util.py --dump, e.g. "1D     MODEM_CONFIG_1 72 01110010"
+REGISTER_DUMP_LINE = re.compile('([0-9A-F][0-9A-F]) +[0-9A-Z_]+ ([0-9A-F][0-9A-F]) [0-1]+')
+
+
+def parse_register_dump(lines):
+    """ Parse the register dump format written by lora_util.py --dump, such as SX127x.regdump.
+    Lines that do not describe a register are skipped.
+    :param lines: Iterable of lines, e.g. an open file
+    :return: List of (reg_addr, reg_value) tuples, in file order
+    :rtype: list[tuple]
+    """
+    result_list = []
+    for line in lines:
+        parsed = REGISTER_DUMP_LINE.match(line)
+        if parsed:
+            result_list.append((int(parsed.group(1), 16), int(parsed.group(2), 16)))
+    return result_list
+
+
+def registers_from_dump(lines):
+    """ Build a full register image from a register dump. Registers missing from the dump read as 0.
+    :param lines: Iterable of lines, e.g. an open file
+    :return: Register values indexed by address, suitable for decode_status()
+    :rtype: list[int]
+    """
+    registers = [0] * N_REGISTERS
+    for reg_addr, reg_value in parse_register_dump(lines):
+        if reg_addr < N_REGISTERS:
+            registers[reg_addr] = reg_value
+    return registers
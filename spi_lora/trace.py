@@ -0,0 +1,255 @@
+""" Defines TracingSpi, an SPI connection wrapper that records every transfer the driver makes, and its sinks. """
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import collections
+import struct
+import sys
+import time
+
+from .constants import REG
+from . import LoRa as _driver_module
+
+
+# One SPI transfer. timestamp is a time.time() value from the start of the transfer, direction is 'R' or 'W', address
+# is the register address (without the write bit), name is its name from REG.LORA, length is the number of data bytes
+# after the address byte, duration is in seconds, and method is the GenericLoRa method the application called, or None
+# if the transfer did not come from the driver. mosi and miso are the bytes sent and received, including the address
+# byte, if the tracer captures data, or else None.
+# Interrupts on DIO lines can be recorded as well, with direction 'D', the DIO number as address and length 0.
+SpiTrace = collections.namedtuple('SpiTrace', ['timestamp', 'direction', 'address', 'name', 'length', 'duration',
+                                               'method', 'mosi', 'miso'])
+
+# Transfers from code in these files are attributed to the outermost driver method on the stack
+_DRIVER_FILES = frozenset([_driver_module.__file__, _driver_module.GenericLoRa.get_registers.__code__.co_filename])
+
+
+def register_name(address):
+    return REG.LORA.lookup.get(address, '0x%02X' % address)
+
+
+def dio_trace(dio_number):
+    """ Make a SpiTrace for an interrupt on a DIO line. """
+    return SpiTrace(time.time(), 'D', dio_number, 'DIO%d' % dio_number, 0, 0., None, None, None)
+
+
+class TracingSpi(object):
+    """
+    Wraps a spidev.SpiDev and records every transfer through it.
+
+    Each transfer becomes a SpiTrace, which is counted in the per-register
+    and per-method aggregates and passed to every sink. A sink is any
+    function taking a SpiTrace; RingSink and FileSink are provided.
+
+    While tracing is disabled, the transfer methods of the wrapper are the
+    bound methods of the wrapped connection itself, so the only cost is one
+    attribute lookup. This makes it cheap enough to leave in place in
+    production and turn on when something looks wrong:
+
+        tracer = attach(lora, enabled=False)
+        ...
+        tracer.sinks.append(RingSink(10000))
+        tracer.enable()
+    """
+
+    TRANSFER_METHODS = ('xfer', 'xfer2', 'xfer3', 'writebytes2')
+
+    def __init__(self, spi, sinks=(), enabled=True, capture_data=False):
+        """
+        :param spi: The SPI connection to wrap
+        :param sinks: Functions to call with each SpiTrace
+        :param enabled: Whether to start tracing right away
+        :param capture_data: Record the bytes sent and received, not just the register and length
+        """
+        self.spi = spi
+        self.sinks = list(sinks)
+        self.capture_data = capture_data
+        self.enabled = False
+        self.reset_stats()
+        if enabled:
+            self.enable()
+        else:
+            self.disable()
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    @property
+    def max_speed_hz(self):
+        return self.spi.max_speed_hz
+
+    @max_speed_hz.setter
+    def max_speed_hz(self, value):
+        self.spi.max_speed_hz = value
+
+    def enable(self):
+        """ Start tracing. """
+        for name in self.TRANSFER_METHODS:
+            raw = getattr(self.spi, name, None)
+            setattr(self, name, None if raw is None else self._traced(raw, name == 'writebytes2'))
+        raw = getattr(self.spi, 'xfer_many', None)
+        self.xfer_many = None if raw is None else self._traced_many(raw)
+        self.enabled = True
+
+    def disable(self):
+        """ Stop tracing, and send transfers straight to the wrapped connection. """
+        for name in self.TRANSFER_METHODS:
+            setattr(self, name, getattr(self.spi, name, None))
+        self.xfer_many = getattr(self.spi, 'xfer_many', None)
+        self.enabled = False
+
+    def reset_stats(self):
+        # Aggregates are [transfers, bytes, seconds] lists, keyed by register name and by method name
+        self.by_register = collections.defaultdict(lambda: [0, 0, 0.])
+        self.by_method = collections.defaultdict(lambda: [0, 0, 0.])
+
+    def stats(self):
+        """ Get the aggregate counters.
+        :return: Dict with by_register and by_method dicts, each mapping a name to transfers, bytes and seconds
+        :rtype: dict
+        """
+        def convert(aggregates):
+            return {k: dict(transfers=v[0], bytes=v[1], seconds=v[2]) for k, v in aggregates.items()}
+        return dict(by_register=convert(self.by_register), by_method=convert(self.by_method))
+
+    def _traced(self, raw, write_only):
+        def transfer(data, *args):
+            timestamp = time.time()
+            start = time.perf_counter()
+            result = raw(data, *args)
+            duration = time.perf_counter() - start
+            self._record(data, None if write_only else result, timestamp, duration)
+            return result
+        return transfer
+
+    def _traced_many(self, raw):
+        def transfer_many(transfers, *args):
+            timestamp = time.time()
+            start = time.perf_counter()
+            results = raw(transfers, *args)
+            # The transfers went out in one call, so share its time between them
+            duration = (time.perf_counter() - start) / max(len(transfers), 1)
+            for data, result in zip(transfers, results):
+                self._record(data, result, timestamp, duration)
+            return results
+        return transfer_many
+
+    def _record(self, data, result, timestamp, duration):
+        method = None
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code.co_filename in _DRIVER_FILES:
+            # Skip the wrappers of the driver's method decorators, which run outside the method they wrap
+            if frame.f_code.co_name != 'wrapper':
+                method = frame.f_code.co_name
+            frame = frame.f_back
+        address = data[0] & 0x7F
+        name = register_name(address)
+        length = len(data) - 1
+        trace = SpiTrace(timestamp, 'W' if data[0] & 0x80 else 'R', address, name, length, duration, method,
+                         bytes(data) if self.capture_data else None,
+                         bytes(result) if self.capture_data and result is not None else None)
+        for aggregate in (self.by_register[name], self.by_method[method]):
+            aggregate[0] += 1
+            aggregate[1] += len(data)
+            aggregate[2] += duration
+        for sink in self.sinks:
+            sink(trace)
+
+
+def attach(lora, sinks=(), enabled=True, capture_data=False):
+    """ Put a TracingSpi between a GenericLoRa and its SPI connection.
+    :return: The TracingSpi
+    :rtype: TracingSpi
+    """
+    lora.spi = TracingSpi(lora.spi, sinks, enabled, capture_data)
+    return lora.spi
+
+
+class RingSink(object):
+    """ Keeps the last capacity traces in memory. """
+
+    def __init__(self, capacity=10000):
+        self.traces = collections.deque(maxlen=capacity)
+
+    def __call__(self, trace):
+        self.traces.append(trace)
+
+    def records(self):
+        return list(self.traces)
+
+
+# Binary trace files start with FILE_MAGIC. Each record is a RECORD_HEADER, then the method name, then, if the record
+# has data, the MOSI bytes and then the MISO bytes (or none for a write-only transfer), each length + 1 bytes long.
+FILE_MAGIC = b'SPITRC\x00\x01'
+RECORD_HEADER = struct.Struct('<dBBHIB')    # timestamp, flags, address, length, duration in ns, method name length
+FLAG_WRITE = 0x01
+FLAG_MOSI = 0x02
+FLAG_MISO = 0x04
+FLAG_DIO = 0x08
+
+
+class FileSink(object):
+    """ Writes traces to a binary file, which read_trace_file() reads back. """
+
+    def __init__(self, trace_file):
+        """
+        :param trace_file: File opened for binary writing
+        """
+        self.file = trace_file
+        self.file.write(FILE_MAGIC)
+
+    def __call__(self, trace):
+        method = (trace.method or '').encode('ascii')
+        flags = (FLAG_WRITE if trace.direction == 'W' else 0) | (FLAG_DIO if trace.direction == 'D' else 0) | \
+                (FLAG_MOSI if trace.mosi is not None else 0) | (FLAG_MISO if trace.miso is not None else 0)
+        self.file.write(RECORD_HEADER.pack(trace.timestamp, flags, trace.address, trace.length,
+                                           min(int(trace.duration * 1e9), 0xFFFFFFFF), len(method)))
+        self.file.write(method)
+        if trace.mosi is not None:
+            self.file.write(trace.mosi)
+        if trace.miso is not None:
+            self.file.write(trace.miso)
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace_file(trace_file):
+    """ Read the traces a FileSink wrote.
+    :param trace_file: File opened for binary reading
+    :return: Generator of SpiTrace
+    """
+    if trace_file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+        raise RuntimeError("Not an SPI trace file")
+    while True:
+        header = trace_file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, flags, address, length, duration_ns, method_length = RECORD_HEADER.unpack(header)
+        method = trace_file.read(method_length).decode('ascii') or None
+        mosi = trace_file.read(length + 1) if flags & FLAG_MOSI else None
+        miso = trace_file.read(length + 1) if flags & FLAG_MISO else None
+        if flags & FLAG_DIO:
+            yield SpiTrace(timestamp, 'D', address, 'DIO%d' % address, 0, 0., None, None, None)
+            continue
+        yield SpiTrace(timestamp, 'W' if flags & FLAG_WRITE else 'R', address, register_name(address), length,
+                       duration_ns / 1e9, method, mosi, miso)
@@ -0,0 +1,1128 @@
+#!/usr/bin/env python3
+
+""" Unit tests that run the driver against a fake SPI device, without any hardware. """
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+from spi_lora.LoRa import *
+from spi_lora.airtime import DutyCycleLedger
+from spi_lora.status import decode_status, format_status, registers_from_dump
+from spi_lora.profiles import RadioProfile, EU868_SF7BW125, EU868_SF12BW125
+from spi_lora.AsyncLoRa import AsyncLoRa
+from spi_lora.sim import RESET_REGISTERS
+from spi_lora.ring import PacketRing, DROP_NEWEST
+from spi_lora.trace import attach, FileSink, RingSink, read_trace_file
+from spi_lora.gateway import LoRaGateway, GatewayClient, encode_frame, read_frame
+from spi_lora.scheduler import SubBand, TxScheduler
+from spi_lora.spidev_ioc import (IocSpiDev, ioc_board, SPI_IOC_MESSAGE, SPI_IOC_TRANSFER, SPI_IOC_WR_MAX_SPEED_HZ,
+                                  SPI_IOC_MAX_TRANSFERS)
+from spi_lora.boards import BaseBoard
+from spi_lora.link import (LinkMonitor, calibrate_speed, calibrate_board, load_speed, apply_saved_speed,
+                           DEFAULT_SPEEDS)
+from spi_lora.gpiochip import (GpioChipBoard, GpioLines, GPIO_V2_GET_LINE_IOCTL, GPIO_V2_LINE_FLAG_INPUT,
+                               GPIO_V2_LINE_FLAG_EDGE_RISING, GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN, LINE_EVENT,
+                               LINE_REQUEST)
+import asyncio
+import ctypes
+import io
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import unittest.mock
+
+
+class FakeSpiDev(object):
+    """ Stands in for a spidev.SpiDev connected to an SX127x. Registers are plain memory and every transfer is logged.
+    The FIFO goes through FIFO_ADDR_PTR, IRQ flags are cleared by writing ones, and TX and CAD finish instantly.
+    """
+
+    def __init__(self):
+        self.registers = [RESET_REGISTERS.get(i, 0) for i in range(0x80)]
+        self.fifo = bytearray(256)
+        self.transfers = []
+        self.cad_detected = False
+
+    def xfer(self, data):
+        data = list(data)
+        self.transfers.append(data)
+        address = data[0] & 0x7F
+        write = data[0] & 0x80
+        result = [0]
+        for i, value in enumerate(data[1:]):
+            if address == REG.LORA.FIFO:
+                ptr = self.registers[REG.LORA.FIFO_ADDR_PTR]
+                result.append(self.fifo[ptr])
+                if write:
+                    self.fifo[ptr] = value
+                self.registers[REG.LORA.FIFO_ADDR_PTR] = (ptr + 1) & 0xFF
+                continue
+            a = (address + i) & 0x7F
+            result.append(self.registers[a])
+            if write and a == REG.LORA.IRQ_FLAGS:
+                self.registers[a] &= ~value
+            elif write:
+                self.registers[a] = value
+                if a == REG.LORA.OP_MODE:
+                    self.mode_changed(value)
+        return result
+
+    def mode_changed(self, mode):
+        if mode == MODE.TX:
+            self.registers[REG.LORA.IRQ_FLAGS] |= 0x08
+            self.registers[REG.LORA.OP_MODE] = MODE.STDBY
+        elif mode == MODE.CAD:
+            self.registers[REG.LORA.IRQ_FLAGS] |= 0x05 if self.cad_detected else 0x04
+            self.registers[REG.LORA.OP_MODE] = MODE.STDBY
+
+    def receive(self, payload, crc_error=False):
+        """ Pretend a packet came in. """
+        start = self.registers[REG.LORA.FIFO_RX_BASE_ADDR]
+        self.fifo[start:start + len(payload)] = payload
+        self.registers[REG.LORA.FIFO_RX_CURR_ADDR] = start
+        self.registers[REG.LORA.RX_NB_BYTES] = len(payload)
+        self.registers[REG.LORA.PKT_RSSI_VALUE] = 100
+        self.registers[REG.LORA.PKT_SNR_VALUE] = 20
+        self.registers[REG.LORA.IRQ_FLAGS] |= 0x70 if crc_error else 0x50
+
+    xfer2 = xfer
+
+    def xfer3(self, data):
+        return tuple(self.xfer(data))
+
+    def writebytes2(self, data):
+        self.xfer(data)
+
+    def writes(self):
+        """ Get the logged transfers that wrote registers. """
+        return [t for t in self.transfers if t[0] & 0x80]
+
+
+def make_lora(**kwargs):
+    spi = FakeSpiDev()
+    lora = GenericLoRa(spi, False, verbose=False, do_calibration=False, **kwargs)
+    spi.transfers = []
+    return spi, lora
+
+
+def reconfigure(lora):
+    """ Apply a typical channel change. """
+    lora.set_mode(MODE.STDBY)
+    lora.set_freq(868.1)
+    lora.set_bw(BW.BW125)
+    lora.set_coding_rate(CODING_RATE.CR4_5)
+    lora.set_spreading_factor(7)
+    lora.set_rx_crc(True)
+    lora.set_preamble(8)
+    lora.set_pa_config(pa_select=1, max_power=0x04, output_power=0x0F)
+    lora.set_ocp_trim(100)
+    lora.set_sync_word(0x34)
+
+
+class TestRegisterCache(unittest.TestCase):
+
+    def test_cache_saves_transfers(self):
+        spi, lora = make_lora()
+        reconfigure(lora)
+        uncached = len(spi.transfers)
+
+        spi, lora = make_lora(cache_registers=True)
+        reconfigure(lora)
+        cached = len(spi.transfers)
+        self.assertLess(cached, uncached)
+        # With a warm cache, only the changed registers get written and nothing is read
+        self.assertTrue(all(t[0] & 0x80 for t in spi.transfers))
+
+        # Reapplying the same configuration needs no transfers at all, except for the mode which isn't cached
+        spi.transfers = []
+        lora.set_mode(MODE.SLEEP)
+        spi.transfers = []
+        reconfigure(lora)
+        self.assertEqual(spi.transfers, [[REG.LORA.OP_MODE | 0x80, MODE.STDBY]])
+
+    def test_cached_values_match_modem(self):
+        spi, lora = make_lora(cache_registers=True)
+        reconfigure(lora)
+        for address in range(1, 0x71):
+            if RegisterCache.cacheable(address):
+                self.assertEqual(lora.get_register(address), spi.registers[address], hex(address))
+        self.assertEqual(lora.get_freq(), int(868.1 * 16384) / 16384.)
+        self.assertEqual(lora.get_modem_config_2()['spreading_factor'], 7)
+
+    def test_volatile_registers_not_cached(self):
+        spi, lora = make_lora(cache_registers=True)
+        spi.registers[REG.LORA.IRQ_FLAGS] = 0x40
+        spi.registers[REG.LORA.RSSI_VALUE] = 42
+        self.assertEqual(lora.get_irq_flags()['rx_done'], 1)
+        self.assertEqual(lora.get_rssi_value(), 42 - 157)
+        self.assertEqual(len(spi.transfers), 2)
+
+    def test_time_on_air_cached(self):
+        spi, lora = make_lora(cache_registers=True)
+        reconfigure(lora)
+        lora.duty_cycle = DutyCycleLedger(0.01)
+        lora.write_payload(b'x' * 10)
+        spi.transfers = []
+        lora.set_mode(MODE.TX)
+        # The ledger's airtime comes from the cache, so the mode write is the only transfer
+        self.assertEqual(spi.transfers, [[REG.LORA.OP_MODE | 0x80, MODE.TX]])
+        self.assertAlmostEqual(lora.duty_cycle.used(), lora.time_on_air(10))
+        self.assertEqual(len(spi.transfers), 1)
+
+    def test_hit_miss_counters(self):
+        spi, lora = make_lora(cache_registers=True)
+        hits = lora.register_cache.hits
+        lora.get_sync_word()
+        self.assertEqual(lora.register_cache.hits, hits + 1)
+        self.assertEqual(spi.transfers, [])
+        lora.set_sync_word(0x34)
+        self.assertEqual(lora.register_cache.misses, 1)
+        self.assertEqual(lora.register_cache.stats()['misses'], 1)
+
+    def test_resync(self):
+        spi, lora = make_lora(cache_registers=True)
+        # Change the modem behind the driver's back
+        spi.registers[REG.LORA.SYNC_WORD] = 0x34
+        self.assertEqual(lora.get_sync_word(), 0x12)
+        lora.resync()
+        self.assertEqual(lora.get_sync_word(), 0x34)
+
+    def test_fsk_mode_bypasses_cache(self):
+        spi, lora = make_lora(cache_registers=True)
+        lora.set_mode(MODE.FSK_STDBY)
+        lora.set_register(REG.FSK.IMAGE_CAL, 0x42)
+        self.assertEqual(lora.get_register(REG.FSK.IMAGE_CAL), 0x42)
+        lora.set_mode(MODE.STDBY)
+        # INVERT_IQ_2 shares its address with IMAGE_CAL, so it must come from the modem now
+        spi.transfers = []
+        lora.get_register(REG.LORA.INVERT_IQ_2)
+        self.assertEqual(len(spi.transfers), 1)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_snapshot_is_one_transfer(self):
+        spi, lora = make_lora()
+        status = lora.snapshot()
+        self.assertEqual(len(spi.transfers), 1)
+        self.assertEqual(status.freq, lora.get_freq())
+        self.assertEqual(status.sync_word, 0x12)
+        self.assertEqual(list(status.dio_mapping), lora.get_dio_mapping())
+        self.assertEqual(dict(status.irq_flags), lora.get_irq_flags())
+        self.assertEqual(status.symb_timeout, lora.get_symb_timeout())
+
+    def test_str_is_one_transfer(self):
+        spi, lora = make_lora()
+        text = str(lora)
+        self.assertEqual(len(spi.transfers), 1)
+        self.assertIn(" freq               434.000000 MHz\n", text)
+        self.assertIn(" sync_word          0x12\n", text)
+
+    def test_snapshot_is_immutable(self):
+        spi, lora = make_lora()
+        status = lora.snapshot()
+        with self.assertRaises(AttributeError):
+            status.freq = 868.
+        with self.assertRaises(TypeError):
+            status.irq_flags['rx_done'] = 1
+
+    def test_decode_regdump(self):
+        with open('SX127x.regdump') as dump_file:
+            registers = registers_from_dump(dump_file)
+        status = decode_status(registers, low_band=True)
+        self.assertEqual(status.mode, MODE.SLEEP)
+        self.assertEqual(status.freq, 434.)
+        self.assertEqual(status.bw, BW.BW125)
+        self.assertEqual(status.max_payload_length, 0xFF)
+        self.assertEqual(status.version, 0x12)
+        self.assertIn(" agc_auto_on        ON\n", format_status(status))
+
+
+def change_channel(lora):
+    """ What LoRaArgumentParser.parse_args does. """
+    lora.set_freq(868.3)
+    lora.set_preamble(12)
+    lora.set_spreading_factor(9)
+    lora.set_bw(BW.BW250)
+    lora.set_coding_rate(CODING_RATE.CR4_6)
+    lora.set_ocp_trim(120)
+
+
+class TestBatch(unittest.TestCase):
+
+    def check_batch(self, **kwargs):
+        naive_spi, naive_lora = make_lora(**kwargs)
+        change_channel(naive_lora)
+
+        spi, lora = make_lora(**kwargs)
+        with lora.batch():
+            change_channel(lora)
+        self.assertEqual(spi.registers, naive_spi.registers)
+        self.assertLess(len(spi.transfers), len(naive_spi.transfers))
+        return spi, naive_spi
+
+    def test_batch(self):
+        spi, naive_spi = self.check_batch()
+        # Every register is written once, and FR_MSB..LSB goes out in one burst
+        self.assertIn([REG.LORA.FR_MSB | 0x80, 0xD9, 0x13, 0x33], spi.writes())
+        addresses = [t[0] & 0x7F for t in spi.writes()]
+        self.assertEqual(addresses, sorted(set(addresses)))
+
+    def test_batch_with_cache(self):
+        spi, naive_spi = self.check_batch(cache_registers=True)
+        # Gaps get filled in from the cache, so FR_MSB..OCP and MODEM_CONFIG_1..PREAMBLE_LSB are one burst each
+        self.assertEqual([(t[0] & 0x7F, len(t) - 1) for t in spi.transfers],
+                         [(REG.LORA.FR_MSB, 6), (REG.LORA.MODEM_CONFIG_1, 5)])
+
+    def test_reads_see_pending_writes(self):
+        spi, lora = make_lora()
+        with lora.batch():
+            lora.set_sync_word(0x34)
+            self.assertEqual(lora.get_sync_word(), 0x34)
+            self.assertEqual(spi.registers[REG.LORA.SYNC_WORD], 0x12)
+        self.assertEqual(spi.registers[REG.LORA.SYNC_WORD], 0x34)
+
+    def test_volatile_write_keeps_order(self):
+        spi, lora = make_lora()
+        with lora.batch():
+            lora.set_sync_word(0x34)
+            lora.set_mode(MODE.STDBY)
+            lora.set_sync_word(0x12)
+        self.assertEqual(spi.writes(), [[REG.LORA.SYNC_WORD | 0x80, 0x34], [REG.LORA.OP_MODE | 0x80, MODE.STDBY],
+                                        [REG.LORA.SYNC_WORD | 0x80, 0x12]])
+
+    def test_exception_discards_batch(self):
+        spi, lora = make_lora()
+        with self.assertRaises(ValueError):
+            with lora.batch():
+                lora.set_sync_word(0x34)
+                raise ValueError()
+        self.assertEqual(spi.writes(), [])
+        self.assertEqual(lora.get_sync_word(), 0x12)
+
+
+class TestRadioProfile(unittest.TestCase):
+
+    def apply_by_setters(self, lora):
+        lora.set_mode(MODE.STDBY)
+        lora.set_freq(868.1)
+        lora.set_pa_config(pa_select=PA_SELECT.PA_BOOST, max_power=0x07, output_power=0x0F)
+        lora.set_pa_ramp(PA_RAMP.RAMP_40_us)
+        lora.set_ocp_trim(100)
+        lora.set_lna(lna_gain=GAIN.G1, lna_boost_lf=0, lna_boost_hf=0)
+        lora.set_bw(BW.BW125)
+        lora.set_coding_rate(CODING_RATE.CR4_5)
+        lora.set_implicit_header_mode(False)
+        lora.set_spreading_factor(7)
+        lora.set_rx_crc(True)
+        lora.set_symb_timeout(0x64)
+        lora.set_preamble(8)
+        lora.set_low_data_rate_optim(False)
+        lora.set_agc_auto_on(True)
+        lora.set_sync_word(0x12)
+
+    def test_profile_matches_setters(self):
+        naive_spi, naive_lora = make_lora()
+        self.apply_by_setters(naive_lora)
+
+        spi, lora = make_lora()
+        lora.set_mode(MODE.STDBY)
+        spi.transfers = []
+        lora.apply_profile(EU868_SF7BW125)
+        self.assertEqual(spi.registers, naive_spi.registers)
+        # Four bursts, against dozens of transfers for the setter chain
+        self.assertEqual(len(spi.transfers), 4)
+        self.assertGreater(len(naive_spi.transfers), 30)
+
+    def test_verify(self):
+        spi, lora = make_lora(cache_registers=True)
+        lora.apply_profile(EU868_SF12BW125, verify=True)
+        self.assertEqual(lora.get_modem_config_3()['low_data_rate_optim'], 1)
+        # Pretend the SYNC_WORD register is stuck
+        spi.registers[REG.LORA.SYNC_WORD] = 0x00
+        with self.assertRaises(RuntimeError):
+            lora.apply_profile(EU868_SF12BW125, verify=True)
+
+    def test_save_load(self):
+        dump_file = io.StringIO()
+        EU868_SF12BW125.save(dump_file)
+        dump_file.seek(0)
+        self.assertEqual(RadioProfile.load(dump_file), EU868_SF12BW125)
+
+    def test_load_regdump(self):
+        with open('SX127x.regdump') as dump_file:
+            profile = RadioProfile.load(dump_file)
+        self.assertEqual(len(profile.registers), 14)
+        self.assertEqual(profile.registers[REG.LORA.MODEM_CONFIG_1], 0x72)
+
+
+class TestAsyncLoRa(unittest.IsolatedAsyncioTestCase):
+
+    async def test_receive_polled(self):
+        spi, lora = make_lora()
+        async with AsyncLoRa(lora, poll_interval=0.001) as radio:
+            self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.RXCONT)
+            spi.receive(b'hello')
+            packet = await radio.receive(timeout=1)
+            self.assertEqual(packet.payload, b'hello')
+            self.assertTrue(packet.crc_ok)
+            self.assertEqual(packet.snr, 5.)
+            spi.receive(b'bad', crc_error=True)
+            async for packet in radio:
+                self.assertEqual(packet.payload, b'bad')
+                self.assertFalse(packet.crc_ok)
+                break
+            with self.assertRaises(asyncio.TimeoutError):
+                await radio.receive(timeout=0.01)
+        self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.SLEEP)
+
+    async def test_send_and_cad(self):
+        spi, lora = make_lora()
+        async with AsyncLoRa(lora, poll_interval=0.001) as radio:
+            await radio.send(b'ping', timeout=1)
+            self.assertIn([REG.LORA.FIFO | 0x80] + list(b'ping'), spi.writes())
+            # Back to listening afterwards
+            self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.RXCONT)
+            self.assertFalse(await radio.cad(timeout=1))
+            spi.cad_detected = True
+            self.assertTrue(await radio.cad(timeout=1))
+
+    async def test_events_from_other_thread(self):
+        callbacks = []
+        spi = FakeSpiDev()
+        lora = GenericLoRa(spi, False, add_events=lambda *cbs: callbacks.extend(cbs), verbose=False,
+                           do_calibration=False)
+        async with AsyncLoRa(lora) as radio:
+            self.assertIsNone(radio._poll_task)
+            spi.receive(b'irq')
+            threading.Thread(target=callbacks[0], args=(22,)).start()
+            packet = await radio.receive(timeout=1)
+            self.assertEqual(packet.payload, b'irq')
+
+    async def test_many_radios_one_loop(self):
+        spis, radios = [], []
+        for i in range(4):
+            spi, lora = make_lora()
+            spis.append(spi)
+            radios.append(AsyncLoRa(lora, poll_interval=0.001))
+            await radios[-1].start()
+        for i, spi in enumerate(spis):
+            spi.receive(bytes([i]))
+        packets = await asyncio.gather(*[radio.receive(timeout=1) for radio in radios])
+        self.assertEqual([p.payload for p in packets], [bytes([i]) for i in range(4)])
+        for radio in radios:
+            await radio.close()
+
+
+class TestRxPipeline(unittest.TestCase):
+
+    def test_ring_drop_oldest(self):
+        ring = PacketRing(3)
+        for i in range(5):
+            self.assertTrue(ring.push(i))
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.drain(), [2, 3, 4])
+        self.assertEqual(ring.dropped_oldest, 2)
+        self.assertIsNone(ring.get_nowait())
+
+    def test_ring_drop_newest(self):
+        ring = PacketRing(3, DROP_NEWEST)
+        self.assertEqual([ring.push(i) for i in range(5)], [True, True, True, False, False])
+        self.assertEqual(ring.drain(), [0, 1, 2])
+        self.assertEqual(ring.dropped, 2)
+        ring.push(5)
+        self.assertEqual(ring.get(timeout=0), 5)
+
+    def test_ring_overwritten_while_reading(self):
+        ring = PacketRing(2)
+        ring.push(0)
+        ring.push(1)
+        received = []
+        class Slots(list):
+            def __setitem__(self, index, packet):
+                list.__setitem__(self, index, packet)
+                # The consumer runs after the producer stored packet 2 over packet 0, but before it moved the head
+                received.append(ring.get_nowait())
+        ring._slots = Slots(ring._slots)
+        ring.push(2)
+        received.extend(ring.drain())
+        self.assertEqual(received, [1, 2])
+        self.assertEqual(ring.dropped_oldest, 1)
+
+    def test_ring_threads(self):
+        ring = PacketRing(4, DROP_NEWEST)
+        received = []
+        def consume():
+            for i in range(1000):
+                received.append(ring.get(timeout=5))
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        i = 0
+        while i < 1000:
+            if ring.push(i):
+                i += 1
+        consumer.join()
+        self.assertEqual(received, list(range(1000)))
+        self.assertIsNone(ring.get(timeout=0.01))
+
+    def test_pipeline(self):
+        spi, lora = make_lora()
+        ring = lora.start_rx_pipeline(capacity=2)
+        self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.RXCONT)
+        spi.transfers = []
+        for payload in (b'one', b'two', b'three'):
+            spi.receive(payload)
+            lora.handle_irq_flags()
+        # The modem was never taken out of RXCONT
+        self.assertNotIn(REG.LORA.OP_MODE | 0x80, [t[0] for t in spi.transfers])
+        self.assertEqual(spi.registers[REG.LORA.IRQ_FLAGS], 0)
+        packets = ring.drain()
+        self.assertEqual([p.payload for p in packets], [b'two', b'three'])
+        self.assertEqual(ring.dropped_oldest, 1)
+        self.assertTrue(packets[0].crc_ok)
+        self.assertEqual(packets[0].snr, 5.)
+        self.assertIs(lora.stop_rx_pipeline(), ring)
+        self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.STDBY)
+
+
+class TestPayload(unittest.TestCase):
+
+    def test_write_buffers(self):
+        spi, lora = make_lora()
+        for payload in (b'bytes', bytearray(b'bytearray'), memoryview(b'xxmemoryview')[2:], [1, 2, 3]):
+            lora.write_payload(payload)
+            self.assertEqual(spi.transfers[-1], [REG.LORA.FIFO | 0x80] + list(payload))
+            self.assertEqual(spi.registers[REG.LORA.PAYLOAD_LENGTH], len(payload))
+
+    def test_read(self):
+        spi, lora = make_lora()
+        spi.receive(b'hello')
+        self.assertEqual(lora.read_payload(nocheck=True), list(b'hello'))
+        self.assertEqual(lora.read_payload_bytes(nocheck=True), b'hello')
+        buf = bytearray(MAX_PAYLOAD_LENGTH)
+        self.assertEqual(lora.read_payload_into(buf, nocheck=True), 5)
+        self.assertEqual(buf[:5], b'hello')
+        with self.assertRaises(RuntimeError):
+            lora.read_payload_into(bytearray(4), nocheck=True)
+        # rx_is_good() fails with RxDone set
+        self.assertIsNone(lora.read_payload_into(buf))
+
+    def test_fetch_packet(self):
+        spi, lora = make_lora(cache_registers=True)
+        lora.start_rx_pipeline()
+        self.assertIsNone(lora.fetch_packet())
+        spi.receive(b'fused', crc_error=True)
+        spi.transfers = []
+        packet = lora.fetch_packet()
+        self.assertEqual(len(spi.transfers), 4)
+        self.assertEqual(packet.payload, b'fused')
+        self.assertFalse(packet.crc_ok)
+        self.assertEqual(packet.rssi, 100 - 157)
+        self.assertEqual(packet.snr, 5.)
+        self.assertEqual(spi.registers[REG.LORA.IRQ_FLAGS], 0)
+        self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.RXCONT)
+
+    def test_plain_xfer(self):
+        """ SPI connections without writebytes2() and xfer3() get lists of ints. """
+        class OldSpiDev(FakeSpiDev):
+            xfer3 = None
+            writebytes2 = None
+        spi = OldSpiDev()
+        lora = GenericLoRa(spi, False, verbose=False, do_calibration=False)
+        lora.write_payload(b'old')
+        spi.receive(b'spidev')
+        self.assertEqual(lora.read_payload_bytes(nocheck=True), b'spidev')
+
+    def test_buffers_allocate_less(self):
+        """ Micro-benchmark of the memory a packet's round trip allocates, by tracemalloc, on an SPI backend whose FIFO
+        bursts allocate nothing, so that what is measured is the driver's own allocations. """
+        class LeanSpiDev(FakeSpiDev):
+            def __init__(self):
+                FakeSpiDev.__init__(self)
+                self.responses = {length: bytearray(length) for length in range(MAX_PAYLOAD_LENGTH + 2)}
+
+            def xfer3(self, data):
+                response = self.responses[len(data)]
+                ptr = self.registers[REG.LORA.FIFO_ADDR_PTR]
+                for i in range(1, len(data)):
+                    response[i] = self.fifo[(ptr + i - 1) & 0xFF]
+                return response
+
+            def writebytes2(self, data):
+                ptr = self.registers[REG.LORA.FIFO_ADDR_PTR]
+                for i in range(1, len(data)):
+                    self.fifo[(ptr + i - 1) & 0xFF] = data[i]
+
+        def peak_allocation(operation, iterations=20):
+            """ Mean over the operations of the most memory allocated at once during each one. """
+            tracemalloc.start()
+            try:
+                total = 0
+                for i in range(iterations):
+                    spi.transfers = []
+                    before = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                    operation()
+                    total += tracemalloc.get_traced_memory()[1] - before
+                return total / iterations
+            finally:
+                tracemalloc.stop()
+
+        spi = LeanSpiDev()
+        lora = GenericLoRa(spi, False, verbose=False, do_calibration=False)
+        lora.set_mode(MODE.STDBY)
+        buf = bytearray(MAX_PAYLOAD_LENGTH)
+        buffer_peaks = []
+        # Register accesses allocate the same on both paths; the difference is in the payload
+        for length in (64, MAX_PAYLOAD_LENGTH):
+            payload = bytes(range(length))
+            payload_list = list(payload)
+            def list_path():
+                lora.write_payload(payload_list)
+                spi.receive(payload)
+                self.assertEqual(lora.read_payload(True), payload_list)
+            def buffer_path():
+                lora.write_payload(payload)
+                spi.receive(payload)
+                self.assertEqual(lora.read_payload_into(buf, True), length)
+            list_path()
+            buffer_path()
+            self.assertEqual(buf[:length], payload)
+            list_bytes = peak_allocation(list_path)
+            buffer_bytes = peak_allocation(buffer_path)
+            self.assertLess(buffer_bytes, list_bytes, length)
+            buffer_peaks.append(buffer_bytes)
+        # With a full FIFO the list's pointer per byte outweighs everything else a packet allocates
+        self.assertGreater(list_bytes - buffer_bytes, 4 * length)
+        # The buffer path copies the payload once on its way from the transfer into buf
+        self.assertLess(buffer_peaks[1] - buffer_peaks[0], 1.5 * (MAX_PAYLOAD_LENGTH - 64))
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_trace(self):
+        spi, lora = make_lora()
+        ring = RingSink()
+        calls = []
+        tracer = attach(lora, sinks=[ring, calls.append])
+        lora.set_mode(MODE.STDBY)
+        lora.set_freq(868.1)
+        lora.write_payload(b'abc')
+        traces = ring.records()
+        self.assertEqual(traces, calls)
+        self.assertEqual([(t.direction, t.name, t.method) for t in traces[:2]],
+                         [('W', 'OP_MODE', 'set_mode'), ('W', 'FR_MSB', 'set_freq')])
+        self.assertEqual(traces[-1].length, 3)
+        self.assertEqual(traces[-1].method, 'write_payload')
+        self.assertIsNone(traces[-1].mosi)
+        stats = tracer.stats()
+        self.assertEqual(stats['by_method']['write_payload']['transfers'], 4)
+        self.assertEqual(stats['by_register']['FIFO']['bytes'], 4)
+        self.assertEqual(stats['by_register']['FR_MSB'], dict(transfers=1, bytes=4, seconds=traces[1].duration))
+
+    def test_disabled(self):
+        spi, lora = make_lora()
+        ring = RingSink()
+        tracer = attach(lora, sinks=[ring], enabled=False)
+        # The raw methods, so tracing costs nothing while it is off
+        self.assertEqual(tracer.xfer, spi.xfer)
+        lora.set_freq(868.1)
+        self.assertEqual(ring.records(), [])
+        tracer.enable()
+        lora.set_freq(868.3)
+        self.assertEqual(len(ring.records()), 1)
+
+    def test_file(self):
+        spi, lora = make_lora()
+        trace_file = io.BytesIO()
+        attach(lora, sinks=[FileSink(trace_file)], capture_data=True)
+        lora.set_mode(MODE.STDBY)
+        lora.write_payload(b'xyz')
+        spi.receive(b'hello')
+        lora.fetch_packet()
+        trace_file.seek(0)
+        traces = list(read_trace_file(trace_file))
+        self.assertEqual(traces[0].mosi, bytes([REG.LORA.OP_MODE | 0x80, MODE.STDBY]))
+        fifo_writes = [t for t in traces if t.name == 'FIFO' and t.direction == 'W']
+        self.assertEqual(fifo_writes[0].mosi[1:], b'xyz')
+        self.assertIsNone(fifo_writes[0].miso)
+        fifo_reads = [t for t in traces if t.name == 'FIFO' and t.direction == 'R']
+        self.assertEqual(fifo_reads[0].miso[1:], b'hello')
+        self.assertEqual(fifo_reads[0].method, 'fetch_packet')
+
+
+class TestCad(unittest.TestCase):
+
+    def test_events(self):
+        spi = FakeSpiDev()
+        callbacks = []
+        lora = GenericLoRa(spi, False, add_events=lambda *args: callbacks.extend(args), verbose=False,
+                           do_calibration=False)
+        handled = []
+        lora.on_cad_done = lambda: handled.append('cad_done')
+        lora.set_dio_mapping([1, 0, 0, 0, 0, 0])
+        spi.cad_detected = True
+        def mode_changed(mode, fake_mode_changed=spi.mode_changed):
+            fake_mode_changed(mode)
+            if mode == MODE.CAD:
+                # The modem raises DIO0 for CadDone
+                callbacks[0](0)
+        spi.mode_changed = mode_changed
+        self.assertTrue(lora.cad())
+        spi.cad_detected = False
+        self.assertFalse(lora.cad())
+        # The application's handler did not see the CAD, and its TxDone mapping is back
+        self.assertEqual(handled, [])
+        self.assertEqual(lora.get_dio_mapping()[0], 1)
+        self.assertEqual(spi.registers[REG.LORA.IRQ_FLAGS], 0)
+        self.assertEqual(lora.mode, MODE.STDBY)
+
+    def test_polled(self):
+        spi, lora = make_lora()
+        spi.cad_detected = True
+        self.assertTrue(lora.cad())
+        self.assertEqual(spi.registers[REG.LORA.IRQ_FLAGS], 0)
+        self.assertNotIn(REG.LORA.DIO_MAPPING_1 | 0x80, [t[0] for t in spi.transfers])
+
+
+class TestGateway(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.spi, lora = make_lora()
+        self.radio = AsyncLoRa(lora, poll_interval=0.001)
+        await self.radio.start()
+        self.gateway = LoRaGateway(self.radio, tx_queue_size=2)
+        server = await self.gateway.start_tcp('127.0.0.1', 0)
+        self.port = server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        await self.gateway.close()
+        await self.radio.close()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.addAsyncCleanup(writer.wait_closed)
+        self.addCleanup(writer.close)
+        return reader, writer
+
+    async def wait_for_clients(self, count):
+        while len(self.gateway.clients) < count:
+            await asyncio.sleep(0.001)
+
+    async def test_fan_out(self):
+        clients = [await self.connect() for i in range(3)]
+        await self.wait_for_clients(3)
+        self.spi.receive(b'hello')
+        for reader, writer in clients:
+            self.assertEqual(await asyncio.wait_for(read_frame(reader), 1), b'hello')
+        stats = self.gateway.stats()['clients']
+        self.assertEqual(sorted(c['rx_delivered'] for c in stats.values()), [1, 1, 1])
+
+    async def test_transmit_queue(self):
+        reader, writer = await self.connect()
+        payloads = [bytes([i]) * 10 for i in range(8)]
+        # Many more packets than the TX queue holds; none may be lost
+        writer.write(b''.join(encode_frame(p) for p in payloads))
+        await writer.drain()
+        while sum(c.tx_sent for c in self.gateway.clients) < len(payloads):
+            await asyncio.sleep(0.001)
+        fifo_writes = [bytes(t[1:]) for t in self.spi.writes() if t[0] == REG.LORA.FIFO | 0x80]
+        self.assertEqual(fifo_writes, payloads)
+        (stats,) = self.gateway.stats()['clients'].values()
+        self.assertEqual(stats['tx_pending'], 0)
+        self.assertEqual(stats['tx_latency']['count'], len(payloads))
+
+    async def test_send_failure(self):
+        send = self.radio.send
+        async def fail_once(payload, timeout=None):
+            self.radio.send = send
+            raise OSError("SPI transfer failed")
+        self.radio.send = fail_once
+        reader, writer = await self.connect()
+        writer.write(encode_frame(b'first') + encode_frame(b'') + encode_frame(b'second'))
+        await writer.drain()
+        while not any(c.tx_sent for c in self.gateway.clients):
+            await asyncio.sleep(0.001)
+        # The first packet failed and the empty one was dropped, but the TX task kept going
+        fifo_writes = [bytes(t[1:]) for t in self.spi.writes() if t[0] == REG.LORA.FIFO | 0x80]
+        self.assertEqual(fifo_writes, [b'second'])
+        (stats,) = self.gateway.stats()['clients'].values()
+        self.assertEqual((stats['tx_sent'], stats['tx_failed'], stats['tx_pending']), (1, 1, 0))
+
+    async def test_lost_tx_done(self):
+        self.gateway.tx_timeout_margin = 0.01
+        mode_changed = self.spi.mode_changed
+        def lose_tx_done(mode):
+            if mode != MODE.TX:
+                return mode_changed(mode)
+            # The first TxDone never comes
+            self.spi.mode_changed = mode_changed
+        self.spi.mode_changed = lose_tx_done
+        reader, writer = await self.connect()
+        writer.write(encode_frame(b'lost') + encode_frame(b'sent'))
+        await writer.drain()
+        while not any(c.tx_sent for c in self.gateway.clients):
+            await asyncio.sleep(0.001)
+        (stats,) = self.gateway.stats()['clients'].values()
+        self.assertEqual((stats['tx_sent'], stats['tx_failed']), (1, 1))
+        # The modem was taken out of TX when the first packet timed out
+        modes = [t[1] for t in self.spi.writes() if t[0] == REG.LORA.OP_MODE | 0x80]
+        self.assertEqual(modes[modes.index(MODE.TX) + 1], MODE.STDBY)
+
+    async def test_slow_client_drops_oldest(self):
+        client = GatewayClient('slow', None, 2)
+        for i in range(5):
+            client.deliver(RxPacket(bytes([i]), -50, 5., True, 0.))
+        self.assertEqual(client.rx_dropped, 3)
+        self.assertEqual([client.rx_queue.get_nowait().payload for i in range(2)], [b'\x03', b'\x04'])
+
+    async def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'gateway.sock')
+        await self.gateway.start_unix(path)
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(encode_frame(b'unix'))
+        await writer.drain()
+        while not any(t[0] == REG.LORA.FIFO | 0x80 for t in self.spi.writes()):
+            await asyncio.sleep(0.001)
+        writer.close()
+        await writer.wait_closed()
+        os.unlink(path)
+
+    async def test_duty_cycle(self):
+        self.radio.lora.set_mode(MODE.STDBY)
+        self.radio.lora.set_freq(868.1)
+        # 0.1 s of airtime to start with, then 1 ms per second
+        self.gateway.scheduler = TxScheduler(self.radio.lora, [SubBand('test', 868., 869., 0.001)], window=100.)
+        reader, writer = await self.connect()
+        writer.write(b''.join(encode_frame(p) for p in (b'x' * 10, b'y' * 10, b'z' * 10, b'w' * 200)))
+        await writer.drain()
+        while self.gateway.scheduler.stats()['queue_depth'] < 1:
+            await asyncio.sleep(0.001)
+        stats = self.gateway.stats()
+        (client,) = stats['clients'].values()
+        self.assertEqual(client['tx_sent'], 2)
+        self.assertEqual(stats['scheduler']['sent'], 2)
+        self.assertAlmostEqual(stats['scheduler']['sub_bands']['test']['airtime'], 2 * self.radio.lora.time_on_air(10))
+
+
+
+class TestGpioChip(unittest.TestCase):
+    """ Runs the character device code against a mocked ioctl, which hands out one end of a pipe as the line fd. """
+
+    def setUp(self):
+        handle, self.chip = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.unlink, self.chip)
+        self.requests = []
+        self.line_fd, self.kernel_fd = os.pipe()
+        self.addCleanup(os.close, self.kernel_fd)
+        patcher = unittest.mock.patch('fcntl.ioctl', self.ioctl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ioctl(self, fd, request, buf, mutate):
+        self.assertEqual(request, GPIO_V2_GET_LINE_IOCTL)
+        self.requests.append(LINE_REQUEST.unpack(buf))
+        buf[-4:] = self.line_fd.to_bytes(4, 'little', signed=True)
+        return 0
+
+    def edge(self, offset, timestamp_ns, line_seqno):
+        os.write(self.kernel_fd, LINE_EVENT.pack(timestamp_ns, 1, offset, line_seqno, line_seqno))
+
+    def test_line_request(self):
+        lines = GpioLines(self.chip, [22, 4], lambda *args: None, bias='pull_down', debounce_us={4: 300000})
+        self.addCleanup(lines.close)
+        request = self.requests[0]
+        self.assertEqual(request[:3], (22, 4, 0))
+        self.assertEqual(request[64].rstrip(b'\0'), b'spi-lora')
+        self.assertEqual(request[65], GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_RISING |
+                                      GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN)
+        self.assertEqual(request[66], 1)
+        # The debounce attribute: id, padding, period and a mask selecting the second line
+        self.assertEqual(request[72:76], (3, 0, 300000, 0b10))
+        self.assertEqual(request[-8], 2)
+        self.assertEqual(lines.fileno(), self.line_fd)
+
+    def test_read_events(self):
+        events = []
+        lines = GpioLines(self.chip, [22, 23], lambda *args: events.append(args))
+        self.addCleanup(lines.close)
+        self.assertEqual(lines.read_events(), 0)
+        self.edge(22, 1500000000, 1)
+        self.edge(23, 2000000000, 1)
+        self.edge(22, 2500000000, 4)
+        self.assertEqual(lines.read_events(), 3)
+        self.assertEqual(events, [(22, 1.5), (23, 2.), (22, 2.5)])
+        self.assertEqual(lines.missed, 2)
+
+    def test_board_thread(self):
+        chip = self.chip
+        class BOARD(GpioChipBoard):
+            GPIO_CHIP = chip
+            DIO0 = 22
+            DIO1 = 23
+        spi = FakeSpiDev()
+        received = []
+        done = threading.Event()
+        class MyLoRa(GenericLoRa):
+            def on_tx_done(self):
+                received.append(self.irq_timestamp)
+                done.set()
+        lora = MyLoRa(spi, False, add_events=BOARD.add_events, verbose=False, do_calibration=False)
+        self.addCleanup(BOARD.teardown)
+        self.assertTrue(lora.irq_events_available)
+        self.assertEqual(self.requests[0][:3], (22, 23, 0))
+        lora.set_dio_mapping([1, 0, 0, 0, 0, 0])
+        self.edge(22, 1234500000000, 1)
+        self.assertTrue(done.wait(5))
+        # The handler saw the kernel's timestamp, not the time the event was read
+        self.assertEqual(received, [1234.5])
+        BOARD.release_events()
+        self.assertIsNone(BOARD.irq_lines)
+
+    def test_pipeline_timestamp(self):
+        chip = self.chip
+        class BOARD(GpioChipBoard):
+            GPIO_CHIP = chip
+            DIO0 = 22
+        spi = FakeSpiDev()
+        lora = GenericLoRa(spi, False, add_events=BOARD.add_events, verbose=False, do_calibration=False)
+        self.addCleanup(BOARD.teardown)
+        ring = lora.start_rx_pipeline()
+        spi.receive(b'stamped')
+        self.edge(22, 99000000000, 1)
+        packet = ring.get(timeout=5)
+        self.assertEqual(packet.payload, b'stamped')
+        self.assertEqual(packet.timestamp, 99.)
+
+
+class TestIocSpiDev(unittest.TestCase):
+    """ Runs IocSpiDev against a mocked ioctl, which decodes the transfer structs and passes them to a FakeSpiDev. """
+
+    def setUp(self):
+        self.device = FakeSpiDev()
+        self.messages = []
+        self.speeds = []
+        patcher = unittest.mock.patch('fcntl.ioctl', self.ioctl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.spi = IocSpiDev()
+        self.spi.fd = 3
+
+    def ioctl(self, fd, request, buf, mutate=True):
+        self.assertEqual(fd, 3)
+        if request == SPI_IOC_WR_MAX_SPEED_HZ:
+            self.speeds.append(int.from_bytes(buf, 'little'))
+            return 0
+        count = len(buf) // SPI_IOC_TRANSFER.size
+        self.assertEqual(request, SPI_IOC_MESSAGE(count))
+        message = []
+        for i in range(count):
+            tx, rx, length, speed, delay, bits, cs_change = SPI_IOC_TRANSFER.unpack_from(buf, i * SPI_IOC_TRANSFER.size)[:7]
+            result = self.device.xfer(ctypes.string_at(tx, length))
+            ctypes.memmove(rx, bytes(result), length)
+            message.append((length, cs_change))
+        self.messages.append(message)
+        return 0
+
+    def test_constants(self):
+        self.assertEqual(SPI_IOC_TRANSFER.size, 32)
+        self.assertEqual(SPI_IOC_MESSAGE(1), 0x40206b00)
+        self.assertEqual(SPI_IOC_WR_MAX_SPEED_HZ, 0x40046b04)
+        self.assertEqual(SPI_IOC_MAX_TRANSFERS, 511)
+
+    def test_xfer(self):
+        self.assertEqual(self.spi.xfer([REG.LORA.SYNC_WORD | 0x80, 0x34]), [0, 0x12])
+        self.assertEqual(self.spi.xfer3(bytes([REG.LORA.SYNC_WORD, 0])), (0, 0x34))
+        self.assertEqual(self.messages, [[(2, 0)], [(2, 0)]])
+
+    def test_xfer_many(self):
+        results = self.spi.xfer_many([[REG.LORA.SYNC_WORD | 0x80, 0x34], [REG.LORA.SYNC_WORD, 0]])
+        self.assertEqual(results, [[0, 0x12], [0, 0x34]])
+        # One ioctl, with the chip select released between the transfers
+        self.assertEqual(self.messages, [[(2, 1), (2, 0)]])
+        self.assertEqual((self.spi.ioctls, self.spi.transfers), (1, 2))
+
+    def test_split(self):
+        spi = IocSpiDev(max_transfers=2, bufsiz=8)
+        spi.fd = 3
+        results = spi.xfer_many([[REG.LORA.VERSION, 0]] * 3 + [[REG.LORA.FIFO, 0, 0, 0, 0, 0, 0]])
+        self.assertEqual([r[1] for r in results[:3]], [0x12] * 3)
+        self.assertEqual(self.messages, [[(2, 1), (2, 0)], [(2, 0)], [(7, 0)]])
+        with self.assertRaises(ValueError):
+            spi.xfer_many([[REG.LORA.FIFO] + [0] * 8])
+
+    def test_board(self):
+        BOARD = ioc_board(BaseBoard.derive(spi_cs=1))
+        with unittest.mock.patch('os.open', return_value=3) as os_open:
+            spi = BOARD.SpiDev()
+        os_open.assert_called_once_with('/dev/spidev0.1', os.O_RDWR)
+        self.assertIs(BOARD.spi, spi)
+        self.assertEqual(self.speeds, [BOARD.max_speed_hz])
+
+    def test_lora(self):
+        lora = GenericLoRa(self.spi, False, verbose=False, do_calibration=False, cache_registers=True)
+        # Once the ioctl is no longer mocked, the modem goes to sleep through the device itself
+        self.addCleanup(setattr, lora, 'spi', self.device)
+        self.messages = []
+        lora.apply_profile(EU868_SF12BW125)
+        # The profile's writes all go in one ioctl
+        batch = [m for m in self.messages if len(m) > 1]
+        self.assertEqual(len(batch), 1)
+        self.assertEqual([cs_change for length, cs_change in batch[0]], [1] * (len(batch[0]) - 1) + [0])
+        naive_spi, naive_lora = make_lora(cache_registers=True)
+        naive_lora.apply_profile(EU868_SF12BW125)
+        self.assertEqual(self.device.registers, naive_spi.registers)
+        lora.write_payload(b'ioctl')
+        base = lora.get_fifo_tx_base_addr()
+        self.assertEqual(bytes(self.device.fifo[base:base + 5]), b'ioctl')
+        lora.set_fifo_addr_ptr(base)
+        self.assertEqual(lora._read_fifo(5), b'ioctl')
+
+
+class FlakySpiDev(FakeSpiDev):
+    """ A FakeSpiDev whose reads get bit errors when clocked faster than limit. """
+
+    def __init__(self, limit):
+        FakeSpiDev.__init__(self)
+        self.limit = limit
+        self.max_speed_hz = 1000000
+
+    def xfer(self, data):
+        result = FakeSpiDev.xfer(self, data)
+        if self.max_speed_hz > self.limit:
+            result[1::7] = [v ^ 0x01 for v in result[1::7]]
+        return result
+
+    xfer2 = xfer
+
+
+class TestLink(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(self.path)
+        self.addCleanup(lambda: os.path.exists(self.path) and os.unlink(self.path))
+
+    def test_calibrate(self):
+        spi = FlakySpiDev(6000000)
+        spi.registers[REG.LORA.OP_MODE] = MODE.SLEEP
+        spi.registers[REG.LORA.SYNC_WORD] = 0x34
+        spi.registers[REG.LORA.FIFO_ADDR_PTR] = 0x80
+        spi.fifo[:5] = b'hello'
+        calibration = calibrate_speed(spi)
+        # 8MHz gives errors, 6MHz doesn't, and one step of margin leaves 5MHz
+        self.assertEqual(list(calibration.errors), [1000000, 2000000, 4000000, 5000000, 6000000, 8000000])
+        self.assertGreater(calibration.errors[8000000], 0)
+        self.assertEqual(calibration.speed, 5000000)
+        self.assertEqual(spi.max_speed_hz, 5000000)
+        # The registers and FIFO bytes used are put back
+        self.assertEqual(spi.registers[REG.LORA.OP_MODE], MODE.SLEEP)
+        self.assertEqual(spi.registers[REG.LORA.SYNC_WORD], 0x34)
+        self.assertEqual(spi.registers[REG.LORA.FIFO_ADDR_PTR], 0x80)
+        self.assertEqual(bytes(spi.fifo[:5]), b'hello')
+
+    def test_calibrate_all_good(self):
+        spi = FlakySpiDev(10000000)
+        spi.registers[REG.LORA.OP_MODE] = MODE.STDBY
+        calibration = calibrate_speed(spi, margin=0)
+        self.assertEqual(calibration.speed, DEFAULT_SPEEDS[-1])
+        self.assertEqual(set(calibration.errors.values()), {0})
+
+    def test_calibrate_fails(self):
+        spi = FlakySpiDev(0)
+        spi.registers[REG.LORA.OP_MODE] = MODE.SLEEP
+        spi.max_speed_hz = 3000000
+        with self.assertRaises(RuntimeError):
+            calibrate_speed(spi)
+        self.assertEqual(spi.max_speed_hz, 3000000)
+        spi.registers[REG.LORA.OP_MODE] = MODE.FSK_STDBY
+        with self.assertRaises(RuntimeError):
+            calibrate_speed(spi)
+        self.assertEqual(spi.max_speed_hz, 3000000)
+
+    def test_saved_speed(self):
+        spi = FlakySpiDev(4000000)
+        spi.registers[REG.LORA.OP_MODE] = MODE.SLEEP
+        class BOARD(BaseBoard):
+            @classmethod
+            def SpiDev(cls, spi_bus=0, spi_cs=0):
+                return spi
+        self.assertIsNone(load_speed(BOARD, self.path))
+        calibration = calibrate_board(BOARD, self.path)
+        self.assertEqual(calibration.speed, 2000000)
+        self.assertEqual(BOARD.max_speed_hz, 2000000)
+        OTHER = BOARD.derive(spi_cs=1)
+        self.assertIsNone(apply_saved_speed(OTHER, self.path))
+        self.assertEqual(OTHER.max_speed_hz, 2000000)
+        del BOARD.max_speed_hz
+        self.assertEqual(apply_saved_speed(BOARD, self.path), 2000000)
+        self.assertEqual(BOARD.max_speed_hz, 2000000)
+
+    def test_monitor(self):
+        spi, lora = make_lora(cache_registers=True)
+        reconfigure(lora)
+        monitor = LinkMonitor(lora)
+        self.assertTrue(monitor.check())
+        # The modem lost a setting
+        spi.registers[REG.LORA.SYNC_WORD] = 0x12
+        self.assertFalse(monitor.check())
+        self.assertEqual(spi.registers[REG.LORA.SYNC_WORD], 0x34)
+        self.assertTrue(monitor.check())
+        # A bit error on one read only
+        xfer = spi.xfer
+        def flaky(data):
+            spi.xfer = xfer
+            result = xfer(data)
+            result[1 + REG.LORA.MODEM_CONFIG_1 - monitor.first] ^= 0x10
+            return result
+        spi.xfer = flaky
+        self.assertFalse(monitor.check())
+        stats = monitor.stats()
+        self.assertEqual(stats['checks'], 4)
+        self.assertEqual(stats['read_errors'], 1)
+        self.assertEqual(stats['config_errors'], 1)
+        self.assertEqual(stats['repaired'], 1)
+        self.assertEqual(stats['by_register'], {'SYNC_WORD': 1, 'MODEM_CONFIG_1': 1})
+        self.assertEqual(stats['latency']['count'], 4)
+        lora.set_mode(MODE.FSK_STDBY)
+        self.assertIsNone(monitor.check())
+        self.assertEqual(monitor.stats()['skipped'], 1)
+
+    def test_monitor_thread(self):
+        spi, lora = make_lora(cache_registers=True)
+        monitor = LinkMonitor(lora)
+        monitor.start(interval=0.001)
+        deadline = time.monotonic() + 5
+        while monitor.checks < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        monitor.stop()
+        self.assertGreaterEqual(monitor.checks, 3)
+        self.assertEqual(monitor.config_errors + monitor.read_errors, 0)
+        with self.assertRaises(ValueError):
+            LinkMonitor(make_lora()[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
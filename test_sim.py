@@ -0,0 +1,851 @@
+#!/usr/bin/env python3
+
+""" Tests that run whole send and receive flows between simulated radios. """
+
+# Copyright 2021 Adam Novak
+#
+# This file is part of spi-lora.
+#
+# spi-lora is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# spi-lora is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You can be released from the requirements of the license by obtaining a commercial license. Such a license is
+# mandatory as soon as you develop commercial activities involving spi-lora without disclosing the source code of your
+# own applications, or shipping spi-lora with a closed source product.
+#
+# You should have received a copy of the GNU General Public License aling with spi-lora.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+from spi_lora.LoRa import *
+from spi_lora.AsyncLoRa import AsyncLoRa
+from spi_lora.airtime import (AirtimeParams, DutyCycleExceeded, DutyCycleLedger, time_on_air, time_on_air_table,
+                              payload_symbols)
+from spi_lora.bench import run_benchmarks
+from spi_lora.boards import BaseBoard
+from spi_lora.bus import BACKGROUND, IRQ, NORMAL, SpiBus
+from spi_lora.channels import AS923, EU868, US915, ChannelPlan
+from spi_lora.fhss import FhssEngine
+from spi_lora.lbt import ChannelBusy, ListenBeforeTalk
+from spi_lora.poller import IrqPoller
+from spi_lora.pool import RadioPool
+from spi_lora.replay import Recorder, ReplaySpi, ReplayDivergence
+from spi_lora.scheduler import EXPIRED, REJECTED, SENT, SubBand, TxScheduler
+from spi_lora.sim import SimChannel, SimulatedSX127x, sim_board
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+import unittest
+
+
+def make_radio(channel, dio_lines=True, wrap_board=None):
+    board = sim_board(channel=channel, dio_lines=dio_lines)
+    lora = LoRa(wrap_board(board) if wrap_board else board, verbose=False)
+    configure(lora)
+    return board.radio, lora
+
+
+def configure(lora):
+    lora.set_mode(MODE.STDBY)
+    with lora.batch():
+        lora.set_freq(868.1)
+        lora.set_spreading_factor(7)
+        lora.set_bw(BW.BW125)
+        lora.set_rx_crc(True)
+
+
+class TestSimulatedSX127x(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = SimChannel()
+        self.radio_a, self.lora_a = make_radio(self.channel)
+        self.radio_b, self.lora_b = make_radio(self.channel)
+
+    def test_calibration(self):
+        # LoRa() ran rx_chain_calibration, which would spin forever if ImageCalRunning stayed set
+        self.assertEqual(self.lora_a.get_version(), 0x12)
+        self.assertAlmostEqual(self.lora_a.get_freq(), 868.1, places=3)
+
+    def test_time_on_air(self):
+        # 10 bytes at SF7, BW125, CR4/5, explicit header, CRC on, 8 symbol preamble
+        self.assertAlmostEqual(time_on_air(10), 0.041216)
+        self.assertAlmostEqual(self.radio_a.time_on_air(10), 0.041216)
+
+    def test_send_receive(self):
+        received = []
+        self.lora_b.on_rx_done = lambda: received.append(self.lora_b.fetch_packet())
+        self.lora_b.set_dio_mapping([0] * 6)
+        self.lora_b.reset_ptr_rx()
+        self.lora_b.set_mode(MODE.RXCONT)
+        self.lora_a.set_dio_mapping([1, 0, 0, 0, 0, 0])
+        tx_done = []
+        self.lora_a.on_tx_done = lambda: tx_done.append(self.channel.time)
+        for payload in (b'hello', b'world'):
+            self.lora_a.write_payload(payload)
+            self.lora_a.set_mode(MODE.TX)
+            self.assertEqual(self.lora_a.get_mode(), MODE.TX)
+            self.channel.run()
+            self.assertEqual(self.lora_a.get_mode(), MODE.STDBY)
+        self.assertEqual([p.payload for p in received], [b'hello', b'world'])
+        self.assertTrue(received[0].crc_ok)
+        self.assertEqual(received[0].rssi, -60)
+        self.assertEqual(received[0].snr, 9.5)
+        self.assertAlmostEqual(tx_done[0], self.radio_a.time_on_air(5))
+        self.assertEqual(self.lora_b.get_rx_packet_cnt(), 2)
+        self.assertEqual(self.lora_b.get_mode(), MODE.RXCONT)
+
+    def test_fast_forward_polling(self):
+        ring = self.lora_b.start_rx_pipeline()
+        self.lora_a.write_payload(b'poll')
+        self.lora_a.set_mode(MODE.TX)
+        # Polling the flags moves the clock on to TxDone
+        while not self.lora_a.get_irq_flags()['tx_done']:
+            pass
+        self.assertAlmostEqual(self.channel.time, self.radio_a.time_on_air(4))
+        self.assertEqual(ring.get_nowait().payload, b'poll')
+
+    def test_settings_must_match(self):
+        ring = self.lora_b.start_rx_pipeline()
+        self.lora_b.set_mode(MODE.STDBY)
+        self.lora_b.set_spreading_factor(8)
+        self.lora_b.set_mode(MODE.RXCONT)
+        self.lora_a.write_payload(b'sf7')
+        self.lora_a.set_mode(MODE.TX)
+        self.channel.run()
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(self.channel.sent, 1)
+        self.assertEqual(self.channel.delivered, 0)
+
+    def test_collision(self):
+        radio_c, lora_c = make_radio(self.channel)
+        ring = lora_c.start_rx_pipeline()
+        for lora in (self.lora_a, self.lora_b):
+            lora.write_payload(b'collide')
+            lora.set_mode(MODE.TX)
+        self.channel.run()
+        packets = ring.drain()
+        self.assertEqual(len(packets), 2)
+        self.assertFalse(any(p.crc_ok for p in packets))
+        self.assertEqual(self.channel.collisions, 2)
+
+    def test_rx_single_timeout(self):
+        self.lora_b.set_dio_mapping([0] * 6)
+        self.lora_b.set_symb_timeout(10)
+        self.lora_b.set_mode(MODE.RXSINGLE)
+        self.channel.run()
+        self.assertTrue(self.lora_b.get_irq_flags()['rx_timeout'])
+        self.assertEqual(self.lora_b.get_mode(), MODE.STDBY)
+        self.assertAlmostEqual(self.channel.time, 10 * self.radio_b.symbol_time())
+
+    def test_cad(self):
+        self.lora_b.set_dio_mapping([2, 2, 0, 0, 0, 0])
+        self.lora_b.set_mode(MODE.CAD)
+        self.channel.run()
+        self.assertEqual(self.lora_b.get_irq_flags()['cad_detected'], 0)
+        self.lora_b.clear_irq_flags(CadDone=1)
+        self.lora_a.write_payload(b'busy' * 10)
+        self.lora_a.set_mode(MODE.TX)
+        self.lora_b.set_mode(MODE.STDBY)
+        self.lora_b.set_mode(MODE.CAD)
+        self.channel.step()
+        flags = self.lora_b.get_irq_flags()
+        self.assertEqual((flags['cad_done'], flags['cad_detected']), (1, 1))
+
+
+class TestSimulatedAsyncLoRa(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_send_receive(self):
+        channel = SimChannel()
+        # Without DIO lines AsyncLoRa polls the IRQ flags, which moves the simulation along
+        radio_a, lora_a = make_radio(channel, dio_lines=False)
+        radio_b, lora_b = make_radio(channel, dio_lines=False)
+        async with AsyncLoRa(lora_a) as a, AsyncLoRa(lora_b) as b:
+            await a.send(b'ping', timeout=1)
+            packet = await b.receive(timeout=1)
+            self.assertEqual(packet.payload, b'ping')
+            await b.send(b'pong', timeout=1)
+            packet = await a.receive(timeout=1)
+            self.assertEqual(packet.payload, b'pong')
+
+    async def test_packet_between_clears(self):
+        channel = SimChannel()
+        radio, lora = make_radio(channel, dio_lines=False)
+        fetch_packet = lora.fetch_packet
+        def fetch_and_receive(timestamp=None):
+            # The next packet comes in right after the first one's IRQ flags are cleared
+            packet = fetch_packet(timestamp)
+            if packet is not None and packet.payload == b'first':
+                radio.deliver(b'second', -60., 9.5)
+            return packet
+        lora.fetch_packet = fetch_and_receive
+        async with AsyncLoRa(lora, poll_interval=0.001) as radio_async:
+            radio.deliver(b'first', -60., 9.5)
+            self.assertEqual((await radio_async.receive(timeout=1)).payload, b'first')
+            # The poll that handled the first packet must not clear the second one's RxDone
+            self.assertEqual((await radio_async.receive(timeout=1)).payload, b'second')
+
+
+class TestRadioPool(unittest.IsolatedAsyncioTestCase):
+
+    def test_derive(self):
+        class Board(BaseBoard):
+            DIO0 = 4
+
+            @classmethod
+            def SpiDev(cls, spi_bus=0, spi_cs=0):
+                cls.spi = (spi_bus, spi_cs)
+                return cls.spi
+
+        board_a = Board.derive(spi_cs=1, DIO0=5)
+        board_b = Board.derive(spi_bus=1, name='Second')
+        self.assertEqual(board_a.SpiDev(), (0, 1))
+        self.assertEqual(board_b.SpiDev(), (1, 0))
+        self.assertEqual(board_a.SpiDev(spi_cs=2), (0, 2))
+        self.assertEqual((board_a.spi, board_b.spi), ((0, 2), (1, 0)))
+        self.assertFalse(hasattr(Board, 'spi'))
+        self.assertEqual((board_a.DIO0, board_b.DIO0), (5, 4))
+        self.assertEqual(board_b.__name__, 'Second')
+        self.assertTrue(issubclass(board_a, Board))
+
+    async def test_pool(self):
+        channel = SimChannel()
+        loras = []
+        senders = []
+        for i in range(3):
+            for radios in (loras, senders):
+                radio, lora = make_radio(channel, dio_lines=False)
+                lora.tune(i, plan=EU868)
+                radios.append(lora)
+        async with RadioPool(loras, poll_interval=0.001, clock=lambda: channel.time) as pool:
+            for i, sender in enumerate(senders):
+                sender.transmit(bytes([i]) * 10)
+            received = sorted([await pool.receive(timeout=1) for i in range(3)], key=lambda p: p.radio)
+            self.assertEqual([(p.radio, p.packet.payload) for p in received],
+                             [(i, bytes([i]) * 10) for i in range(3)])
+            used = await asyncio.gather(*[pool.send(bytes([i]) * 20, timeout=1) for i in range(6)])
+            self.assertEqual(sorted(used), [0, 0, 1, 1, 2, 2])
+            stats = pool.stats()
+        self.assertEqual([r['tx_packets'] for r in stats['radios']], [2, 2, 2])
+        self.assertEqual([r['rx_packets'] for r in stats['radios']], [1, 1, 1])
+        total = stats['total']
+        self.assertEqual((total['tx_bytes'], total['rx_bytes'], total['tx_errors']), (120, 30, 0))
+        self.assertAlmostEqual(total['tx_airtime'], 6 * loras[0].time_on_air(20))
+        self.assertGreater(stats['elapsed'], 0)
+        self.assertAlmostEqual(total['tx_rate'], 6 / stats['elapsed'])
+        for lora in loras:
+            self.assertEqual(lora.get_mode(), MODE.SLEEP)
+
+
+class TestSpiBus(unittest.TestCase):
+
+    def test_priority_order(self):
+        bus = SpiBus()
+        order = []
+        threads = []
+        bus.acquire()
+        for priority in (BACKGROUND, NORMAL, IRQ, NORMAL):
+            def run(priority=priority):
+                with bus.hold(priority):
+                    order.append(priority)
+            thread = threading.Thread(target=run)
+            thread.start()
+            threads.append(thread)
+            while bus.queue_depth() < len(threads):
+                time.sleep(0.001)
+        # Taking the bus again while holding it doesn't wait
+        with bus.hold(BACKGROUND):
+            pass
+        bus.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [IRQ, NORMAL, NORMAL, BACKGROUND])
+        stats = bus.stats()
+        self.assertEqual(stats['max_queue'], 4)
+        self.assertEqual(stats['waits']['normal']['count'], 3)
+        self.assertEqual(stats['waits']['background']['count'], 1)
+        self.assertGreaterEqual(stats['waits']['background']['max'], stats['waits']['irq']['max'])
+
+    def test_shared_bus(self):
+        channel = SimChannel()
+        bus = SpiBus()
+        radio_a, lora_a = make_radio(channel, wrap_board=bus.board)
+        radio_b, lora_b = make_radio(channel, wrap_board=bus.board)
+        ring = lora_b.start_rx_pipeline()
+        self.assertEqual(bus.stats()['waits']['irq']['count'], 0)
+        lora_a.transmit(b'hello')
+        channel.run()
+        self.assertEqual(ring.get_nowait().payload, b'hello')
+        # B read the packet out from its RxDone callback
+        self.assertGreater(bus.stats()['waits']['irq']['count'], 0)
+        with bus.priority(BACKGROUND):
+            lora_a.snapshot()
+        stats = bus.stats()
+        self.assertGreater(stats['waits']['background']['count'], 0)
+        self.assertEqual(stats['transfers'], radio_a.xfer_count + radio_b.xfer_count)
+        self.assertEqual(stats['bytes'], radio_a.bytes_transferred + radio_b.bytes_transferred)
+        self.assertTrue(0 < stats['utilisation'] <= 1)
+
+
+class TestLocking(unittest.TestCase):
+
+    def test_atomic(self):
+        radio, lora = make_radio(SimChannel())
+        done = threading.Event()
+        def monitor():
+            lora.get_mode()
+            done.set()
+        with lora.atomic():
+            thread = threading.Thread(target=monitor)
+            thread.start()
+            self.assertFalse(done.wait(0.05))
+            # Re-entrant
+            with lora.atomic():
+                lora.write_payload(b'held')
+        thread.join()
+        self.assertTrue(done.is_set())
+        stats = lora.lock.stats()
+        self.assertEqual(stats['contended'], 1)
+        self.assertGreaterEqual(stats['wait']['max'], 0.04)
+        self.assertGreaterEqual(stats['hold']['max'], 0.04)
+        self.assertGreater(stats['acquisitions'], stats['contended'])
+
+    def test_monitor_under_rx_load(self):
+        # The monitor thread must not fast forward the simulation itself
+        channel = SimChannel(fast_forward=False)
+        radio_a, lora_a = make_radio(channel)
+        radio_b, lora_b = make_radio(channel)
+        ring = lora_b.start_rx_pipeline()
+        stop = threading.Event()
+        peeks = []
+        def monitor():
+            while not stop.is_set():
+                lora_b.snapshot()
+                # Moves FifoAddrPtr, which would spoil a packet being fetched if it got in between
+                peeks.append(lora_b.read_payload_bytes(nocheck=True))
+        thread = threading.Thread(target=monitor)
+        thread.start()
+        try:
+            payloads = [bytes([i]) * (16 + i) for i in range(40)]
+            for payload in payloads:
+                lora_a.transmit(payload)
+                channel.run()
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual([p.payload for p in ring.drain()], payloads)
+        self.assertTrue(peeks)
+        self.assertGreater(lora_b.lock.stats()['hold']['count'], len(payloads))
+
+
+class TestAirtime(unittest.TestCase):
+
+    def test_time_on_air(self):
+        self.assertEqual(payload_symbols(10), 28)
+        params = AirtimeParams(12, 125000., CODING_RATE.CR4_5, 8, False, True, True)
+        self.assertAlmostEqual(params.symbol_time(), 0.032768)
+        self.assertAlmostEqual(params.time_on_air(51), 2.465792)
+        # Implicit header and no CRC make it shorter
+        self.assertLess(time_on_air(10, implicit_header_mode=True, rx_crc=False), time_on_air(10))
+
+    def test_table(self):
+        params = [AirtimeParams(sf, 125000., CODING_RATE.CR4_5, 8, False, True, sf >= 11) for sf in range(7, 13)]
+        lengths = [0, 1, 10, 51, 222, 255]
+        table = time_on_air_table(lengths, params)
+        self.assertEqual(len(table), len(params))
+        for row, p in zip(table, params):
+            self.assertEqual(len(row), len(lengths))
+            for value, n in zip(row, lengths):
+                self.assertAlmostEqual(float(value), p.time_on_air(n))
+
+    def test_driver(self):
+        channel = SimChannel()
+        radio, lora = make_radio(channel)
+        params = lora.get_airtime_params()
+        self.assertEqual(params, AirtimeParams.from_registers(radio.registers))
+        self.assertEqual((params.spreading_factor, params.bw_hz, params.rx_crc), (7, 125000., True))
+        lora.write_payload(b'x' * 10)
+        self.assertAlmostEqual(lora.time_on_air(), 0.041216)
+        self.assertAlmostEqual(lora.time_on_air(51), radio.time_on_air(51))
+
+    def test_ledger(self):
+        now = [0.]
+        ledger = DutyCycleLedger(0.01, window=100., clock=lambda: now[0])
+        self.assertEqual(ledger.budget, 1.)
+        ledger.record(0.4)
+        now[0] = 10.
+        ledger.record(0.4)
+        self.assertAlmostEqual(ledger.available(), 0.2)
+        self.assertTrue(ledger.can_send(0.2))
+        # Room for 0.3 s comes when the first transmission leaves the window
+        self.assertAlmostEqual(ledger.wait_time(0.3), 90.4)
+        self.assertEqual(ledger.wait_time(2.), float('inf'))
+        now[0] = 100.4
+        self.assertAlmostEqual(ledger.used(), 0.4)
+        ledger.charge(0.6)
+        with self.assertRaises(DutyCycleExceeded) as raised:
+            ledger.charge(0.1)
+        self.assertAlmostEqual(raised.exception.wait, 10.)
+        self.assertEqual(ledger.refused, 1)
+
+    def test_driver_ledger(self):
+        channel = SimChannel()
+        radio, lora = make_radio(channel)
+        lora.duty_cycle = DutyCycleLedger(0.01, window=10., clock=lambda: channel.time)
+        sent = 0
+        with self.assertRaises(DutyCycleExceeded):
+            while True:
+                lora.write_payload(b'x' * 10)
+                lora.set_mode(MODE.TX)
+                channel.run()
+                sent += 1
+        # 0.1 s of budget fits two 41 ms packets
+        self.assertEqual(sent, 2)
+        self.assertEqual(channel.sent, 2)
+        self.assertEqual(lora.get_mode(), MODE.STDBY)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = SimChannel()
+        self.radio, self.lora = make_radio(self.channel)
+        self.received = []
+        self.lora.on_tx_done = self.on_tx_done
+        self.airtime = self.lora.time_on_air(10)
+
+    def on_tx_done(self):
+        self.lora.clear_irq_flags(TxDone=1)
+        self.lora.set_mode(MODE.STDBY)
+
+    def make_scheduler(self, duty_cycle=0.01, window=10.):
+        return TxScheduler(self.lora, [SubBand('test', 868., 868.6, duty_cycle)], window=window,
+                           clock=lambda: self.channel.time)
+
+    def run_scheduler(self, scheduler, limit=10):
+        """ Send everything in the queue, moving the clock on while the scheduler waits. """
+        while len(scheduler):
+            wait = scheduler.poll()
+            if wait is None:
+                # Transmitting
+                self.channel.run()
+                self.lora.handle_irq_flags()
+            elif wait:
+                self.assertLess(wait, limit)
+                self.channel.advance(wait)
+
+    def test_priority(self):
+        scheduler = self.make_scheduler()
+        low = scheduler.submit(b'low')
+        high = scheduler.submit(b'high', priority=1)
+        later = scheduler.submit(b'later', priority=1, not_before=0.5)
+        self.run_scheduler(scheduler)
+        self.assertEqual([r.status for r in (low, high, later)], [SENT] * 3)
+        self.assertLess(high.sent, later.sent)
+        self.assertLess(later.sent, low.sent)
+        self.assertGreaterEqual(later.sent, 0.5)
+
+    def test_duty_cycle(self):
+        # 0.1 s of airtime saved up, then 10 ms per second
+        scheduler = self.make_scheduler()
+        requests = [scheduler.submit(b'x' * 10) for i in range(4)]
+        self.run_scheduler(scheduler)
+        self.assertEqual(self.channel.sent, 4)
+        starts = [r.sent for r in requests]
+        # Two fit in the bucket at once; after that each waits for its airtime to trickle back in
+        self.assertLess(starts[1], 2 * self.airtime + 0.001)
+        self.assertAlmostEqual(starts[3] - starts[2], self.airtime / 0.01, places=3)
+        stats = scheduler.stats()
+        self.assertEqual(stats['sent'], 4)
+        self.assertAlmostEqual(stats['sub_bands']['test']['airtime'], 4 * self.airtime)
+        self.assertGreater(stats['sub_bands']['test']['utilisation'], 0.9)
+        self.assertEqual(stats['wait']['count'], 4)
+
+    def test_outside_sub_bands(self):
+        self.lora.set_freq(915.)
+        scheduler = self.make_scheduler()
+        for i in range(10):
+            scheduler.submit(b'x' * 10)
+        self.run_scheduler(scheduler, limit=0)
+        self.assertEqual(scheduler.sent, 10)
+
+    def test_deadline(self):
+        scheduler = self.make_scheduler()
+        first, second = scheduler.submit(b'x' * 10), scheduler.submit(b'x' * 10)
+        late = scheduler.submit(b'late' * 10, deadline=1.)
+        never = scheduler.submit(b'x' * 255)
+        after = scheduler.submit(b'x' * 10, priority=-1)
+        self.run_scheduler(scheduler)
+        self.assertEqual([r.status for r in (first, second, late, never, after)], [SENT, SENT, EXPIRED, REJECTED, SENT])
+        self.assertEqual((scheduler.expired, scheduler.rejected), (1, 1))
+
+    def test_beacon(self):
+        # Like tx_beacon.py: each TxDone schedules the next beacon a second later, on the scheduler's clock
+        self.channel.advance(1000.)
+        scheduler = self.make_scheduler(duty_cycle=0.1)
+        beacons = [scheduler.submit(b'\x0f', not_before=scheduler.clock())]
+        def on_tx_done():
+            self.on_tx_done()
+            if len(beacons) < 2:
+                beacons.append(scheduler.submit(b'\x0f', not_before=scheduler.clock() + 1.))
+        self.lora.on_tx_done = on_tx_done
+        while self.channel.sent < 2:
+            wait = scheduler.poll()
+            if wait is None:
+                self.channel.run()
+                self.lora.handle_irq_flags()
+            elif wait:
+                self.assertLess(wait, 2)
+                self.channel.advance(wait)
+        self.assertEqual([r.status for r in beacons], [SENT, SENT])
+        self.assertEqual(self.channel.sent, 2)
+        self.assertAlmostEqual(beacons[0].sent, 1000.)
+        self.assertAlmostEqual(beacons[1].sent - beacons[0].sent, 1. + self.lora.time_on_air(1), places=3)
+
+    def test_driver_ledger(self):
+        # The driver's own ledger is stricter, and the scheduler waits for it instead of tripping it
+        self.lora.duty_cycle = DutyCycleLedger(0.001, window=100., clock=lambda: self.channel.time)
+        scheduler = self.make_scheduler()
+        requests = [scheduler.submit(b'x' * 10) for i in range(3)]
+        self.run_scheduler(scheduler, limit=200)
+        self.assertAlmostEqual(requests[2].sent, requests[0].sent + 100 + self.airtime, places=3)
+
+
+class TestListenBeforeTalk(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = SimChannel()
+        self.radio_a, self.lora_a = make_radio(self.channel, dio_lines=False)
+        self.radio_b, self.lora_b = make_radio(self.channel, dio_lines=False)
+        self.radio_c, self.lora_c = make_radio(self.channel)
+        self.ring = self.lora_c.start_rx_pipeline()
+        self.lbt = ListenBeforeTalk(rng=random.Random(1), clock=lambda: self.channel.time, sleep=self.channel.advance)
+
+    def test_cad(self):
+        self.assertFalse(self.lora_b.cad())
+        self.assertEqual(self.lora_b.get_mode(), MODE.STDBY)
+        self.lora_a.transmit(b'x' * 60)
+        self.assertTrue(self.lora_b.cad())
+        self.assertEqual(self.lora_b.get_irq_flags()['cad_done'], 0)
+
+    def test_without_lbt(self):
+        self.lora_a.transmit(b'x' * 60)
+        self.lora_b.transmit(b'y' * 10)
+        self.channel.run()
+        self.assertEqual(self.channel.collisions, 2)
+
+    def test_backoff(self):
+        self.lora_a.transmit(b'x' * 60)
+        end = self.radio_a.time_on_air(60)
+        self.lora_b.lbt = self.lbt
+        self.lora_b.transmit(b'y' * 10)
+        # B held off until A was done
+        self.assertGreaterEqual(self.channel.time, end)
+        self.channel.run()
+        self.assertEqual(self.channel.collisions, 0)
+        self.assertEqual(sorted(p.payload for p in self.ring.drain()), [b'x' * 60, b'y' * 10])
+        stats = self.lbt.stats()
+        self.assertEqual(stats['acquired'], 1)
+        self.assertGreaterEqual(stats['busy_cad'], 1)
+        self.assertEqual(stats['checks'], stats['busy_cad'] + 1)
+        self.assertGreater(stats['backoff_time'], 0)
+        self.assertGreaterEqual(stats['access_delay']['max'], end)
+
+    def test_gives_up(self):
+        # Nothing is on the air, but the RSSI threshold is below the noise floor
+        self.lbt.rssi_threshold = -200
+        self.lbt.max_attempts = 3
+        self.lora_b.lbt = self.lbt
+        with self.assertRaises(ChannelBusy):
+            self.lora_b.transmit(b'never')
+        self.assertEqual(self.channel.sent, 0)
+        self.assertEqual(self.lbt.stats()['busy_rssi'], 3)
+        self.assertEqual(self.lbt.gave_up, 1)
+        self.assertEqual(self.lora_b.get_mode(), MODE.STDBY)
+
+    def test_backoff_grows(self):
+        lbt = ListenBeforeTalk(slot=0.01, max_backoff=0.05, rng=random.Random(1))
+        for busy_count, limit in ((1, 0.01), (2, 0.02), (3, 0.04), (4, 0.05), (10, 0.05)):
+            draws = [lbt.backoff(busy_count) for i in range(200)]
+            self.assertLessEqual(max(draws), limit)
+            self.assertGreater(max(draws), limit * 0.9)
+
+
+class TestChannelPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = SimChannel()
+
+    def test_plans(self):
+        self.assertEqual((len(EU868), len(US915), len(AS923)), (8, 72, 8))
+        self.assertAlmostEqual(US915[63], 914.9)
+        self.assertAlmostEqual(US915[71], 914.2)
+        for plan in (EU868, US915, AS923):
+            for channel, frequency in enumerate(plan.frequencies):
+                self.assertEqual(list(plan.registers[channel]), encode_freq(frequency))
+                self.assertEqual(plan.channel(encode_freq(frequency)), channel)
+        self.assertIsNone(EU868.channel(encode_freq(433.)))
+        plan = ChannelPlan.spaced(433.05, 0.025, 69, name='LPD433')
+        self.assertAlmostEqual(plan[68], 434.75)
+        self.assertEqual(repr(plan), "ChannelPlan(LPD433)")
+
+    def test_tune(self):
+        radio, lora = make_radio(self.channel)
+        lora.channel_plan = AS923
+        transfers = radio.xfer_count
+        lora.tune(2)
+        self.assertEqual(radio.xfer_count - transfers, 1)
+        self.assertEqual(lora.get_channel(), 2)
+        self.assertAlmostEqual(lora.get_freq(), 922.2, places=3)
+        lora.set_mode(MODE.RXCONT)
+        transfers = radio.xfer_count
+        lora.tune(5, MODE.RXCONT)
+        self.assertEqual(radio.xfer_count - transfers, 3)
+        self.assertEqual(lora.get_mode(), MODE.RXCONT)
+        self.assertEqual(lora.get_channel(), 5)
+        lora.set_mode(MODE.STDBY)
+        lora.set_freq(915.)
+        self.assertIsNone(lora.get_channel())
+
+    def test_scan(self):
+        radio_a, lora_a = make_radio(self.channel)
+        radio_b, lora_b = make_radio(self.channel)
+        lora_a.tune(2, plan=EU868)
+        lora_a.transmit(b'x' * 200)
+        readings = EU868.scan(lora_b, channels=[0, 1, 2, 3], samples=2, sleep=self.channel.advance)
+        readings = [list(row) for row in readings]
+        self.assertEqual(readings, [[-120, -120], [-120, -120], [-60, -60], [-120, -120]])
+        self.assertEqual(lora_b.get_mode(), MODE.STDBY)
+        self.assertEqual(lora_b.get_channel(EU868), 3)
+
+
+class TestFhss(unittest.TestCase):
+
+    CHANNELS = [868.1, 868.3, 868.5, 868.7]
+    SEQUENCE = [0, 3, 1, 2]
+
+    def setUp(self):
+        self.channel = SimChannel()
+
+    def make_engine(self, lora, **kwargs):
+        engine = FhssEngine(lora, self.CHANNELS, self.SEQUENCE, hop_period=8, **kwargs)
+        engine.start()
+        return engine
+
+    def test_hopping(self):
+        radio_a, lora_a = make_radio(self.channel)
+        radio_b, lora_b = make_radio(self.channel)
+        radio_c, lora_c = make_radio(self.channel)
+        engine_a = self.make_engine(lora_a)
+        engine_b = self.make_engine(lora_b)
+        # C starts on the right channel with the right hop period, but does not hop
+        lora_c.set_hop_period(8)
+        ring_b = lora_b.start_rx_pipeline()
+        ring_c = lora_c.start_rx_pipeline()
+        lora_a.transmit(b'x' * 60)
+        self.channel.run()
+        self.assertEqual([p.payload for p in ring_b.drain()], [b'x' * 60])
+        self.assertEqual(ring_c.drain(), [])
+        hops = int(radio_a.time_on_air(60) / engine_a.hop_time)
+        self.assertEqual(radio_a.hops, hops)
+        for engine in (engine_a, engine_b):
+            stats = engine.stats()
+            self.assertEqual(stats['hops'], hops)
+            self.assertEqual(stats['missed'], 0)
+            self.assertEqual(stats['late'], 0)
+        self.assertEqual(radio_b.missed_hops, 0)
+        # Both are back on the first channel for the next packet
+        self.assertAlmostEqual(lora_b.get_freq(), 868.1, places=3)
+        lora_a.set_mode(MODE.STDBY)
+        lora_a.transmit(b'y' * 20)
+        self.channel.run()
+        self.assertEqual([p.payload for p in ring_b.drain()], [b'y' * 20])
+        engine_b.stop()
+        self.assertIsNone(lora_b.fhss)
+        self.assertEqual(lora_b.get_hop_period(), 0)
+
+    def test_missed_hop(self):
+        radio, lora = make_radio(self.channel, dio_lines=False)
+        engine = self.make_engine(lora)
+        lora.transmit(b'x' * 60)
+        # Nobody looks at the IRQ flags for two and a half hops
+        self.channel.advance(2.5 * engine.hop_time)
+        self.assertEqual(radio.missed_hops, 1)
+        self.assertEqual(lora.get_hop_channel()['fhss_present_channel'], 2)
+        lora.handle_irq_flags()
+        self.assertEqual(engine.missed, 1)
+        self.assertEqual(engine.hops, 1)
+        # Reading IRQ_FLAGS through the driver would fast forward to the next hop
+        self.assertEqual(radio.registers[REG.LORA.IRQ_FLAGS], 0)
+        # The engine caught up with the modem, onto the channel for the third hop
+        self.assertAlmostEqual(lora.get_freq(), self.CHANNELS[self.SEQUENCE[2]], places=3)
+
+    def test_late_hop(self):
+        radio, lora = make_radio(self.channel, dio_lines=False)
+        engine = self.make_engine(lora, clock=lambda: 1.)
+        radio.hop(1)
+        lora.irq_timestamp = 1. - engine.hop_time / 2
+        engine.hop()
+        radio.hop(2)
+        lora.irq_timestamp = 1. - engine.hop_time * 2
+        engine.hop()
+        self.assertEqual(engine.hops, 2)
+        self.assertEqual(engine.late, 1)
+        self.assertAlmostEqual(engine.stats()['latency']['max'], engine.hop_time * 2)
+
+    def test_untracked(self):
+        radio, lora = make_radio(self.channel, dio_lines=False)
+        engine = self.make_engine(lora, track_channel=False)
+        radio.hop(1)
+        transfers = radio.xfer_count
+        engine.hop()
+        self.assertEqual(radio.xfer_count - transfers, 2)
+        self.assertAlmostEqual(lora.get_freq(), self.CHANNELS[self.SEQUENCE[1]], places=3)
+
+
+class TestPoller(unittest.TestCase):
+
+    def setUp(self):
+        # The poller sleeps on the simulation clock, so nothing may move it behind the poller's back
+        self.channel = SimChannel(fast_forward=False)
+        self.radio_a, self.lora_a = make_radio(self.channel, dio_lines=False)
+        self.radio_b, self.lora_b = make_radio(self.channel, dio_lines=False)
+
+    def make_poller(self, lora, **kwargs):
+        kwargs.setdefault('cpu_budget', None)
+        return IrqPoller(lora, latency_target=0.005, max_interval=0.05, clock=lambda: self.channel.time,
+                         sleep=self.channel.advance, **kwargs)
+
+    def test_rx(self):
+        ring = self.lora_b.start_rx_pipeline()
+        poller = self.make_poller(self.lora_b)
+        self.assertFalse(poller.run(timeout=1))
+        # Nothing going on, so it has backed off all the way
+        self.assertEqual(poller.interval, 0.05)
+        self.assertEqual(poller.active_polls, 0)
+        self.lora_a.write_payload(b'x' * 60)
+        self.lora_a.set_mode(MODE.TX)
+        self.assertGreater(self.radio_a.time_on_air(60), 0.05)
+        self.assertTrue(poller.run(until=lambda: len(ring), timeout=1))
+        self.assertEqual(ring.get_nowait().payload, b'x' * 60)
+        stats = poller.stats()
+        self.assertEqual(stats['packets'], 1)
+        self.assertGreater(stats['active_polls'], 1)
+        # It saw the packet coming in and tightened up before RxDone
+        self.assertLessEqual(stats['latency']['max'], 0.005 + 1e-9)
+
+    def test_tx(self):
+        done = []
+        def on_tx_done():
+            self.lora_a.clear_irq_flags(TxDone=1)
+            self.lora_a.set_mode(MODE.STDBY)
+            done.append(self.channel.time)
+        self.lora_a.on_tx_done = on_tx_done
+        poller = self.make_poller(self.lora_a)
+        self.lora_a.write_payload(b'beacon')
+        self.lora_a.set_mode(MODE.TX)
+        self.assertTrue(poller.run(until=lambda: done, timeout=1))
+        self.assertEqual(poller.stats()['latency']['count'], 1)
+        self.assertLessEqual(poller.stats()['latency']['max'], 0.005 + 1e-9)
+        self.assertEqual(poller.active_polls, poller.polls)
+        # Back in STDBY, it backs off again
+        poller.run(timeout=1)
+        self.assertEqual(poller.interval, 0.05)
+
+    def test_cpu_budget(self):
+        cpu = iter(range(1000000))
+        # Each poll takes 1ms of CPU time, so a 1% budget allows one poll every 100ms
+        poller = self.make_poller(self.lora_b, cpu_budget=0.01, cpu_clock=lambda: next(cpu) / 1000.)
+        self.assertAlmostEqual(poller.poll(), 0.1)
+        self.channel.advance(0.1)
+        poller.run(timeout=0.95)
+        # Polls at 0, 0.1 .. 1.0 and at the deadline
+        self.assertEqual(poller.polls, 12)
+        self.assertAlmostEqual(poller.interval, 0.1)
+
+
+class TestReplay(unittest.TestCase):
+
+    def record(self):
+        """ Record a radio receiving three packets through the receive pipeline. """
+        channel = SimChannel()
+        trace_file = io.BytesIO()
+        recorder = Recorder(trace_file)
+        radio_a, lora_a = make_radio(channel)
+        radio_b, lora_b = make_radio(channel, wrap_board=recorder.board)
+        ring = lora_b.start_rx_pipeline()
+        for payload in (b'one', b'two', b'three'):
+            lora_a.write_payload(payload)
+            lora_a.set_mode(MODE.TX)
+            channel.run()
+        self.assertEqual(len(ring), 3)
+        recorder.stop()
+        trace_file.seek(0)
+        return trace_file
+
+    def test_replay(self):
+        replay = ReplaySpi.load(self.record(), strict=True)
+        self.assertEqual(sum(t.direction == 'D' for t in replay.traces), 3)
+        lora = LoRa(replay.board(), verbose=False)
+        configure(lora)
+        ring = lora.start_rx_pipeline()
+        self.assertEqual(replay.run(), 3)
+        self.assertTrue(replay.done)
+        self.assertEqual([p.payload for p in ring.drain()], [b'one', b'two', b'three'])
+
+    def test_divergence(self):
+        replay = ReplaySpi.load(self.record())
+        lora = LoRa(replay.board(), verbose=False)
+        configure(lora)
+        lora.set_sync_word(0x34)
+        ring = lora.start_rx_pipeline()
+        replay.run()
+        self.assertEqual(len(replay.divergences), 1)
+        self.assertEqual(replay.divergences[0].mosi, bytes([REG.LORA.SYNC_WORD | 0x80, 0x34]))
+        # Back in step afterwards
+        self.assertEqual(len(ring), 3)
+
+        replay = ReplaySpi.load(self.record(), strict=True)
+        lora = LoRa(replay.board(), verbose=False)
+        configure(lora)
+        with self.assertRaises(ReplayDivergence):
+            lora.set_sync_word(0x34)
+        replay.strict = False
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        board = sim_board()
+        board.max_speed_hz = 1000000
+        report = json.loads(json.dumps(run_benchmarks(board, iterations=5)))
+        self.assertEqual(report['max_speed_hz'], 1000000)
+        scenarios = report['scenarios']
+        self.assertEqual(scenarios['mode_switch']['xfers_per_op'], 1)
+        self.assertEqual(scenarios['mode_switch']['bus_us_per_op'], 16.)
+        self.assertEqual(scenarios['apply_profile']['xfers_per_op'], 4)
+        # Writing the 64 byte payload is one burst, plus the length, mode and FIFO pointer
+        self.assertEqual(scenarios['write_payload']['bytes_per_op'], 65 + 2 + 2 + 2)
+        self.assertEqual(scenarios['rx_loop']['xfers_per_op'], 6)
+        # STDBY, the frequency burst and RXCONT
+        self.assertEqual(scenarios['tune']['xfers_per_op'], 3)
+        # HOP_CHANNEL, the frequency burst and the IRQ flag
+        self.assertEqual(scenarios['fhss_hop']['xfers_per_op'], 3)
+        for stats in scenarios.values():
+            self.assertLessEqual(stats['p50_us'], stats['p99_us'])
+
+    def test_subset(self):
+        report = run_benchmarks(sim_board(), iterations=2, scenarios=['register_dump'], cache_registers=True)
+        self.assertEqual(list(report['scenarios']), ['register_dump'])
+        self.assertEqual(report['scenarios']['register_dump']['xfers_per_op'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
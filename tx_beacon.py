@@ -26,6 +26,8 @@ import sys
 from time import sleep
 from spi_lora.LoRa import *
 from spi_lora.LoRaArgumentParser import LoRaArgumentParser
+from spi_lora.poller import IrqPoller
+from spi_lora.scheduler import TxScheduler
 from spi_lora.boards.Generic_RFM95W import BOARD
 
 BOARD.setup()
@@ -45,6 +47,8 @@ class LoRaBeacon(LoRa):
         self.set_mode(MODE.SLEEP)
         self.set_dio_mapping([1,0,0,0,0,0])
         self.message = None
+        self.next_beacon = None
+        self.scheduler = None
 
     def on_rx_done(self):
         print("\nRxDone")
@@ -65,8 +69,8 @@ class LoRaBeacon(LoRa):
             print
             sys.exit(0)
         BOARD.led_off()
-        sleep(args.wait)
-        self._send_message()
+        # On the scheduler's clock, which is time.monotonic() and not time.time()
+        self.next_beacon = self.scheduler.clock() + args.wait
 
     def on_cad_done(self):
         print("\non_CadDone")
@@ -88,25 +92,31 @@ class LoRaBeacon(LoRa):
         print("\non_FhssChangeChannel")
         print(self.get_irq_flags())
         
-    def _send_message(self):
+    def _payload(self):
         if self.message:
             # Send the specified message
-            self.write_payload([b for b in self.message.encode('utf-8')])
+            return self.message.encode("utf-8")
         else:
             # Send a generic payload
-            self.write_payload([0x0f])
-        BOARD.led_on()
-        self.set_mode(MODE.TX)
+            return [0x0f]
 
     def start(self):
         global args
         sys.stdout.write("\rstart")
         self.tx_counter = 0
-        self._send_message()
+        # The scheduler holds each beacon back until the sub-band's duty cycle allows it
+        self.scheduler = scheduler = TxScheduler(self)
+        poller = None if self.irq_events_available else IrqPoller(self)
+        self.next_beacon = scheduler.clock()
         while True:
-            sleep(1)
-            if not self.irq_events_available:
-                self.handle_irq_flags()
+            if self.next_beacon is not None and self.mode != MODE.TX:
+                scheduler.submit(self._payload(), not_before=self.next_beacon)
+                self.next_beacon = None
+            wait = scheduler.poll()
+            if wait == 0:
+                BOARD.led_on()
+            waits = [w for w in (wait, poller.poll() if poller else None) if w is not None]
+            sleep(min(waits) if waits else 1)
 
 lora = LoRaBeacon(BOARD, verbose=False)
 args = parser.parse_args(lora)